@@ -1,67 +1,90 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 from flask_socketio import SocketIO, emit
 from dotenv import load_dotenv
 import os 
-import time
-from langchain_core.documents import Document
-from setupcouchbase import cb_vector_search, insert_user_message, insert_bot_message, update_bot_message_rating
-from langchain.memory import ChatMessageHistory
-from llm import create_openai_embeddings, generate_query_transform_prompt, generate_document_chain
+from setupcouchbase import cluster_connection
+from chat_writer import ChatWriter
+from chat_history import issue_session_token, session_from_token
+from chat_pipeline import ChatPipeline, SEMANTIC_CACHE, SEMANTIC_CACHE_REFRESH_SECONDS
+from retriever import retriever_from_env
+from llm import create_openai_embeddings, create_openai_embeddings_batch, get_rewrite_metrics
+from model_router import get_model_metrics
+from openai_scheduler import get_scheduler_metrics, SchedulerShed, BACKGROUND
+from vector_encoding import encode_vector
+from metrics import start_trace, timed_stage, render_metrics, METRICS_CONTENT_TYPE
 from data_processor.data_reformat import data_reformat
-from data_processor.metadata_tag import tag_metadata
+from data_processor.metadata_tag import tag_metadata, label_metadata, get_tagging_metrics
+from data_processor.batch import process_documents
+from data_processor.chunking import chunk_text
 import argparse 
-from couchbase.auth import PasswordAuthenticator
+import atexit
 from couchbase.cluster import Cluster
-from couchbase.options import ClusterOptions
 from datetime import timedelta
 
 load_dotenv()
 
 app = Flask(__name__)
-socketio = SocketIO(app)
+
+# with several app.py processes behind a load balancer, SOCKETIO_MESSAGE_QUEUE (e.g. redis://host:6379/0)
+# lets every process emit to clients connected to the others
+socketio = SocketIO(app, message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE"))
 
 #set up argparse 
 parser = argparse.ArgumentParser()
 parser.add_argument('--capella', action='store_true', default=False, help='if the environment is Capella')
+parser.add_argument('--port', type=int, default=int(os.getenv("PORT", 5000)))
 args = parser.parse_args()
 IS_CAPELLA = args.capella
 
 
 #set up couchbase
-if IS_CAPELLA:
-    print("Start setting up Capella cluster..")
-    endpoint = os.getenv("CB_HOSTNAME")
-    auth = PasswordAuthenticator(os.getenv("CB_USERNAME"), os.getenv("CB_PASSWORD"))
-    options = ClusterOptions(auth)
-    options.apply_profile('wan_development')
-    cluster = Cluster('couchbases://{}'.format(endpoint), options)
+print("Start setting up Capella cluster.." if IS_CAPELLA else "Start setting up EE cluster..")
+cluster = Cluster(*cluster_connection(IS_CAPELLA))
+cluster.wait_until_ready(timedelta(seconds=5))
+print("Couchbase setup complete")
 
-    # Wait until the cluster is ready for use.
+# k, candidates, filters, hybrid search and the context budget are set with the RETRIEVER_* variables
+retriever = retriever_from_env(cluster)
 
-else: 
-    # Connect options - authentication
-    print("Start setting up EE cluster..")
-    auth = PasswordAuthenticator(os.getenv("CB_USERNAME"), os.getenv("CB_PASSWORD"))
+# chat messages and ratings are written in batches by a background worker, whatever is queued is written on exit
+chat_writer = ChatWriter(cluster)
+atexit.register(chat_writer.close)
 
-    # Get a reference to our cluster
-    cluster = Cluster(f'couchbase://{os.getenv("EE_HOSTNAME")}', ClusterOptions(auth))
+# chat histories, the semantic answer cache, retrieval and persistence, see chat_pipeline.py
+pipeline = ChatPipeline(cluster, retriever, chat_writer)
 
 
-cluster.wait_until_ready(timedelta(seconds=5))
-print("Couchbase setup complete")
+def refresh_answer_cache():
+    while True:
+        pipeline.refresh_answer_cache()
+        socketio.sleep(SEMANTIC_CACHE_REFRESH_SECONDS)
 
-    
-chat_model_toggle = 1
-embedding_model_toggle = "model1"
 
-demo_ephemeral_chat_history = ChatMessageHistory()
+if SEMANTIC_CACHE:
+    socketio.start_background_task(refresh_answer_cache)
     
 @app.route('/')
 def index():
     return render_template('index.html')
-    global embedding_model_toggle
-    embedding_model_toggle = request.json['selectedModel']
-    return jsonify(success=True)
+
+
+# the chat session of every connection on this worker, by socket sid
+connection_sessions = {}
+
+
+# a client reconnecting with the token it was given resumes its session, anyone else starts a new one
+@socketio.on('connect')
+def handle_connect(auth=None):
+    session_id = session_from_token((auth or {}).get('session_token'))
+    if session_id is None:
+        session_id, token = issue_session_token()
+        emit('session', token)
+    connection_sessions[request.sid] = session_id
+
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    connection_sessions.pop(request.sid, None)
 
 
 @socketio.on('rating')
@@ -69,77 +92,94 @@ def handle_rating(rating_data):
     bot_message_id = rating_data['bot_message_id']
     score= rating_data['score']
     
-    update_bot_message_rating(cluster, bot_message_id, score)
+    chat_writer.submit_rating(bot_message_id, score)
 
 
 @socketio.on('message')
 def handle_message(msg_to_process):
+    session_id = connection_sessions.get(request.sid, request.sid)
+    trace = start_trace("message", session_id=session_id)
     
-    query = msg_to_process['query']
-    browserType = msg_to_process['browserType']
-    deviceType = msg_to_process['deviceType']
-    
-    #0. add user message, both locally and to couchbase
-    demo_ephemeral_chat_history.add_user_message(query)
-    
-    #1. incorporating the chat history together with the new questions to generate an independent prompt
-    new_query = generate_query_transform_prompt(demo_ephemeral_chat_history.messages)
-    print(f"Generated query: {new_query}")
-    
-    #2. turn it into an embedding
-    vector = create_openai_embeddings(new_query)
-    print(f"Generated vector..")
-   
-    #3. using Couchbase SDK  
-    result = cb_vector_search(cluster, "embedding", vector, 'assembled_for_embedding')
-    print(f"Search result retrieved..")
-    
-    #4. parsing the results
-    product_ids = []
-    additional_context = ""
-    documents = []
-    
-    for row in result.rows():
-        product_ids.append(row.id)
-        
-        additional_context += row.fields['assembled_for_embedding'] + "\n"
-        documents.append(row.fields)
-    
-    #5. streaming
-    document_chain = generate_document_chain()
-    
-    message_string = ""   
-    timestamp = int(time.time())
-    
-    for chunk in document_chain.stream({
-        "input": new_query, 
-        "context": [Document(page_content=additional_context)] 
-    }):
-        message_string += chunk
-            
-        emit('message', {
-            "timestamp": timestamp, 
-            "message_string": message_string,
-            "document_ids": product_ids,
-            "documents": documents
-        }) 
-        
-    #6. add bot message, both locally and to couchbase
-    demo_ephemeral_chat_history.add_ai_message(message_string)
-    user_message_uuid = insert_user_message(cluster, query, new_query, deviceType, browserType)
-    bot_message_id = insert_bot_message(cluster, message_string, user_message_uuid, product_ids)
-    
+    try:
+        persist = pipeline.answer(msg_to_process, session_id, trace, emit_events)
+        socketio.start_background_task(persist_messages, request.sid, persist)
+    finally:
+        trace.finish()
+
+
+def emit_events(events):
+    for event, payload in events:
+        emit(event, payload)
+
+
+@timed_stage("persist")
+def persist_messages(sid, persist):
+    bot_message_id = persist()
     if bot_message_id is not None:
-        emit('bot_message_creation', bot_message_id)
-   
+        socketio.emit('bot_message_creation', bot_message_id, to=sid)
+    
 
+# embeddings are returned in EMBEDDING_ENCODING, a float array or a base64 string, and stored as they are
 @app.route('/create_embedding', methods=['POST'])
 def split_string():
     data = request.get_json()
     string = data.get('string', '')
     
-    openai_embedding = create_openai_embeddings(string)    
-    return jsonify(openai_embedding)
+    openai_embedding = create_openai_embeddings(string, BACKGROUND)    
+    return jsonify(encode_vector(openai_embedding))
+
+
+# batch variant of /create_embedding: {"strings": [...]} returns the embeddings in the same order
+@app.route('/create_embeddings', methods=['POST'])
+def create_embeddings():
+    data = request.get_json()
+    strings = data.get('strings', [])
+    
+    openai_embeddings = create_openai_embeddings_batch(strings)
+    return jsonify([encode_vector(embedding) for embedding in openai_embeddings])
+
+
+# chunks of {"string": ...} and their embeddings, {"chunks": [{"text": ..., "embedding": [...]}, ...]}
+@app.route('/create_chunk_embeddings', methods=['POST'])
+def create_chunk_embeddings():
+    data = request.get_json()
+    chunks = chunk_text(data.get('string', ''))
+    
+    openai_embeddings = create_openai_embeddings_batch(chunks)
+    return jsonify(chunks=[dict(text=text, embedding=encode_vector(embedding)) for text, embedding in zip(chunks, openai_embeddings)])
+
+
+# prometheus text format: stage durations, couchbase operation latencies, openai tokens and cache hit rates
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route('/model_metrics', methods=['GET'])
+def model_metrics():
+    return jsonify(get_model_metrics())
+
+
+# concurrency limit, calls in flight, and per priority queue the waiting calls, wait times and shed calls
+@app.route('/scheduler_metrics', methods=['GET'])
+def scheduler_metrics():
+    return jsonify(get_scheduler_metrics())
+
+
+# background work the OpenAI scheduler couldn't fit before its deadline, the caller may retry later
+@app.errorhandler(SchedulerShed)
+def scheduler_shed(error):
+    return jsonify(error=str(error)), 503
+
+
+@app.route('/rewrite_metrics', methods=['GET'])
+def rewrite_metrics():
+    return jsonify(get_rewrite_metrics())
+
+
+@app.route('/tagging_metrics', methods=['GET'])
+def tagging_metrics():
+    return jsonify(get_tagging_metrics())
 
 
 @app.route('/data_reformatting', methods=['POST'])
@@ -160,6 +200,26 @@ def metadata_tag():
     type = tag_metadata(data)
 
     return jsonify(type)
+
+
+# batch variants of the enrichment endpoints: {"documents": [{"id": ..., "doc": {...}}, ...]} returns
+# {"results": [{"id": ..., "result": ..., "error": ...}, ...]}, the documents are processed concurrently
+@app.route('/data_reformatting_batch', methods=['POST'])
+def data_reformatting_batch():
+    data = request.get_json()
+    
+    results = process_documents(data_reformat, data.get('documents', []))
+
+    return jsonify(results=results)
+
+
+@app.route('/metadata_tag_batch', methods=['POST'])
+def metadata_tag_batch():
+    data = request.get_json()
+    
+    results = process_documents(label_metadata, data.get('documents', []))
+
+    return jsonify(results=results)
     
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=args.port)
\ No newline at end of file
@@ -0,0 +1,311 @@
+from aiohttp import web
+import socketio
+from dotenv import load_dotenv
+import os
+import asyncio
+import multiprocessing
+import signal
+import sys
+from setupcouchbase import cluster_connection
+from chat_writer import AsyncChatWriter
+from chat_history import issue_session_token, session_from_token
+from chat_pipeline import AsyncChatPipeline, SEMANTIC_CACHE, SEMANTIC_CACHE_REFRESH_SECONDS
+from retriever import retriever_from_env
+from llm import acreate_openai_embeddings, acreate_openai_embeddings_batch, get_rewrite_metrics
+from model_router import get_model_metrics
+from openai_scheduler import get_scheduler_metrics, SchedulerShed, BACKGROUND
+from vector_encoding import encode_vector
+from metrics import start_trace, timed_stage, render_metrics, METRICS_CONTENT_TYPE
+from data_processor.data_reformat import data_reformat
+from data_processor.metadata_tag import tag_metadata, label_metadata, get_tagging_metrics
+from data_processor.batch import process_documents
+from data_processor.chunking import chunk_text
+import argparse
+from acouchbase.cluster import Cluster
+from datetime import timedelta
+
+load_dotenv()
+
+# asyncio execution mode of app.py: the socket handlers, OpenAI calls and Couchbase operations are all
+# non-blocking, so many conversations are served concurrently by one process
+# with several processes or nodes, SOCKETIO_MESSAGE_QUEUE (e.g. redis://host:6379/0) lets every process
+# emit to clients connected to the others
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+client_manager = socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*', client_manager=client_manager)
+
+
+# background work the OpenAI scheduler couldn't fit before its deadline, the caller may retry later
+@web.middleware
+async def scheduler_shed(request, handler):
+    try:
+        return await handler(request)
+    except SchedulerShed as e:
+        return web.json_response({"error": str(e)}, status=503)
+
+
+app = web.Application(middlewares=[scheduler_shed])
+sio.attach(app)
+
+#set up argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--capella', action='store_true', default=False, help='if the environment is Capella')
+parser.add_argument('--port', type=int, default=int(os.getenv("PORT", 5000)))
+parser.add_argument('--workers', type=int, default=int(os.getenv("WORKERS", 1)), help='processes accepting connections on the same port')
+args = parser.parse_args()
+IS_CAPELLA = args.capella
+
+
+cluster = None
+chat_writer = None
+pipeline = None
+
+# persistence tasks running in the background, kept here so they're not garbage collected before they finish
+pending_persistence = set()
+
+
+#set up couchbase
+async def setup_couchbase(app):
+    global cluster, chat_writer, pipeline
+
+    print("Start setting up Capella cluster.." if IS_CAPELLA else "Start setting up EE cluster..")
+    cluster = await Cluster.connect(*cluster_connection(IS_CAPELLA))
+    await cluster.wait_until_ready(timedelta(seconds=5))
+    await cluster.bucket("main").on_connect()
+    print("Couchbase setup complete")
+
+    # k, candidates, filters, hybrid search and the context budget are set with the RETRIEVER_* variables
+    retriever = retriever_from_env(cluster)
+
+    # chat messages and ratings are written in batches by a background task, flushed on cleanup
+    chat_writer = AsyncChatWriter(cluster)
+
+    # chat histories, the semantic answer cache, retrieval and persistence, see chat_pipeline.py
+    pipeline = AsyncChatPipeline(cluster, retriever, chat_writer)
+
+
+async def drain_persistence(app):
+    if pending_persistence:
+        print(f"Waiting for {len(pending_persistence)} pending chat writes..")
+        await asyncio.gather(*pending_persistence, return_exceptions=True)
+
+    if chat_writer is not None:
+        await chat_writer.close()
+
+
+app.on_startup.append(setup_couchbase)
+app.on_cleanup.append(drain_persistence)
+
+
+async def refresh_answer_cache():
+    while True:
+        await pipeline.refresh_answer_cache()
+        await asyncio.sleep(SEMANTIC_CACHE_REFRESH_SECONDS)
+
+
+async def start_answer_cache_refresh(app):
+    if SEMANTIC_CACHE:
+        app["answer_cache_refresh"] = asyncio.create_task(refresh_answer_cache())
+
+
+async def stop_answer_cache_refresh(app):
+    if "answer_cache_refresh" in app:
+        app["answer_cache_refresh"].cancel()
+
+
+app.on_startup.append(start_answer_cache_refresh)
+app.on_cleanup.append(stop_answer_cache_refresh)
+
+
+async def index(request):
+    return web.FileResponse('./templates/index.html')
+
+
+# the chat session of every connection on this worker, by socket sid
+connection_sessions = {}
+
+
+# a client reconnecting with the token it was given resumes its session, anyone else starts a new one
+@sio.on('connect')
+async def handle_connect(sid, environ, auth=None):
+    session_id = session_from_token((auth or {}).get('session_token'))
+    if session_id is None:
+        session_id, token = issue_session_token()
+        await sio.emit('session', token, to=sid)
+    connection_sessions[sid] = session_id
+
+
+@sio.on('disconnect')
+async def handle_disconnect(sid):
+    connection_sessions.pop(sid, None)
+
+
+@sio.on('rating')
+async def handle_rating(sid, rating_data):
+    bot_message_id = rating_data['bot_message_id']
+    score= rating_data['score']
+
+    await chat_writer.submit_rating(bot_message_id, score)
+
+
+@sio.on('message')
+async def handle_message(sid, msg_to_process):
+    session_id = connection_sessions.get(sid, sid)
+    trace = start_trace("message", session_id=session_id)
+
+    try:
+        persist = await pipeline.answer(msg_to_process, session_id, trace, lambda events: emit_events(sid, events))
+
+        task = asyncio.create_task(persist_messages(sid, persist))
+        pending_persistence.add(task)
+        task.add_done_callback(pending_persistence.discard)
+    finally:
+        trace.finish()
+
+
+async def emit_events(sid, events):
+    for event, payload in events:
+        await sio.emit(event, payload, to=sid)
+
+
+@timed_stage("persist")
+async def persist_messages(sid, persist):
+    bot_message_id = await persist()
+    if bot_message_id is not None:
+        await sio.emit('bot_message_creation', bot_message_id, to=sid)
+
+
+async def split_string(request):
+    data = await request.json()
+    string = data.get('string', '')
+
+    openai_embedding = await acreate_openai_embeddings(string, BACKGROUND)
+    return web.json_response(encode_vector(openai_embedding))
+
+
+# batch variant of /create_embedding: {"strings": [...]} returns the embeddings in the same order
+async def create_embeddings(request):
+    data = await request.json()
+    strings = data.get('strings', [])
+
+    openai_embeddings = await acreate_openai_embeddings_batch(strings)
+    return web.json_response([encode_vector(embedding) for embedding in openai_embeddings])
+
+
+# chunks of {"string": ...} and their embeddings, {"chunks": [{"text": ..., "embedding": [...]}, ...]}
+async def create_chunk_embeddings(request):
+    data = await request.json()
+    chunks = chunk_text(data.get('string', ''))
+
+    openai_embeddings = await acreate_openai_embeddings_batch(chunks)
+    return web.json_response({"chunks": [dict(text=text, embedding=encode_vector(embedding)) for text, embedding in zip(chunks, openai_embeddings)]})
+
+
+# prometheus text format: stage durations, couchbase operation latencies, openai tokens and cache hit rates
+async def metrics(request):
+    return web.Response(text=render_metrics(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+
+async def model_metrics(request):
+    return web.json_response(get_model_metrics())
+
+
+async def scheduler_metrics(request):
+    return web.json_response(get_scheduler_metrics())
+
+
+async def rewrite_metrics(request):
+    return web.json_response(get_rewrite_metrics())
+
+
+async def tagging_metrics(request):
+    return web.json_response(get_tagging_metrics())
+
+
+# the enrichment steps are blocking, run them in the default executor to keep the event loop free
+async def data_reformatting(request):
+    data = await request.json()
+
+    processed_data = await asyncio.get_running_loop().run_in_executor(None, data_reformat, data)
+
+    return web.json_response(processed_data)
+
+
+async def metadata_tag(request):
+    data = await request.json()
+
+    type = await asyncio.get_running_loop().run_in_executor(None, tag_metadata, data)
+
+    return web.json_response(type)
+
+
+# batch variants of the enrichment endpoints, see app.py
+async def data_reformatting_batch(request):
+    data = await request.json()
+
+    results = await asyncio.get_running_loop().run_in_executor(None, process_documents, data_reformat, data.get('documents', []))
+
+    return web.json_response(dict(results=results))
+
+
+async def metadata_tag_batch(request):
+    data = await request.json()
+
+    results = await asyncio.get_running_loop().run_in_executor(None, process_documents, label_metadata, data.get('documents', []))
+
+    return web.json_response(dict(results=results))
+
+
+app.router.add_get('/', index)
+app.router.add_static('/static', './static')
+app.router.add_post('/create_embedding', split_string)
+app.router.add_post('/create_embeddings', create_embeddings)
+app.router.add_post('/create_chunk_embeddings', create_chunk_embeddings)
+app.router.add_get('/metrics', metrics)
+app.router.add_get('/model_metrics', model_metrics)
+app.router.add_get('/scheduler_metrics', scheduler_metrics)
+app.router.add_get('/rewrite_metrics', rewrite_metrics)
+app.router.add_get('/tagging_metrics', tagging_metrics)
+app.router.add_post('/data_reformatting', data_reformatting)
+app.router.add_post('/metadata_tag', metadata_tag)
+app.router.add_post('/data_reformatting_batch', data_reformatting_batch)
+app.router.add_post('/metadata_tag_batch', metadata_tag_batch)
+
+
+def run_worker(host, port, reuse_port):
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port)
+
+
+# each worker is a separate process with its own event loop, Couchbase cluster and OpenAI clients, all
+# listening on the same port with SO_REUSEPORT so the kernel spreads the connections across them. the
+# page connects with the websocket transport only, so a connection never moves between workers
+def serve(host, port, workers):
+    if workers <= 1:
+        run_worker(host, port, False)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(host, port, True), name=f"worker-{index}") for index in range(workers)]
+
+    for process in processes:
+        process.start()
+    print(f"Started {workers} workers on port {port}")
+
+    # stopping this process stops the workers, each of them flushes its chat writes on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    serve('0.0.0.0', args.port, args.workers)
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_openai import ChatOpenAI
+from chain_registry import ChainRegistry, PROMPTS_DIR
+
+
+# per message cost of building the answer and rewrite chains, like every message did before the chain
+# registry, against looking them up in the registry. "build" only constructs the runnables; "invoke" also
+# runs them against a local fake chat model, to show the share of the per message work that was removed.
+# no network calls are made
+parser = argparse.ArgumentParser(description="micro-benchmark of the chain registry")
+parser.add_argument('--iterations', type=int, default=2000)
+parser.add_argument('--model', default='gpt-4o')
+args = parser.parse_args()
+
+
+# the registry keys chains by model_name, like ChatOpenAI has
+class FakeChatModel(FakeListChatModel):
+    model_name: str = "fake"
+
+
+def read_prompt(filename):
+    with open(os.path.join(PROMPTS_DIR, filename), "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def rewrite_prompt(text):
+    return ChatPromptTemplate.from_messages([MessagesPlaceholder(variable_name="messages"), ("user", text)])
+
+
+def per_message_chains(llm):
+    answer_chain = create_stuff_documents_chain(llm, ChatPromptTemplate.from_template(answer_text))
+    rewrite_chain = rewrite_prompt(rewrite_text) | llm
+    return answer_chain, rewrite_chain
+
+
+def cached_chains(llm):
+    return chains.chain("answer", llm), chains.chain("query_transform", llm)
+
+
+def measure(get_chains, llm, invoke):
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        answer_chain, rewrite_chain = get_chains(llm)
+        if invoke:
+            rewrite_chain.invoke(rewrite_inputs)
+            answer_chain.invoke(answer_inputs)
+    return (time.perf_counter() - start) / args.iterations * 1e6
+
+
+answer_text = read_prompt("answer.txt")
+rewrite_text = read_prompt("query_transform.txt")
+
+chains = ChainRegistry()
+chains.register("answer", "answer.txt", ChatPromptTemplate.from_template, create_stuff_documents_chain)
+chains.register("query_transform", "query_transform.txt", rewrite_prompt)
+
+rewrite_inputs = {"messages": [HumanMessage(content="Is my dog eligible if she is 9 years old?")]}
+answer_inputs = {"input": "Is my dog eligible if she is 9 years old?", "context": [Document(page_content="Dogs up to 10 years old are covered. " * 20)]}
+
+openai_llm = ChatOpenAI(model=args.model, api_key="benchmark", max_retries=0)
+fake_llm = FakeChatModel(responses=["pet insurance age limit"], model_name=args.model)
+
+if __name__ == '__main__':
+    results = [
+        ("build, ChatOpenAI", measure(per_message_chains, openai_llm, False), measure(cached_chains, openai_llm, False)),
+        ("build and invoke, fake model", measure(per_message_chains, fake_llm, True), measure(cached_chains, fake_llm, True)),
+    ]
+
+    print(f"{args.iterations} messages each, microseconds per message")
+    for name, before, after in results:
+        print(f"  {name}: per message {before:.1f}, registry {after:.1f}, saved {before - after:.1f} ({(before - after) / before:.0%})")
@@ -0,0 +1,219 @@
+from couchbase.exceptions import DocumentNotFoundException
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_index import assemble_for_embedding, document_key, read_documents
+
+
+# in-process stand-ins for the couchbase and acouchbase clusters, enough of them for the chat pipeline:
+# KV get/upsert/mutate_in on any collection and scope.search returning the first rows of the corpus.
+# every operation waits for its configured latency and records its service time
+KV_LATENCY = float(os.getenv("BENCH_KV_LATENCY", 0.002))
+SEARCH_LATENCY = float(os.getenv("BENCH_SEARCH_LATENCY", 0.02))
+CORPUS_PATH = os.getenv("BENCH_CORPUS_PATH", "./templates/assets/raw-data.json")
+
+stats = {}
+stats_lock = threading.Lock()
+
+
+def record(operation, seconds):
+    with stats_lock:
+        stats.setdefault(operation, []).append(seconds)
+
+
+def reset_stats():
+    with stats_lock:
+        stats.clear()
+
+
+def load_rows():
+    rows = []
+    for document in read_documents(CORPUS_PATH):
+        key = document_key(document, None)
+        if key is not None:
+            rows.append((key, {"assembled_for_embedding": assemble_for_embedding(document), "source": document.get("source"), "from": document.get("from")}))
+    return rows
+
+
+class FakeResult:
+
+    def __init__(self, content):
+        self.content = content
+
+    @property
+    def content_as(self):
+        return {dict: self.content}
+
+
+class FakeMultiResult:
+
+    all_ok = True
+    exceptions = {}
+
+
+class FakeRow:
+
+    def __init__(self, id, fields):
+        self.id = id
+        self.fields = fields
+
+
+class FakeSearchResult:
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def rows(self):
+        return iter(self._rows)
+
+
+# acouchbase returns the result at once and the rows are awaited, so the latency is spent in rows()
+class FakeAsyncSearchResult(FakeSearchResult):
+
+    async def rows(self):
+        start = time.time()
+        await asyncio.sleep(SEARCH_LATENCY)
+        record("search", time.time() - start)
+        for row in self._rows:
+            yield row
+
+
+# documents are shared by every collection handle of a cluster
+class FakeCollection:
+
+    def __init__(self, store, lock, name):
+        self.store = store
+        self.lock = lock
+        self.name = name
+
+    def get(self, key, *options):
+        start = time.time()
+        time.sleep(KV_LATENCY)
+        with self.lock:
+            content = self.store.get((self.name, key))
+        record("kv_get", time.time() - start)
+
+        if content is None:
+            raise DocumentNotFoundException()
+        return FakeResult(content)
+
+    def upsert(self, key, document, *options):
+        start = time.time()
+        time.sleep(KV_LATENCY)
+        with self.lock:
+            self.store[(self.name, key)] = document
+        record("kv_upsert", time.time() - start)
+
+    def mutate_in(self, key, specs, *options):
+        start = time.time()
+        time.sleep(KV_LATENCY)
+        record("kv_mutate_in", time.time() - start)
+
+    # one round trip for the whole batch, like the SDK's multi operations
+    def upsert_multi(self, documents, *options):
+        start = time.time()
+        time.sleep(KV_LATENCY)
+        with self.lock:
+            for key, document in documents.items():
+                self.store[(self.name, key)] = document
+        record("kv_upsert_multi", time.time() - start)
+        return FakeMultiResult()
+
+
+class FakeAsyncCollection(FakeCollection):
+
+    async def get(self, key, *options):
+        start = time.time()
+        await asyncio.sleep(KV_LATENCY)
+        with self.lock:
+            content = self.store.get((self.name, key))
+        record("kv_get", time.time() - start)
+
+        if content is None:
+            raise DocumentNotFoundException()
+        return FakeResult(content)
+
+    async def upsert(self, key, document, *options):
+        start = time.time()
+        await asyncio.sleep(KV_LATENCY)
+        with self.lock:
+            self.store[(self.name, key)] = document
+        record("kv_upsert", time.time() - start)
+
+    async def mutate_in(self, key, specs, *options):
+        start = time.time()
+        await asyncio.sleep(KV_LATENCY)
+        record("kv_mutate_in", time.time() - start)
+
+
+class FakeScope:
+
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+
+    def collection(self, name):
+        return self.cluster.collection_type(self.cluster.store, self.cluster.lock, f"{self.name}.{name}")
+
+    # the corpus isn't embedded, so vector and text requests both get the first rows up to the limit
+    def search(self, index_name, request, options=None):
+        start = time.time()
+        limit = (options or {}).get("limit") or 10
+        time.sleep(SEARCH_LATENCY)
+        record("search", time.time() - start)
+        return FakeSearchResult([FakeRow(id, fields) for id, fields in self.cluster.rows[:limit]])
+
+
+class FakeAsyncScope(FakeScope):
+
+    def search(self, index_name, request, options=None):
+        limit = (options or {}).get("limit") or 10
+        return FakeAsyncSearchResult([FakeRow(id, fields) for id, fields in self.cluster.rows[:limit]])
+
+
+class FakeBucket:
+
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+
+    def scope(self, name):
+        return self.cluster.scope_type(self.cluster, name)
+
+    async def on_connect(self):
+        pass
+
+
+class FakeCluster:
+
+    collection_type = FakeCollection
+    scope_type = FakeScope
+
+    def __init__(self, connection_string=None, *options):
+        self.store = {}
+        self.lock = threading.Lock()
+        self.rows = load_rows()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def wait_until_ready(self, timeout, *options):
+        pass
+
+
+class FakeAsyncCluster(FakeCluster):
+
+    collection_type = FakeAsyncCollection
+    scope_type = FakeAsyncScope
+
+    @classmethod
+    async def connect(cls, connection_string=None, *options):
+        return cls(connection_string)
+
+    async def wait_until_ready(self, timeout, *options):
+        pass
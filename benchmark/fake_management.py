@@ -0,0 +1,221 @@
+from aiohttp import web
+import argparse
+import asyncio
+import re
+import time
+
+
+# stand-in for the couchbase server REST APIs provisioning.py drives, to run setupbucket.py and
+# setupothers.py locally: buckets, scopes and collections (management port), CREATE INDEX and
+# system:indexes (query), search index definitions, deletes, counts and stats (search) and eventing functions and
+# their status (eventing), on --base-port +0, +2, +3 and +5 like 8091, 8093, 8094 and 8096. buckets warm up
+# for --warmup seconds and refuse scopes meanwhile, indexes build for --index-build and functions deploy in
+# --deploy. creating anything twice is a 400 "already exists". every request waits --latency and is
+# counted, GET /stats has the counts. point the setup at it with EE_HOSTNAME, EVENTING_HOSTNAME and
+# SEARCH_HOSTNAME=127.0.0.1 and CB_MANAGEMENT_PORT, CB_QUERY_PORT, CB_SEARCH_PORT, CB_EVENTING_PORT
+parser = argparse.ArgumentParser()
+parser.add_argument('--base-port', type=int, default=18091)
+parser.add_argument('--latency', type=float, default=0.05, help='seconds every request takes')
+parser.add_argument('--warmup', type=float, default=2, help='seconds before a new bucket is healthy')
+parser.add_argument('--index-build', type=float, default=3, help='seconds before a new index is online')
+parser.add_argument('--deploy', type=float, default=2, help='seconds before a new function is deployed')
+args = parser.parse_args()
+
+buckets = {}
+functions = {}
+query_indexes = {}
+search_indexes = {}
+stats = {}
+
+
+def ready_at(seconds):
+    return time.time() + seconds
+
+
+def already_exists(what):
+    return web.json_response({"errors": {"name": f"{what} already exists"}}, status=400)
+
+
+@web.middleware
+async def simulate(request, handler):
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+    key = f"{request.method} {route}"
+    stats[key] = stats.get(key, 0) + 1
+    await asyncio.sleep(args.latency)
+    return await handler(request)
+
+
+async def create_bucket(request):
+    form = await request.post()
+    name = form.get("name")
+    if name in buckets:
+        return already_exists(f"bucket {name}")
+    buckets[name] = dict(ram_quota=int(form.get("ramQuota", 0)), ready=ready_at(args.warmup), scopes={"_default": ["_default"]})
+    return web.json_response({}, status=202)
+
+
+def get_bucket(request):
+    bucket = buckets.get(request.match_info["bucket"])
+    if bucket is None:
+        raise web.HTTPNotFound(text="Requested resource not found.")
+    return bucket
+
+
+async def bucket_details(request):
+    bucket = get_bucket(request)
+    status = "healthy" if time.time() >= bucket["ready"] else "warmup"
+    return web.json_response({"name": request.match_info["bucket"], "quota": {"ram": bucket["ram_quota"] * 1024 * 1024}, "nodes": [{"status": status}]})
+
+
+async def list_scopes(request):
+    bucket = get_bucket(request)
+    return web.json_response({"scopes": [{"name": scope, "collections": [{"name": collection} for collection in collections]}
+                                         for scope, collections in bucket["scopes"].items()]})
+
+
+async def create_scope(request):
+    bucket = get_bucket(request)
+    if time.time() < bucket["ready"]:
+        return web.json_response({"errors": {"_": "bucket is warming up"}}, status=503)
+    name = (await request.post()).get("name")
+    if name in bucket["scopes"]:
+        return already_exists(f"scope {name}")
+    bucket["scopes"][name] = []
+    return web.json_response({"uid": "1"})
+
+
+async def create_collection(request):
+    bucket = get_bucket(request)
+    collections = bucket["scopes"].get(request.match_info["scope"])
+    if collections is None:
+        raise web.HTTPNotFound(text="Scope not found")
+    name = (await request.post()).get("name")
+    if name in collections:
+        return already_exists(f"collection {name}")
+    collections.append(name)
+    return web.json_response({"uid": "1"})
+
+
+async def query_service(request):
+    statement = (await request.post()).get("statement", "")
+
+    create = re.match(r"CREATE INDEX (IF NOT EXISTS )?(\w+) ON `?(\w+)`?\.`?(\w+)`?\.`?(\w+)`?", statement, re.IGNORECASE)
+    if create:
+        name, keyspace = create.group(2), create.group(3, 4, 5)
+        if keyspace[0] not in buckets or keyspace[2] not in buckets[keyspace[0]]["scopes"].get(keyspace[1], []):
+            return web.json_response({"status": "fatal", "errors": [{"code": 12003, "msg": "Keyspace not found"}]}, status=500)
+        if (name, keyspace) in query_indexes and not create.group(1):
+            return web.json_response({"status": "fatal", "errors": [{"code": 4300, "msg": f"The index {name} already exists."}]}, status=409)
+        query_indexes.setdefault((name, keyspace), ready_at(args.index_build))
+        return web.json_response({"status": "success", "results": []})
+
+    select = re.search(r'system:indexes WHERE name = "(\w+)" AND bucket_id = "(\w+)" AND scope_id = "(\w+)" AND keyspace_id = "(\w+)"', statement)
+    if select:
+        ready = query_indexes.get((select.group(1), select.group(2, 3, 4)))
+        results = [] if ready is None else ["online" if time.time() >= ready else "building"]
+        return web.json_response({"status": "success", "results": results})
+
+    return web.json_response({"status": "fatal", "errors": [{"code": 3000, "msg": "syntax error"}]}, status=400)
+
+
+async def get_search_index(request):
+    index = search_indexes.get(request.match_info["index"])
+    if index is None:
+        return web.json_response({"status": "fail", "error": "index not found"}, status=400)
+    return web.json_response({"status": "ok", "indexDef": index["definition"]})
+
+
+async def put_search_index(request):
+    name = request.match_info["index"]
+    definition = await request.json()
+    if name in search_indexes and definition.get("uuid") != search_indexes[name]["definition"].get("uuid"):
+        return web.json_response({"status": "fail", "error": f"index {name} already exists"}, status=400)
+    search_indexes[name] = dict(definition=dict(definition, uuid=f"{len(search_indexes) + 1:016x}"), ready=ready_at(args.index_build))
+    return web.json_response({"status": "ok"})
+
+
+async def delete_search_index(request):
+    if search_indexes.pop(request.match_info["index"], None) is None:
+        return web.json_response({"status": "fail", "error": "index not found"}, status=400)
+    return web.json_response({"status": "ok"})
+
+
+async def search_index_count(request):
+    index = search_indexes.get(request.match_info["index"])
+    if index is None or time.time() < index["ready"]:
+        return web.json_response({"status": "fail", "error": "index not ready"}, status=400)
+    return web.json_response({"status": "ok", "count": 0})
+
+
+# the ingest progress of an index, by its full bucket.scope.index name
+async def search_index_stats(request):
+    index = search_indexes.get(request.match_info["name"].split(".")[-1])
+    if index is None:
+        return web.json_response({"status": "fail", "error": "index not found"}, status=400)
+    built = time.time() >= index["ready"]
+    return web.json_response({"num_pindexes_target": 6, "num_pindexes_actual": 6 if built else 2,
+                              "num_mutations_to_index": 0 if built else 1000, "doc_count": 0})
+
+
+async def get_function(request):
+    function = functions.get(request.match_info["name"])
+    if function is None:
+        return web.json_response({"name": "ERR_APP_NOT_FOUND_TS", "code": 27}, status=404)
+    return web.json_response(function["definition"])
+
+
+async def create_function(request):
+    name = request.match_info["name"]
+    if name in functions:
+        return web.json_response({"name": "ERR_APP_ALREADY_DEPLOYED", "code": 20, "description": f"Function {name} already exists"}, status=400)
+    definition = await request.json()
+    definition = definition[0] if isinstance(definition, list) else definition
+    functions[name] = dict(definition=definition, ready=ready_at(args.deploy))
+    return web.json_response({"code": 0, "info": {"status": "Stored function"}})
+
+
+async def function_status(request):
+    return web.json_response({"apps": [{"name": name, "composite_status": "deployed" if time.time() >= function["ready"] else "deploying"}
+                                       for name, function in functions.items()]})
+
+
+async def get_stats(request):
+    return web.json_response(stats)
+
+
+async def reset(request):
+    for state in (buckets, functions, query_indexes, search_indexes, stats):
+        state.clear()
+    return web.json_response({})
+
+
+app = web.Application(middlewares=[simulate])
+app.router.add_post('/pools/default/buckets', create_bucket)
+app.router.add_get('/pools/default/buckets/{bucket}', bucket_details)
+app.router.add_get('/pools/default/buckets/{bucket}/scopes', list_scopes)
+app.router.add_post('/pools/default/buckets/{bucket}/scopes', create_scope)
+app.router.add_post('/pools/default/buckets/{bucket}/scopes/{scope}/collections', create_collection)
+app.router.add_post('/query/service', query_service)
+app.router.add_get('/api/bucket/{bucket}/scope/{scope}/index/{index}', get_search_index)
+app.router.add_put('/api/bucket/{bucket}/scope/{scope}/index/{index}', put_search_index)
+app.router.add_delete('/api/bucket/{bucket}/scope/{scope}/index/{index}', delete_search_index)
+app.router.add_get('/api/bucket/{bucket}/scope/{scope}/index/{index}/count', search_index_count)
+app.router.add_get('/api/stats/index/{name}', search_index_stats)
+app.router.add_get('/api/v1/functions/{name}', get_function)
+app.router.add_post('/api/v1/functions/{name}', create_function)
+app.router.add_get('/api/v1/status', function_status)
+app.router.add_get('/stats', get_stats)
+app.router.add_post('/reset', reset)
+
+
+async def serve():
+    runner = web.AppRunner(app)
+    await runner.setup()
+    for offset in (0, 2, 3, 5):
+        await web.TCPSite(runner, '127.0.0.1', args.base_port + offset).start()
+    print(f"management API on 127.0.0.1:{args.base_port}, {args.base_port + 2}, {args.base_port + 3}, {args.base_port + 5}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve())
@@ -0,0 +1,115 @@
+from aiohttp import web
+import argparse
+import asyncio
+import hashlib
+import json
+import numpy as np
+import time
+
+
+# stand-in for the OpenAI API used by llm.py, data_processor and the embeddings endpoints. chat completions
+# answer after --first-token-delay and stream --answer-tokens tokens at --tokens-per-second, embeddings
+# are deterministic unit vectors derived from the text, after --embedding-delay
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=8900)
+parser.add_argument('--first-token-delay', type=float, default=0.3, help='seconds before the first token of a completion')
+parser.add_argument('--tokens-per-second', type=float, default=50)
+parser.add_argument('--answer-tokens', type=int, default=60)
+parser.add_argument('--embedding-delay', type=float, default=0.05)
+parser.add_argument('--dimensions', type=int, default=1536)
+args = parser.parse_args()
+
+# service time of every call, by pipeline stage
+stats = {}
+
+
+def record(stage, seconds):
+    stats.setdefault(stage, []).append(seconds)
+
+
+def fake_embedding(text):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=args.dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def completion_chunk(content=None, role=None, finish_reason=None):
+    delta = {}
+    if role:
+        delta["role"] = role
+    if content is not None:
+        delta["content"] = content
+
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "bench",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def chat_completions(request):
+    start = time.time()
+    body = await request.json()
+    await asyncio.sleep(args.first_token_delay)
+
+    if not body.get("stream"):
+        # the query rewrite: echo the last user message back as the search query
+        content = next((message["content"] for message in reversed(body["messages"]) if message["role"] == "user"), "")
+        record("rewrite", time.time() - start)
+        return web.json_response({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "bench",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(f"data: {json.dumps(completion_chunk(role='assistant', content=''))}\n\n".encode())
+
+    for index in range(args.answer_tokens):
+        await response.write(f"data: {json.dumps(completion_chunk(content=f'token{index} '))}\n\n".encode())
+        await asyncio.sleep(1 / args.tokens_per_second)
+
+    await response.write(f"data: {json.dumps(completion_chunk(finish_reason='stop'))}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    record("generate", time.time() - start)
+    return response
+
+
+async def embeddings(request):
+    start = time.time()
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    await asyncio.sleep(args.embedding_delay)
+
+    record("embed", time.time() - start)
+    return web.json_response({
+        "object": "list",
+        "model": body.get("model", "bench"),
+        "data": [{"object": "embedding", "index": index, "embedding": fake_embedding(str(text))} for index, text in enumerate(inputs)],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    })
+
+
+async def get_stats(request):
+    return web.json_response(stats)
+
+
+async def reset_stats(request):
+    stats.clear()
+    return web.json_response({})
+
+
+app = web.Application()
+app.router.add_post('/v1/chat/completions', chat_completions)
+app.router.add_post('/v1/embeddings', embeddings)
+app.router.add_get('/stats', get_stats)
+app.router.add_post('/stats/reset', reset_stats)
+
+if __name__ == '__main__':
+    web.run_app(app, host='127.0.0.1', port=args.port, print=None)
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+
+
+# a Redis-compatible pub/sub server, just enough for the socket.io message queue (SOCKETIO_MESSAGE_QUEUE)
+# when running several workers locally or in tests: PING, PUBLISH, SUBSCRIBE and UNSUBSCRIBE over RESP2.
+# CLIENT and SELECT are acknowledged, anything else is an error
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=6379)
+args = parser.parse_args()
+
+subscribers = {}
+
+
+def encode(value):
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+
+    if not line.startswith(b"*"):
+        return line.strip().split()
+
+    command = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+async def handle(reader, writer):
+    channels = set()
+
+    try:
+        while True:
+            command = await read_command(reader)
+            if command is None:
+                break
+            if not command:
+                continue
+
+            name = command[0].upper()
+
+            if name == b"PING":
+                writer.write(b"+PONG\r\n")
+
+            elif name in (b"CLIENT", b"SELECT"):
+                writer.write(b"+OK\r\n")
+
+            elif name == b"PUBLISH":
+                receivers = subscribers.get(command[1], set())
+                for receiver in receivers:
+                    receiver.write(encode([b"message", command[1], command[2]]))
+                writer.write(encode(len(receivers)))
+
+            elif name == b"SUBSCRIBE":
+                for channel in command[1:]:
+                    channels.add(channel)
+                    subscribers.setdefault(channel, set()).add(writer)
+                    writer.write(encode([b"subscribe", channel, len(channels)]))
+
+            elif name == b"UNSUBSCRIBE":
+                for channel in command[1:] or list(channels):
+                    channels.discard(channel)
+                    subscribers.get(channel, set()).discard(writer)
+                    writer.write(encode([b"unsubscribe", channel, len(channels)]))
+
+            else:
+                writer.write(b"-ERR unknown command '%s'\r\n" % name)
+
+            await writer.drain()
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+
+    finally:
+        for channel in channels:
+            subscribers.get(channel, set()).discard(writer)
+        writer.close()
+
+
+async def main():
+    server = await asyncio.start_server(handle, '127.0.0.1', args.port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,180 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_index import assemble_for_embedding, document_key, read_documents
+from reranker import (Reranker, words, encoding, RERANK_CANDIDATES, RERANK_VECTOR_WEIGHT, RERANK_DUPLICATE_THRESHOLD,
+                      RERANK_DOCUMENT_MAX_TOKENS)
+from retriever import Retriever
+
+
+# the rerank and compression stage against plain top-k retrieval, on a fixed question set over
+# raw-data.json plus benchmark/rerank_corpus.json (near-duplicate products, emails with unrelated
+# paragraphs). for every question both contexts are built from the same ranked candidates; reported are
+# the prompt tokens, the time the stage takes, and as a proxy for answer quality the share of the
+# expected facts that made it into the context and whether a relevant document did. candidates are ranked by tf-idf
+# cosine unless --openai embeds with the real embedding model; --generate also streams both answers
+# from the chat model to measure generation time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK = os.path.join(ROOT, "benchmark")
+
+
+def load_corpus(paths):
+    ids, texts, documents = [], [], []
+    for path in paths:
+        for document in read_documents(path):
+            text = assemble_for_embedding(document)
+            ids.append(document_key(document, None))
+            texts.append(text)
+            documents.append({"assembled_for_embedding": text, "source": document.get("source"), "from": document.get("from")})
+    return ids, texts, documents
+
+
+def tfidf_vectors(texts, queries):
+    vocabulary = {}
+    for text in texts:
+        for word in words(text):
+            vocabulary.setdefault(word, len(vocabulary))
+
+    def counts(text):
+        vector = np.zeros(len(vocabulary))
+        for word in words(text):
+            if word in vocabulary:
+                vector[vocabulary[word]] += 1
+        return vector
+
+    matrix = np.array([counts(text) for text in texts])
+    idf = np.log((1 + len(texts)) / (1 + (matrix > 0).sum(axis=0))) + 1
+
+    def normalise(vectors):
+        vectors = vectors * idf
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    return normalise(matrix), normalise(np.array([counts(query) for query in queries]))
+
+
+def openai_vectors(texts, queries):
+    from llm import create_openai_embeddings_batch
+    return np.array(create_openai_embeddings_batch(texts)), np.array(create_openai_embeddings_batch(queries))
+
+
+def prompt_tokens(question, context):
+    with open(os.path.join(ROOT, "prompts", "answer.txt"), "r", encoding="utf-8") as file:
+        return len(encoding.encode(file.read().format(input=question, context=context)))
+
+
+# relevant lists interchangeable copies of the same answer, one of them in the context is a hit
+def quality(question, ids, context):
+    facts = [fact for fact in question["facts"] if fact.lower() in context.lower()]
+    return len(facts) / len(question["facts"]), float(any(id in ids for id in question["relevant"]))
+
+
+def generate(question, context):
+    from llm import stream_answer
+
+    start = time.time()
+    first_token = None
+    answer = ""
+    for _, chunk in stream_answer(question, context):
+        first_token = first_token or time.time()
+        answer += chunk
+    return (first_token or time.time()) - start, time.time() - start, answer
+
+
+# the candidates are ranked here, the retriever only reranks and builds the context from them
+class RankedRetriever(Retriever):
+    def retrieve(self, rows, query_text, collections=None):
+        return self.finish(rows, query_text)
+
+
+def run(args):
+    paths = [os.path.join(ROOT, "templates", "assets", "raw-data.json"), os.path.join(BENCHMARK, "rerank_corpus.json")]
+    ids, texts, documents = load_corpus(paths)
+
+    with open(os.path.join(BENCHMARK, "rerank_questions.json"), "r") as file:
+        questions = json.load(file)
+
+    vectors, query_vectors = (openai_vectors if args.openai else tfidf_vectors)(texts, [question["question"] for question in questions])
+
+    baseline = RankedRetriever(k=args.k, context_max_tokens=args.context_max_tokens)
+    reranked = RankedRetriever(k=args.candidates, context_max_tokens=args.context_max_tokens,
+                                 reranker=Reranker(keep=args.k, vector_weight=args.vector_weight, duplicate_threshold=args.duplicate_threshold,
+                                                   document_max_tokens=args.document_max_tokens))
+
+    results = []
+    for question, query_vector in zip(questions, query_vectors):
+        ranked = np.argsort(-(vectors @ query_vector), kind="stable")
+        rows = [(ids[index], dict(documents[index])) for index in ranked[:args.candidates]]
+        result = {"question": question["question"]}
+
+        for name, retriever, candidates in (("baseline", baseline, rows[:args.k]), ("rerank", reranked, rows)):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                document_ids, context, _ = retriever.retrieve(candidates, question["question"])
+            seconds = (time.perf_counter() - start) / args.repeat
+
+            fact_recall, document_hit = quality(question, document_ids, context)
+            result[name] = {
+                "document_ids": document_ids,
+                "prompt_tokens": prompt_tokens(question["question"], context),
+                "stage_ms": round(seconds * 1000, 3),
+                "fact_recall": fact_recall,
+                "document_hit": document_hit,
+            }
+
+            if args.generate:
+                first_token, total, answer = generate(question["question"], context)
+                result[name].update(first_token_seconds=round(first_token, 3), generation_seconds=round(total, 3), answer=answer)
+
+        results.append(result)
+    return results
+
+
+def summarise(results, generated):
+    keys = ["prompt_tokens", "stage_ms", "fact_recall", "document_hit"] + (["first_token_seconds", "generation_seconds"] if generated else [])
+    summary = {name: {key: round(float(np.mean([result[name][key] for result in results])), 3) for key in keys} for name in ("baseline", "rerank")}
+    summary["prompt_token_reduction"] = round(1 - summary["rerank"]["prompt_tokens"] / summary["baseline"]["prompt_tokens"], 3)
+    summary["fact_recall_change"] = round(summary["rerank"]["fact_recall"] - summary["baseline"]["fact_recall"], 3)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rerank and context compression against plain top-k retrieval")
+    parser.add_argument('--k', type=int, default=5, help='documents in the context, RETRIEVER_K')
+    parser.add_argument('--candidates', type=int, default=RERANK_CANDIDATES, help='documents fetched for the reranker, RERANK_CANDIDATES')
+    parser.add_argument('--vector-weight', type=float, default=RERANK_VECTOR_WEIGHT, help='RERANK_VECTOR_WEIGHT')
+    parser.add_argument('--duplicate-threshold', type=float, default=RERANK_DUPLICATE_THRESHOLD, help='RERANK_DUPLICATE_THRESHOLD')
+    parser.add_argument('--document-max-tokens', type=int, default=RERANK_DOCUMENT_MAX_TOKENS, help='RERANK_DOCUMENT_MAX_TOKENS')
+    parser.add_argument('--context-max-tokens', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=20, help='timing repetitions of the stage per question')
+    parser.add_argument('--openai', action='store_true', default=False, help='rank candidates with OpenAI embeddings instead of tf-idf')
+    parser.add_argument('--generate', action='store_true', default=False, help='also stream both answers from the chat model')
+    parser.add_argument('--output', default=None, help='write the per question results as json')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    for result in results:
+        print(result["question"])
+        for name in ("baseline", "rerank"):
+            row = result[name]
+            print(f"  {name:8} {row['prompt_tokens']:5} tokens, {row['stage_ms']:7.3f} ms, facts {row['fact_recall']:.0%}, "
+                  f"documents {row['document_hit']:.0%}, {', '.join(row['document_ids'])}")
+
+    summary = summarise(results, args.generate)
+    print(json.dumps(summary, indent=2))
+    if summary["fact_recall_change"] < 0:
+        print(f"rerank loses {-summary['fact_recall_change']:.0%} fact recall, raise --document-max-tokens or keep RERANK off")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"config": vars(args), "summary": summary, "results": results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import json
+import numpy as np
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import socketio
+
+
+# end-to-end latency of the chat pipeline without network dependencies: starts fake_openai.py and the
+# app (through server.py, with the couchbase stand-in), then drives it with concurrent socket clients at
+# each concurrency level, optionally for several app_async worker counts. per stage p50/p95/p99 and
+# messages per second are written as json, so two commits can be compared with --compare
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK = os.path.join(ROOT, "benchmark")
+
+QUESTIONS = [
+    "What promotions are available for pet insurance?",
+    "Is my dog eligible if she is 9 years old?",
+    "What does the travel insurance cover?",
+    "Are there any exclusions I should know about?",
+    "How do I make a claim?",
+    "What is the waiting period?",
+]
+
+PERCENTILES = [50, 95, 99]
+
+
+def summarise(values):
+    if not values:
+        return {"count": 0}
+
+    milliseconds = np.array(values) * 1000
+    summary = {"count": len(values), "mean_ms": round(float(milliseconds.mean()), 3)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(float(np.percentile(milliseconds, percentile)), 3)
+    return summary
+
+
+def http_json(url, method="GET"):
+    request = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as connection:
+            if connection.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.2)
+    raise TimeoutError(f"nothing listening on port {port} after {timeout} seconds")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# one conversation: messages are sent one after another in the same session, like a user would
+async def run_client(url, messages, timings, timeout):
+    client = socketio.AsyncClient()
+    state = {}
+
+    def on_sources(data):
+        state.setdefault("sources", time.time())
+
+    def on_token(data):
+        state.setdefault("first_token", time.time())
+
+    def on_done(data):
+        state["done"] = time.time()
+        state["finished"].set()
+
+    client.on("sources", on_sources)
+    client.on("token", on_token)
+    client.on("done", on_done)
+
+    await client.connect(url, transports=["websocket"])
+
+    try:
+        for index in range(messages):
+            state.clear()
+            state["finished"] = asyncio.Event()
+            sent = time.time()
+
+            await client.emit("message", {
+                "query": QUESTIONS[index % len(QUESTIONS)],
+                "deviceType": "benchmark",
+                "browserType": "benchmark",
+                "delta": True,
+            })
+
+            try:
+                await asyncio.wait_for(state["finished"].wait(), timeout)
+            except asyncio.TimeoutError:
+                timings["errors"] += 1
+                continue
+
+            timings["sources"].append(state["sources"] - sent)
+            timings["first_token"].append(state.get("first_token", state["done"]) - sent)
+            timings["generation"].append(state["done"] - state.get("first_token", state["done"]))
+            timings["total"].append(state["done"] - sent)
+    finally:
+        await client.disconnect()
+
+
+async def run_level(url, concurrency, messages, timeout):
+    timings = {"sources": [], "first_token": [], "generation": [], "total": [], "errors": 0}
+
+    start = time.time()
+    await asyncio.gather(*[run_client(url, messages, timings, timeout) for _ in range(concurrency)])
+    elapsed = time.time() - start
+
+    return timings, elapsed
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+
+    before_levels = {(level.get("workers", 1), level["concurrency"]): level for level in baseline["levels"]}
+
+    print(f"\nCompared with {baseline.get('commit')}:")
+    for level in results["levels"]:
+        before = before_levels.get((level["workers"], level["concurrency"]))
+        if before is None:
+            continue
+        print(f"  {level['workers']} workers, concurrency {level['concurrency']}: "
+              f"total p95 {before['client']['total'].get('p95_ms')} -> {level['client']['total'].get('p95_ms')} ms, "
+              f"{before['messages_per_second']} -> {level['messages_per_second']} messages/s")
+
+
+# messages per second of every worker count against the single worker run, at the same concurrency
+def print_scaling(levels):
+    single = {level["concurrency"]: level["messages_per_second"] for level in levels if level["workers"] == 1}
+
+    print("\nScaling:")
+    for level in levels:
+        baseline = single.get(level["concurrency"])
+        if level["workers"] == 1 or not baseline:
+            continue
+        print(f"  {level['workers']} workers, concurrency {level['concurrency']}: {level['messages_per_second']} messages/s, "
+              f"{level['messages_per_second'] / baseline:.2f}x one worker ({level['messages_per_second'] / (baseline * level['workers']):.0%} of linear)")
+
+
+def start_process(script, arguments, environment):
+    return subprocess.Popen([sys.executable, os.path.join(BENCHMARK, script)] + [str(argument) for argument in arguments], cwd=ROOT, env=environment)
+
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def measure(args, app_url, openai_url, workers):
+    levels = []
+
+    for concurrency in args.concurrency:
+        http_json(f"{openai_url}/stats/reset", "POST")
+        http_json(f"{app_url}/benchmark/couchbase_stats/reset", "POST")
+
+        timings, elapsed = asyncio.run(run_level(app_url, concurrency, args.messages_per_client, args.timeout))
+        completed = len(timings["total"])
+
+        stages = {stage: summarise(values) for stage, values in http_json(f"{openai_url}/stats").items()}
+        # the couchbase stand-in lives in the workers, with several of them its stats are partial
+        if workers == 1:
+            stages.update({operation: summarise(values) for operation, values in http_json(f"{app_url}/benchmark/couchbase_stats").items()})
+
+        level = {
+            "workers": workers,
+            "concurrency": concurrency,
+            "messages": completed,
+            "errors": timings["errors"],
+            "elapsed_seconds": round(elapsed, 3),
+            "messages_per_second": round(completed / elapsed, 3) if elapsed else 0,
+            "client": {stage: summarise(timings[stage]) for stage in ("sources", "first_token", "generation", "total")},
+            "stages": stages,
+        }
+        levels.append(level)
+
+        print(f"{workers} workers, concurrency {concurrency}: {completed} messages, {timings['errors']} errors, {level['messages_per_second']} messages/s, "
+              f"first token p95 {level['client']['first_token'].get('p95_ms')} ms, total p95 {level['client']['total'].get('p95_ms')} ms")
+
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end latency benchmark of the chat pipeline")
+    parser.add_argument('--app', choices=['app', 'app_async'], default='app')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1], help='app_async worker counts to measure, for a scaling test')
+    parser.add_argument('--message-queue', action='store_true', default=False, help='connect the workers through fake_redis.py')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--messages-per-client', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for one answer')
+    parser.add_argument('--app-port', type=int, default=5050)
+    parser.add_argument('--openai-port', type=int, default=8900)
+    parser.add_argument('--redis-port', type=int, default=6390)
+    parser.add_argument('--first-token-delay', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=60)
+    parser.add_argument('--embedding-delay', type=float, default=0.05)
+    parser.add_argument('--kv-latency', type=float, default=0.002)
+    parser.add_argument('--search-latency', type=float, default=0.02)
+    parser.add_argument('--output', default=None, help='defaults to benchmark/results/<commit>-<app>.json')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if args.app == 'app' and args.workers != [1]:
+        parser.error("several workers need --app app_async")
+
+    environment = dict(
+        os.environ,
+        OPENAI_API_KEY="benchmark",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{args.openai_port}/v1",
+        OPENAI_API_BASE=f"http://127.0.0.1:{args.openai_port}/v1",
+        BENCH_KV_LATENCY=str(args.kv_latency),
+        BENCH_SEARCH_LATENCY=str(args.search_latency),
+        RETRIEVER_BACKEND="couchbase",
+    )
+
+    services = [start_process("fake_openai.py", [
+        "--port", args.openai_port,
+        "--first-token-delay", args.first_token_delay,
+        "--tokens-per-second", args.tokens_per_second,
+        "--answer-tokens", args.answer_tokens,
+        "--embedding-delay", args.embedding_delay,
+    ], environment)]
+
+    if args.message_queue:
+        services.append(start_process("fake_redis.py", ["--port", args.redis_port], environment))
+        environment["SOCKETIO_MESSAGE_QUEUE"] = f"redis://127.0.0.1:{args.redis_port}/0"
+
+    openai_url = f"http://127.0.0.1:{args.openai_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+
+    results = {
+        "commit": git_commit(),
+        "app": args.app,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "levels": [],
+    }
+
+    try:
+        wait_for_port(args.openai_port)
+
+        for workers in args.workers:
+            server = start_process("server.py", ["--app", args.app, "--port", args.app_port, "--workers", workers], environment)
+            try:
+                wait_for_port(args.app_port)
+                results["levels"].extend(measure(args, app_url, openai_url, workers))
+            finally:
+                stop_processes([server])
+
+    finally:
+        stop_processes(services)
+
+    output = args.output or os.path.join(BENCHMARK, "results", f"{results['commit']}-{args.app}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    if len(args.workers) > 1:
+        print_scaling(results["levels"])
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_couchbase
+
+
+# runs app.py or app_async.py unchanged, except that the couchbase cluster is the in-process stand-in.
+# OPENAI_BASE_URL / OPENAI_API_BASE are expected to point at fake_openai.py. the stand-in's KV and search
+# service times are served on /benchmark/couchbase_stats for run.py. app_async.py can run with several
+# workers sharing the port
+parser = argparse.ArgumentParser()
+parser.add_argument('--app', choices=['app', 'app_async'], default='app')
+parser.add_argument('--port', type=int, default=5000)
+parser.add_argument('--workers', type=int, default=1, help='app_async worker processes')
+args = parser.parse_args()
+
+# the apps parse their own arguments at import. spawned workers re-run this module with the same
+# arguments, so they're restored afterwards
+server_argv = sys.argv
+sys.argv = [sys.argv[0]]
+
+if args.app == 'app':
+    import couchbase.cluster
+    couchbase.cluster.Cluster = fake_couchbase.FakeCluster
+
+    from flask import jsonify
+    import app as chat_app
+
+    @chat_app.app.route('/benchmark/couchbase_stats', methods=['GET'])
+    def couchbase_stats():
+        return jsonify(fake_couchbase.stats)
+
+    @chat_app.app.route('/benchmark/couchbase_stats/reset', methods=['POST'])
+    def reset_couchbase_stats():
+        fake_couchbase.reset_stats()
+        return jsonify({})
+
+else:
+    import acouchbase.cluster
+    acouchbase.cluster.Cluster = fake_couchbase.FakeAsyncCluster
+
+    from aiohttp import web
+    import app_async as chat_app
+
+    async def couchbase_stats(request):
+        return web.json_response(fake_couchbase.stats)
+
+    async def reset_couchbase_stats(request):
+        fake_couchbase.reset_stats()
+        return web.json_response({})
+
+    chat_app.app.router.add_get('/benchmark/couchbase_stats', couchbase_stats)
+    chat_app.app.router.add_post('/benchmark/couchbase_stats/reset', reset_couchbase_stats)
+
+sys.argv = server_argv
+
+if __name__ == '__main__':
+    if args.app == 'app':
+        chat_app.socketio.run(chat_app.app, host='127.0.0.1', port=args.port, allow_unsafe_werkzeug=True)
+    else:
+        # with several workers the couchbase stats are those of whichever worker answers
+        chat_app.serve('127.0.0.1', args.port, args.workers)
@@ -0,0 +1,129 @@
+from metrics import registry
+from dotenv import load_dotenv
+import hashlib
+import os
+import threading
+import time
+
+load_dotenv()
+
+
+# prompt templates live in PROMPTS_DIR, one file per prompt, so they can be edited without a restart. a
+# prompt's version is the hash of its file; a changed file is picked up at most PROMPT_RELOAD_SECONDS later
+# (0 turns the check off). runnables are built once per prompt, model and version and reused by every
+# message, chains of older versions are dropped when a prompt changes
+PROMPTS_DIR = os.getenv("PROMPTS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts"))
+PROMPT_RELOAD_SECONDS = float(os.getenv("PROMPT_RELOAD_SECONDS", 5))
+
+chain_builds = registry.counter("chatbot_chain_builds_total", "Runnables built by the chain registry, by prompt", ["prompt"])
+prompt_reloads = registry.counter("chatbot_prompt_reloads_total", "Prompt templates reloaded after their file changed", ["prompt"])
+
+
+def prompt_version(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def pipe(prompt, llm):
+    return prompt | llm
+
+
+class ChainRegistry:
+
+    def __init__(self, directory=PROMPTS_DIR, reload_seconds=PROMPT_RELOAD_SECONDS):
+        self.directory = directory
+        self.reload_seconds = reload_seconds
+        # name -> (file name, make_prompt(text), make_chain(prompt, llm))
+        self.definitions = {}
+        # name -> (version, file mtime, prompt)
+        self.prompts = {}
+        # (name, model, version) -> runnable
+        self.chains = {}
+        self.checked = time.time()
+        self.lock = threading.Lock()
+
+    def register(self, name, filename, make_prompt, make_chain=pipe):
+        with self.lock:
+            self.definitions[name] = (filename, make_prompt, make_chain)
+            self.prompts[name] = self.load(name)
+
+    def load(self, name):
+        filename, make_prompt, _ = self.definitions[name]
+        path = os.path.join(self.directory, filename)
+
+        with open(path, "r", encoding="utf-8") as file:
+            text = file.read()
+        return prompt_version(text), os.path.getmtime(path), make_prompt(text)
+
+    # rereads the prompt files that changed since they were loaded, returns the names of those whose text changed
+    def reload(self):
+        changed = []
+
+        with self.lock:
+            self.checked = time.time()
+
+            for name, (filename, _, _) in self.definitions.items():
+                version, mtime, _ = self.prompts[name]
+                try:
+                    if os.path.getmtime(os.path.join(self.directory, filename)) == mtime:
+                        continue
+                    loaded = self.load(name)
+                except (OSError, ValueError) as e:
+                    # a half written or broken template keeps the current one until the next check
+                    print(f"Could not reload prompt {name}: {e}")
+                    continue
+
+                self.prompts[name] = loaded
+                if loaded[0] != version:
+                    self.chains = {key: chain for key, chain in self.chains.items() if key[0] != name}
+                    prompt_reloads.inc(prompt=name)
+                    changed.append(name)
+                    print(f"Reloaded prompt {name}, version {loaded[0]}")
+
+        return changed
+
+    def maybe_reload(self):
+        if self.reload_seconds and time.time() - self.checked >= self.reload_seconds:
+            self.reload()
+
+    def version(self, name):
+        self.maybe_reload()
+        return self.prompts[name][0]
+
+    def prompt(self, name):
+        self.maybe_reload()
+        return self.prompts[name][2]
+
+    # the runnable of a prompt for a chat model (anything with a model_name), built on first use
+    def chain(self, name, llm):
+        self.maybe_reload()
+        version, _, prompt = self.prompts[name]
+        key = (name, llm.model_name, version)
+
+        chain = self.chains.get(key)
+        if chain is None:
+            with self.lock:
+                chain = self.chains.get(key)
+                if chain is None:
+                    chain = self.definitions[name][2](prompt, llm)
+                    self.chains[key] = chain
+                    chain_builds.inc(prompt=name)
+        return chain
+
+    # builds the chains up front, so the first messages don't pay for it
+    def warm(self, name, llms):
+        for llm in llms:
+            self.chain(name, llm)
+
+    def versions(self):
+        return {name: version for name, (version, _, _) in self.prompts.items()}
+
+
+chains = ChainRegistry()
+
+
+def collect_prompt_metrics():
+    yield ("chatbot_prompt_info", "gauge", "Prompt versions in use",
+           [({"prompt": name, "version": version}, 1) for name, version in chains.versions().items()])
+
+
+registry.register_collector(collect_prompt_metrics)
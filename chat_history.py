@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from langchain.memory import ChatMessageHistory
+from langchain_core.messages import messages_from_dict, messages_to_dict
+from metrics import registry, get_logger
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+import tiktoken
+import time
+
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+logger = get_logger("chat_history")
+sessions_evicted = registry.counter("chatbot_chat_sessions_evicted_total", "In-memory chat sessions evicted, by reason (capacity or idle)", ["reason"])
+
+
+def count_tokens(message):
+    return len(encoding.encode(message.content))
+
+
+# a client resumes its chat session across reconnects with the token it got in the "session" event: a
+# random session id and its HMAC under CHAT_SESSION_SECRET, so only ids this server issued are accepted,
+# and they are all 32 url-safe characters before becoming main.chats.sessions keys. workers sharing
+# sessions need the same CHAT_SESSION_SECRET, without one each process signs with its own random secret
+CHAT_SESSION_SECRET = (os.getenv("CHAT_SESSION_SECRET") or secrets.token_hex(32)).encode("utf-8")
+
+session_token_pattern = re.compile(r"[A-Za-z0-9_-]{32}\.[A-Za-z0-9_-]{43}")
+
+
+def session_signature(session_id):
+    digest = hmac.new(CHAT_SESSION_SECRET, session_id.encode("ascii"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+# a new session id and the token to resume it with
+def issue_session_token():
+    session_id = secrets.token_urlsafe(24)
+    return session_id, f"{session_id}.{session_signature(session_id)}"
+
+
+# the session id of a token issued by issue_session_token, None for anything else
+def session_from_token(token):
+    if not isinstance(token, str) or session_token_pattern.fullmatch(token) is None:
+        return None
+
+    session_id, signature = token.split(".")
+    return session_id if hmac.compare_digest(signature, session_signature(session_id)) else None
+
+
+# chat histories keyed by session id (issued on connect, see issue_session_token).
+# each session keeps at most max_messages messages, the prompt window is trimmed to max_tokens,
+# and sessions idle for longer than ttl_seconds or beyond max_sessions (least recently used first) are evicted
+class SessionChatHistoryStore:
+
+    def __init__(self, max_sessions=1000, ttl_seconds=1800, max_messages=20, max_tokens=2000):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def has_session(self, session_id):
+        with self.lock:
+            return session_id in self.sessions
+
+    def get_history(self, session_id):
+        with self.lock:
+            now = time.time()
+
+            if session_id in self.sessions:
+                history, _ = self.sessions.pop(session_id)
+            else:
+                history = ChatMessageHistory()
+
+            self.sessions[session_id] = (history, now)
+            self.evict(now)
+            return history
+
+    # replace=True takes the stored messages over the ones held here, when another worker may have
+    # answered in this session since
+    def resume(self, session_id, message_dicts, replace=False):
+        history = self.get_history(session_id)
+        if replace:
+            history.clear()
+        if not history.messages:
+            for message in messages_from_dict(message_dicts):
+                history.add_message(message)
+            self.trim(history)
+
+    def add_user_message(self, session_id, message):
+        history = self.get_history(session_id)
+        history.add_user_message(message)
+        self.trim(history)
+
+    def add_ai_message(self, session_id, message):
+        history = self.get_history(session_id)
+        history.add_ai_message(message)
+        self.trim(history)
+
+    # the most recent messages that fit in the token budget, the latest message is always kept
+    def window(self, session_id):
+        messages = self.get_history(session_id).messages
+        selected = []
+        tokens = 0
+
+        for message in reversed(messages):
+            tokens += count_tokens(message)
+            if selected and tokens > self.max_tokens:
+                break
+            selected.append(message)
+
+        return list(reversed(selected))
+
+    def to_dict(self, session_id):
+        return messages_to_dict(self.get_history(session_id).messages)
+
+    def trim(self, history):
+        if len(history.messages) > self.max_messages:
+            history.messages = history.messages[-self.max_messages:]
+
+    def evict(self, now):
+        while self.sessions:
+            session_id, (_, last_access) = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_sessions or now - last_access > self.ttl_seconds:
+                self.sessions.pop(session_id)
+                sessions_evicted.inc(reason="capacity" if len(self.sessions) >= self.max_sessions else "idle")
+                logger.debug("Evicted chat session %s", session_id)
+            else:
+                break
@@ -0,0 +1,285 @@
+from setupcouchbase import (generate_uuid, load_chat_session, save_chat_session, get_cached_answer, insert_cached_answer, scan_cached_answers,
+                            aload_chat_session, asave_chat_session, aget_cached_answer, ainsert_cached_answer, ascan_cached_answers)
+from chat_history import SessionChatHistoryStore
+from semantic_cache import SemanticAnswerCache, generate_cache_key
+from streaming import MessageStream
+from llm import create_openai_embeddings, acreate_openai_embeddings, transform_query_and_retrieve, atransform_query_and_retrieve, stream_answer, astream_answer, record_answer_tokens
+from model_router import router
+from metrics import annotate, span, record_stage, record_cache
+from dotenv import load_dotenv
+import functools
+import os
+import time
+
+load_dotenv()
+
+
+# what app.py and app_async.py answer a chat message with, apart from the socket and HTTP handling: the
+# session history, the semantic answer cache, retrieval, streaming and persistence. ChatPipeline works with
+# the couchbase cluster of app.py, AsyncChatPipeline with the acouchbase cluster of app_async.py. answer()
+# takes the function that emits the stream's events and returns the persistence to run in the background,
+# which returns the bot message id to announce with bot_message_creation, None for delta clients
+
+# persist every session to main.chats.sessions so another worker, or this one after a restart, can resume it
+CHAT_HISTORY_WRITE_THROUGH = os.getenv("CHAT_HISTORY_WRITE_THROUGH", "false").lower() == "true"
+
+# for workers without sticky sessions: every message reloads its session from main.chats.sessions and
+# saves it before the handler returns, so the next message can be answered by any worker
+CHAT_HISTORY_SHARED = os.getenv("CHAT_HISTORY_SHARED", "false").lower() == "true"
+CHAT_HISTORY_WRITE_THROUGH = CHAT_HISTORY_WRITE_THROUGH or CHAT_HISTORY_SHARED
+
+# the shortest interval between two streamed events of the same message
+TOKEN_COALESCE_SECONDS = float(os.getenv("TOKEN_COALESCE_SECONDS", 0.05))
+
+# answer previously seen questions from main.cache.answers instead of searching and generating again
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+
+# answers cached before a restart or by other workers are indexed from main.cache.answers at startup and
+# then every SEMANTIC_CACHE_REFRESH_SECONDS. a refresh scans the answers cached since the previous one
+# started, less SEMANTIC_CACHE_REFRESH_OVERLAP_SECONDS for clock differences between the workers
+SEMANTIC_CACHE_REFRESH_SECONDS = float(os.getenv("SEMANTIC_CACHE_REFRESH_SECONDS", 30))
+SEMANTIC_CACHE_REFRESH_OVERLAP_SECONDS = float(os.getenv("SEMANTIC_CACHE_REFRESH_OVERLAP_SECONDS", 60))
+
+
+class ChatPipelineBase:
+
+    def __init__(self, cluster, retriever, chat_writer):
+        self.cluster = cluster
+        self.retriever = retriever
+        self.chat_writer = chat_writer
+
+        self.chat_histories = SessionChatHistoryStore(
+            max_sessions=int(os.getenv("CHAT_HISTORY_MAX_SESSIONS", 1000)),
+            ttl_seconds=int(os.getenv("CHAT_SESSION_TTL_SECONDS", 1800)),
+            max_messages=int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", 20)),
+            max_tokens=int(os.getenv("CHAT_HISTORY_MAX_TOKENS", 2000)),
+        )
+
+        self.answer_cache = SemanticAnswerCache(
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000)),
+            ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 86400)),
+        )
+        self.refreshed_at = None
+
+    # the session is resumed from couchbase if this worker hasn't seen it, or always when sessions are shared
+    def needs_stored_session(self, session_id):
+        return CHAT_HISTORY_SHARED or (CHAT_HISTORY_WRITE_THROUGH and not self.chat_histories.has_session(session_id))
+
+    def resume_session(self, session_id, stored_messages):
+        if stored_messages is not None:
+            self.chat_histories.resume(session_id, stored_messages, replace=CHAT_HISTORY_SHARED)
+
+    def new_stream(self, msg_to_process, retrieval):
+        return MessageStream(int(time.time()), retrieval["product_ids"], retrieval["documents"], msg_to_process.get('delta', False), TOKEN_COALESCE_SECONDS)
+
+    def record_answer(self, model, new_query, retrieval, message_string):
+        if retrieval["cached_answer"] is None:
+            record_answer_tokens(model, new_query, retrieval["additional_context"], message_string)
+            annotate(model=model)
+        annotate(cached=retrieval["cached_answer"] is not None, document_ids=retrieval["product_ids"])
+
+    def cacheable(self, retrieval, message_string):
+        return SEMANTIC_CACHE and retrieval["cached_answer"] is None and message_string
+
+    # the indexed key of a semantically identical question for the same model, if there is one
+    def lookup_cached(self, vector, model):
+        return self.answer_cache.lookup(vector, model) if SEMANTIC_CACHE else None
+
+    def cached_retrieval(self, vector, cache_key, cached):
+        record_cache("semantic", cached is not None)
+        if cached is not None:
+            return dict(vector=vector, product_ids=cached["document_ids"], additional_context="", documents=cached["documents"], cached_answer=cached["answer"])
+
+        # expired or invalidated since it was indexed here
+        if cache_key is not None:
+            self.answer_cache.remove(cache_key)
+        return None
+
+    # where the next refresh starts scanning from, None for all of main.cache.answers
+    def refresh_since(self):
+        since = None if self.refreshed_at is None else self.refreshed_at - SEMANTIC_CACHE_REFRESH_OVERLAP_SECONDS
+        self.refreshed_at = time.time()
+        return since
+
+    def index_cached_answers(self, entries):
+        for key, vector, model, expires_at in entries:
+            self.answer_cache.add(key, vector, model, expires_at)
+
+
+# for the couchbase cluster of app.py
+class ChatPipeline(ChatPipelineBase):
+
+    def answer(self, msg_to_process, session_id, trace, emit_events):
+        query = msg_to_process['query']
+
+        #0. add user message to this session's history, resuming it from couchbase if this worker hasn't seen it
+        if self.needs_stored_session(session_id):
+            self.resume_session(session_id, load_chat_session(self.cluster, session_id))
+
+        self.chat_histories.add_user_message(session_id, query)
+
+        # the client may pick one of CHAT_MODELS with "model", cached answers are only reused for the same model
+        model = router.resolve(msg_to_process.get('model'))
+
+        #1. incorporating the chat history together with the new questions to generate an independent prompt when
+        # the question needs it, then retrieving the documents for it
+        new_query, retrieval = transform_query_and_retrieve(self.chat_histories.window(session_id), lambda new_query: self.retrieve(new_query, model))
+
+        #5. streaming, or sending the cached answer in one go
+        stream = self.new_stream(msg_to_process, retrieval)
+        emit_events(stream.start())
+
+        if retrieval["cached_answer"] is not None:
+            emit_events(stream.add(retrieval["cached_answer"]))
+
+        else:
+            # the router falls back to another model if needed
+            with span("generate"):
+                for model, chunk in stream_answer(new_query, retrieval["additional_context"], msg_to_process.get('model')):
+                    if not stream.message_string:
+                        record_stage("first_token", trace.elapsed())
+                    emit_events(stream.add(chunk))
+
+        bot_message_id = str(generate_uuid())
+        message_string = stream.message_string
+
+        # the chat messages are queued before done hands bot_message_id to the client, so a rating is always
+        # written after the message it rates
+        user_message_uuid = self.chat_writer.submit_user_message(query, new_query, msg_to_process['deviceType'], msg_to_process['browserType'])
+        self.chat_writer.submit_bot_message(message_string, user_message_uuid, retrieval["product_ids"], bot_message_id)
+        emit_events(stream.finish(bot_message_id))
+
+        self.record_answer(model, new_query, retrieval, message_string)
+        trace.finish()
+
+        #6. add bot message to the session, the couchbase writes are left to the caller's background task
+        self.chat_histories.add_ai_message(session_id, message_string)
+        if CHAT_HISTORY_SHARED:
+            save_chat_session(self.cluster, session_id, self.chat_histories.to_dict(session_id))
+
+        return functools.partial(self.persist, session_id, new_query, message_string, retrieval, bot_message_id, stream.delta, model)
+
+    def persist(self, session_id, new_query, message_string, retrieval, bot_message_id, delta, model):
+        if self.cacheable(retrieval, message_string):
+            cache_key = generate_cache_key()
+            if insert_cached_answer(self.cluster, cache_key, new_query, message_string, retrieval["product_ids"], retrieval["documents"], retrieval["vector"], model):
+                self.answer_cache.add(cache_key, retrieval["vector"], model)
+
+        if CHAT_HISTORY_WRITE_THROUGH and not CHAT_HISTORY_SHARED:
+            save_chat_session(self.cluster, session_id, self.chat_histories.to_dict(session_id))
+
+        # delta clients already got the id with the done event
+        return None if delta else bot_message_id
+
+    def retrieve(self, query, model=None):
+        #2. turn it into an embedding
+        vector = create_openai_embeddings(query)
+
+        #2.1 look for an answer to a semantically identical question
+        if SEMANTIC_CACHE:
+            with span("semantic_cache"):
+                cache_key = self.lookup_cached(vector, model)
+                cached = get_cached_answer(self.cluster, cache_key) if cache_key is not None else None
+
+            retrieval = self.cached_retrieval(vector, cache_key, cached)
+            if retrieval is not None:
+                return retrieval
+
+        #3. using Couchbase SDK, and 4. building the context from the results
+        with span("search"):
+            product_ids, additional_context, documents = self.retriever.retrieve(vector, query)
+
+        return dict(vector=vector, product_ids=product_ids, additional_context=additional_context, documents=documents, cached_answer=None)
+
+    def refresh_answer_cache(self):
+        self.index_cached_answers(scan_cached_answers(self.cluster, self.answer_cache, self.refresh_since()))
+
+
+# for the acouchbase cluster of app_async.py
+class AsyncChatPipeline(ChatPipelineBase):
+
+    async def answer(self, msg_to_process, session_id, trace, emit_events):
+        query = msg_to_process['query']
+
+        #0. add user message to this session's history, resuming it from couchbase if this worker hasn't seen it
+        if self.needs_stored_session(session_id):
+            self.resume_session(session_id, await aload_chat_session(self.cluster, session_id))
+
+        self.chat_histories.add_user_message(session_id, query)
+
+        # the client may pick one of CHAT_MODELS with "model", cached answers are only reused for the same model
+        model = router.resolve(msg_to_process.get('model'))
+
+        #1. incorporating the chat history together with the new questions to generate an independent prompt when
+        # the question needs it, then retrieving the documents for it
+        new_query, retrieval = await atransform_query_and_retrieve(self.chat_histories.window(session_id), lambda new_query: self.retrieve(new_query, model))
+
+        #5. streaming, or sending the cached answer in one go
+        stream = self.new_stream(msg_to_process, retrieval)
+        await emit_events(stream.start())
+
+        if retrieval["cached_answer"] is not None:
+            await emit_events(stream.add(retrieval["cached_answer"]))
+
+        else:
+            # the router falls back to another model if needed
+            with span("generate"):
+                async for model, chunk in astream_answer(new_query, retrieval["additional_context"], msg_to_process.get('model')):
+                    if not stream.message_string:
+                        record_stage("first_token", trace.elapsed())
+                    await emit_events(stream.add(chunk))
+
+        bot_message_id = str(generate_uuid())
+        message_string = stream.message_string
+
+        # the chat messages are queued before done hands bot_message_id to the client, so a rating is always
+        # written after the message it rates
+        user_message_uuid = await self.chat_writer.submit_user_message(query, new_query, msg_to_process['deviceType'], msg_to_process['browserType'])
+        await self.chat_writer.submit_bot_message(message_string, user_message_uuid, retrieval["product_ids"], bot_message_id)
+        await emit_events(stream.finish(bot_message_id))
+
+        self.record_answer(model, new_query, retrieval, message_string)
+        trace.finish()
+
+        #6. add bot message to the session, the couchbase writes are left to the caller's background task
+        self.chat_histories.add_ai_message(session_id, message_string)
+        if CHAT_HISTORY_SHARED:
+            await asave_chat_session(self.cluster, session_id, self.chat_histories.to_dict(session_id))
+
+        return functools.partial(self.persist, session_id, new_query, message_string, retrieval, bot_message_id, stream.delta, model)
+
+    async def persist(self, session_id, new_query, message_string, retrieval, bot_message_id, delta, model):
+        if self.cacheable(retrieval, message_string):
+            cache_key = generate_cache_key()
+            if await ainsert_cached_answer(self.cluster, cache_key, new_query, message_string, retrieval["product_ids"], retrieval["documents"], retrieval["vector"], model):
+                self.answer_cache.add(cache_key, retrieval["vector"], model)
+
+        if CHAT_HISTORY_WRITE_THROUGH and not CHAT_HISTORY_SHARED:
+            await asave_chat_session(self.cluster, session_id, self.chat_histories.to_dict(session_id))
+
+        # delta clients already got the id with the done event
+        return None if delta else bot_message_id
+
+    async def retrieve(self, query, model=None):
+        #2. turn it into an embedding
+        vector = await acreate_openai_embeddings(query)
+
+        #2.1 look for an answer to a semantically identical question
+        if SEMANTIC_CACHE:
+            with span("semantic_cache"):
+                cache_key = self.lookup_cached(vector, model)
+                cached = await aget_cached_answer(self.cluster, cache_key) if cache_key is not None else None
+
+            retrieval = self.cached_retrieval(vector, cache_key, cached)
+            if retrieval is not None:
+                return retrieval
+
+        #3. using Couchbase SDK, and 4. building the context from the results
+        with span("search"):
+            product_ids, additional_context, documents = await self.retriever.aretrieve(vector, query)
+
+        return dict(vector=vector, product_ids=product_ids, additional_context=additional_context, documents=documents, cached_answer=None)
+
+    async def refresh_answer_cache(self):
+        self.index_cached_answers(await ascan_cached_answers(self.cluster, self.answer_cache, self.refresh_since()))
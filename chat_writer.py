@@ -0,0 +1,398 @@
+from setupcouchbase import generate_uuid, get_collection, user_message_document, bot_message_document
+from metrics import registry, get_logger
+from dotenv import load_dotenv
+from couchbase.exceptions import DocumentNotFoundException
+import couchbase.subdocument as SD
+import asyncio
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+
+load_dotenv()
+
+
+# chat messages and ratings are queued and written by one background worker. message ids are generated
+# when they're submitted, so callers get them back at once. upserts are batched per collection, failed
+# keys are retried with exponential backoff, and close() writes everything still queued. a rating of a bot
+# message that isn't written yet is put back and retried in a later batch, with the same backoff, instead
+# of holding up the worker. once closed there's no worker left: writes are done by the caller and such a
+# rating is retried in place
+CHAT_WRITER_QUEUE_SIZE = int(os.getenv("CHAT_WRITER_QUEUE_SIZE", 10000))
+CHAT_WRITER_BATCH_SIZE = int(os.getenv("CHAT_WRITER_BATCH_SIZE", 100))
+CHAT_WRITER_FLUSH_SECONDS = float(os.getenv("CHAT_WRITER_FLUSH_SECONDS", 0.05))
+CHAT_WRITER_MAX_RETRIES = int(os.getenv("CHAT_WRITER_MAX_RETRIES", 5))
+CHAT_WRITER_BACKOFF_SECONDS = float(os.getenv("CHAT_WRITER_BACKOFF_SECONDS", 0.1))
+
+# how long a submit waits for room in a full queue before the write is done by the caller instead
+CHAT_WRITER_ENQUEUE_TIMEOUT = float(os.getenv("CHAT_WRITER_ENQUEUE_TIMEOUT", 1))
+
+writes = registry.counter("chatbot_chat_writes_total", "Chat documents written, by result (ok, retried or failed)", ["result"])
+enqueue_wait_seconds = registry.histogram("chatbot_chat_writer_enqueue_wait_seconds", "Time a submit waited for room in the chat write queue")
+batch_sizes = registry.histogram("chatbot_chat_writer_batch_size", "Writes per chat writer batch", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+writers = []
+
+logger = get_logger("chat_writer")
+
+
+def collect_writer_metrics():
+    yield ("chatbot_chat_writer_queue_depth", "gauge", "Chat writes waiting in the queue",
+           [({"writer": str(index)}, writer.queue_depth()) for index, writer in enumerate(writers)])
+
+
+registry.register_collector(collect_writer_metrics)
+
+
+class ChatWriterBase:
+
+    def __init__(self, cluster, batch_size=CHAT_WRITER_BATCH_SIZE, flush_seconds=CHAT_WRITER_FLUSH_SECONDS,
+                 max_retries=CHAT_WRITER_MAX_RETRIES, backoff_seconds=CHAT_WRITER_BACKOFF_SECONDS):
+        self.human = get_collection(cluster, "chats", "human")
+        self.bot = get_collection(cluster, "chats", "bot")
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.deferred = []
+        self.deferred_attempts = {}
+        self.deferred_lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.closed = False
+        writers.append(self)
+
+    def user_message(self, query, transformed_query, deviceType, browserType):
+        uuid_to_insert = str(generate_uuid())
+        return uuid_to_insert, ("upsert", self.human, uuid_to_insert, user_message_document(query, transformed_query, deviceType, browserType))
+
+    def bot_message(self, message, user_msg_id, product_ids, uuid_to_insert=None):
+        uuid_to_insert = uuid_to_insert or str(generate_uuid())
+        return uuid_to_insert, ("upsert", self.bot, uuid_to_insert, bot_message_document(message, user_msg_id, product_ids))
+
+    def rating(self, bot_msg_id, rating):
+        return ("rating", self.bot, bot_msg_id, rating)
+
+    # upserts grouped by collection, in submission order, then the ratings, which may refer to a bot
+    # message in the same batch
+    def group(self, batch):
+        upserts = {}
+        ratings = []
+
+        for kind, collection, key, value in batch:
+            if kind == "upsert":
+                upserts.setdefault(collection, {})[key] = value
+            else:
+                ratings.append((collection, key, value))
+
+        return upserts, ratings
+
+    def record_failure(self, key, error):
+        writes.inc(result="failed")
+        logger.error("Giving up writing chat document %s: %s", key, error)
+
+    def rating_written(self, key):
+        with self.deferred_lock:
+            retried = self.deferred_attempts.pop(key, None) is not None
+        writes.inc(result="retried" if retried else "ok")
+
+    # the rated bot message isn't there yet: the rating goes back for a later batch
+    def defer_rating(self, collection, key, rating, error):
+        with self.deferred_lock:
+            attempt = self.deferred_attempts.get(key, 0)
+            if attempt < self.max_retries:
+                self.deferred_attempts[key] = attempt + 1
+                ready_at = time.time() + self.backoff_seconds * 2 ** attempt
+                heapq.heappush(self.deferred, (ready_at, next(self.sequence), ("rating", collection, key, rating)))
+                return
+            self.deferred_attempts.pop(key, None)
+        self.record_failure(key, error)
+
+    # the deferred writes that are due, or all of them
+    def due_deferred(self, everything=False):
+        with self.deferred_lock:
+            due = []
+            while self.deferred and (everything or self.deferred[0][0] <= time.time()):
+                due.append(heapq.heappop(self.deferred)[2])
+            return due
+
+    # how long the worker may wait for new writes before a deferred one is due, None without any
+    def deferred_wait(self):
+        with self.deferred_lock:
+            return max(0.0, self.deferred[0][0] - time.time()) if self.deferred else None
+
+    def abandon_deferred(self):
+        for _, _, key, _ in self.due_deferred(everything=True):
+            self.record_failure(key, "the rated bot message was never written")
+
+    # writes a submit queued while close() was stopping the worker
+    def leftovers(self):
+        batch = []
+        while True:
+            try:
+                write = self.queue.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                return batch
+            if write is not None:
+                batch.append(write)
+
+
+# for the couchbase cluster of app.py, batches go out with upsert_multi
+class ChatWriter(ChatWriterBase):
+
+    def __init__(self, cluster, max_queue=CHAT_WRITER_QUEUE_SIZE, **kwargs):
+        super().__init__(cluster, **kwargs)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.worker = threading.Thread(target=self.run, name="chat-writer", daemon=True)
+        self.worker.start()
+
+    def submit_user_message(self, query, transformed_query, deviceType, browserType):
+        uuid_to_insert, write = self.user_message(query, transformed_query, deviceType, browserType)
+        self.submit(write)
+        return uuid_to_insert
+
+    def submit_bot_message(self, message, user_msg_id, product_ids, uuid_to_insert=None):
+        uuid_to_insert, write = self.bot_message(message, user_msg_id, product_ids, uuid_to_insert)
+        self.submit(write)
+        return uuid_to_insert
+
+    def submit_rating(self, bot_msg_id, rating):
+        self.submit(self.rating(bot_msg_id, rating))
+
+    def submit(self, write):
+        start = time.time()
+
+        try:
+            if self.closed:
+                raise queue.Full
+            self.queue.put(write, timeout=CHAT_WRITER_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            # back-pressure: the caller pays for the write rather than dropping it
+            self.write_batch([write])
+        finally:
+            enqueue_wait_seconds.observe(time.time() - start)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        while True:
+            batch = self.due_deferred()
+            stop = False
+
+            if not batch:
+                try:
+                    write = self.queue.get(timeout=self.deferred_wait())
+                except queue.Empty:
+                    continue
+                if write is None:
+                    stop = True
+                else:
+                    batch = [write]
+
+            deadline = time.time() + self.flush_seconds
+
+            while batch and not stop and len(batch) < self.batch_size:
+                try:
+                    write = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if write is None:
+                    stop = True
+                    break
+                batch.append(write)
+
+            if batch:
+                self.write_batch(batch)
+            if stop:
+                # one last try for ratings still waiting on their bot message
+                remaining = self.due_deferred(everything=True)
+                if remaining:
+                    self.write_batch(remaining)
+                self.abandon_deferred()
+                return
+
+    def write_batch(self, batch):
+        batch_sizes.observe(len(batch))
+        upserts, ratings = self.group(batch)
+
+        for collection, documents in upserts.items():
+            self.upsert_with_retries(collection, documents)
+
+        for collection, key, rating in ratings:
+            try:
+                collection.mutate_in(key, [SD.upsert("rating", rating)])
+                self.rating_written(key)
+            except DocumentNotFoundException as e:
+                if self.closed:
+                    self.with_retries(key, lambda: collection.mutate_in(key, [SD.upsert("rating", rating)]))
+                else:
+                    self.defer_rating(collection, key, rating, e)
+            except Exception:
+                self.with_retries(key, lambda: collection.mutate_in(key, [SD.upsert("rating", rating)]))
+
+    def upsert_with_retries(self, collection, documents):
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = collection.upsert_multi(documents)
+                failed = result.exceptions
+            except Exception as e:
+                failed = {key: e for key in documents}
+
+            writes.inc(len(documents) - len(failed), result="ok" if attempt == 0 else "retried")
+            if not failed:
+                return
+
+            documents = {key: documents[key] for key in failed}
+            if attempt < self.max_retries:
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+
+        for key, error in failed.items():
+            self.record_failure(key, error)
+
+    def with_retries(self, key, write):
+        for attempt in range(self.max_retries + 1):
+            try:
+                write()
+                writes.inc(result="ok" if attempt == 0 else "retried")
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff_seconds * 2 ** attempt)
+
+        self.record_failure(key, error)
+
+    # writes everything already queued and stops the worker
+    def close(self, timeout=30):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.worker.join(timeout)
+
+        remaining = self.leftovers()
+        if remaining:
+            self.write_batch(remaining)
+
+
+# for the acouchbase cluster of app_async.py, which has no multi operations: a batch is written with
+# concurrent upserts over the same connection instead
+class AsyncChatWriter(ChatWriterBase):
+
+    def __init__(self, cluster, max_queue=CHAT_WRITER_QUEUE_SIZE, **kwargs):
+        super().__init__(cluster, **kwargs)
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.worker = asyncio.create_task(self.run())
+
+    async def submit_user_message(self, query, transformed_query, deviceType, browserType):
+        uuid_to_insert, write = self.user_message(query, transformed_query, deviceType, browserType)
+        await self.submit(write)
+        return uuid_to_insert
+
+    async def submit_bot_message(self, message, user_msg_id, product_ids, uuid_to_insert=None):
+        uuid_to_insert, write = self.bot_message(message, user_msg_id, product_ids, uuid_to_insert)
+        await self.submit(write)
+        return uuid_to_insert
+
+    async def submit_rating(self, bot_msg_id, rating):
+        await self.submit(self.rating(bot_msg_id, rating))
+
+    async def submit(self, write):
+        start = time.time()
+
+        try:
+            if self.closed:
+                raise asyncio.TimeoutError
+            await asyncio.wait_for(self.queue.put(write), CHAT_WRITER_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # back-pressure: the caller pays for the write rather than dropping it
+            await self.write_batch([write])
+        finally:
+            enqueue_wait_seconds.observe(time.time() - start)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    async def run(self):
+        while True:
+            batch = self.due_deferred()
+            stop = False
+
+            if not batch:
+                try:
+                    write = await asyncio.wait_for(self.queue.get(), self.deferred_wait())
+                except asyncio.TimeoutError:
+                    continue
+                if write is None:
+                    stop = True
+                else:
+                    batch = [write]
+
+            deadline = time.time() + self.flush_seconds
+
+            while batch and not stop and len(batch) < self.batch_size:
+                try:
+                    write = await asyncio.wait_for(self.queue.get(), max(0, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    break
+                if write is None:
+                    stop = True
+                    break
+                batch.append(write)
+
+            if batch:
+                await self.write_batch(batch)
+            if stop:
+                # one last try for ratings still waiting on their bot message
+                remaining = self.due_deferred(everything=True)
+                if remaining:
+                    await self.write_batch(remaining)
+                self.abandon_deferred()
+                return
+
+    async def write_batch(self, batch):
+        batch_sizes.observe(len(batch))
+        upserts, ratings = self.group(batch)
+
+        await asyncio.gather(*[
+            self.with_retries(key, lambda collection=collection, key=key, document=document: collection.upsert(key, document))
+            for collection, documents in upserts.items() for key, document in documents.items()
+        ])
+
+        for collection, key, rating in ratings:
+            try:
+                await collection.mutate_in(key, [SD.upsert("rating", rating)])
+                self.rating_written(key)
+            except DocumentNotFoundException as e:
+                if self.closed:
+                    await self.with_retries(key, lambda: collection.mutate_in(key, [SD.upsert("rating", rating)]))
+                else:
+                    self.defer_rating(collection, key, rating, e)
+            except Exception:
+                await self.with_retries(key, lambda: collection.mutate_in(key, [SD.upsert("rating", rating)]))
+
+    async def with_retries(self, key, write):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await write()
+                writes.inc(result="ok" if attempt == 0 else "retried")
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.backoff_seconds * 2 ** attempt)
+
+        self.record_failure(key, error)
+
+    # writes everything already queued and stops the worker
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        await self.queue.put(None)
+        await self.worker
+
+        remaining = self.leftovers()
+        if remaining:
+            await self.write_batch(remaining)
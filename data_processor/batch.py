@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from metrics import registry, get_logger
+import os
+
+load_dotenv()
+
+# shared by all batch requests, so concurrent batches don't multiply the number of LLM calls in flight
+ENRICHMENT_WORKERS = int(os.getenv("ENRICHMENT_WORKERS", 8))
+
+enrichment_executor = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS)
+
+logger = get_logger("batch")
+enrichment_errors = registry.counter("chatbot_enrichment_errors_total", "Documents of batch enrichment requests that failed")
+
+
+# runs process(doc) for every {"id": ..., "doc": ...} in documents and returns one
+# {"id": ..., "result": ..., "error": ...} per document, in the same order
+def process_documents(process, documents):
+
+    def process_one(document):
+        try:
+            return dict(id=document["id"], result=process(document["doc"]), error=None)
+
+        except Exception as e:
+            enrichment_errors.inc()
+            logger.warning("Error processing document %s: %s", document["id"], e)
+            return dict(id=document["id"], result=None, error=str(e))
+
+    return list(enrichment_executor.map(process_one, documents))
@@ -0,0 +1,43 @@
+from dotenv import load_dotenv
+import os
+import tiktoken
+
+load_dotenv()
+
+
+# long documents are embedded as overlapping chunks of at most CHUNK_MAX_TOKENS tokens, so one vector
+# doesn't have to stand for a whole email or product page and the prompt only carries the relevant part.
+# a chunk ends at the last sentence end in the second half of its window when there is one
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 32))
+
+SENTENCE_ENDS = (".", "!", "?", "\n")
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return [text] if text.strip() else []
+
+    chunks = []
+    start = 0
+
+    while True:
+        end = min(start + max_tokens, len(tokens))
+        if end < len(tokens):
+            end = sentence_end(tokens, start, end)
+
+        chunks.append(encoding.decode(tokens[start:end]).strip())
+        if end == len(tokens):
+            return chunks
+
+        start = max(end - overlap_tokens, start + 1)
+
+
+def sentence_end(tokens, start, end):
+    for index in range(end, start + (end - start) // 2, -1):
+        if encoding.decode(tokens[index - 1:index]).rstrip(" ").endswith(SENTENCE_ENDS):
+            return index
+    return end
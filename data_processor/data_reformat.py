@@ -1,8 +1,10 @@
 from datetime import datetime
 import re
 from data_processor.pii_processor import mask_sensitive_data
+from metrics import timed_stage
 
     
+@timed_stage("reformat")
 def data_reformat(data):    
     # Process "last_update" field
     last_update = data.get('last_update', None)
@@ -3,7 +3,17 @@ from langchain_community.document_transformers.openai_functions import (
 )
 from langchain_core.documents import Document
 from langchain_openai import ChatOpenAI
+from dotenv import load_dotenv
+from data_processor.text_classifier import TfidfLogisticClassifier
+from metrics import registry, record_stage, get_logger
+from openai_scheduler import scheduler, estimate_tokens, BACKGROUND
 import json
+import numpy as np
+import os
+import threading
+import time
+
+load_dotenv()
 
 schema = {
     "properties": {
@@ -19,13 +29,215 @@ schema = {
 }
 
 
-# Must be an OpenAI model that supports functions
-llm = ChatOpenAI(temperature=0, model="gpt-4o")
+# Must be an OpenAI model that supports functions. rate limits are retried by the OpenAI scheduler
+llm = ChatOpenAI(temperature=0, model="gpt-4o", max_retries=0)
 
 
 document_transformer = create_metadata_tagger(metadata_schema=schema, llm=llm)
 
+TYPES = ["internal_policies", "insurance_product"]
+
+# below this probability the local text classifier defers to the LLM tagger
+TAG_CLASSIFIER_THRESHOLD = float(os.getenv("TAG_CLASSIFIER_THRESHOLD", 0.8))
+
+# the labelled documents the local text classifier trains on: cbexports of main.data.products and policies
+# (json lines or array), whose label_tier says which tier labelled them, or json arrays of documents labelled by
+# hand under "type". only the LLM labels of an export are used, those are the documents the structural rules
+# couldn't decide, and the classifier's own labels would only teach it what it already predicts. without any
+# the classifier is disabled
+TAG_CLASSIFIER_TRAINING_PATHS = [path.strip() for path in os.getenv("TAG_CLASSIFIER_TRAINING_PATHS", "").split(",") if path.strip()]
+
+# the tier stays disabled unless every type has this many training documents. TAG_CLASSIFIER_HOLDOUT of them
+# are held out to measure its accuracy, and it's disabled if the predictions it would make (those above
+# TAG_CLASSIFIER_THRESHOLD) are right less than TAG_CLASSIFIER_MIN_ACCURACY of the time
+TAG_CLASSIFIER_MIN_PER_CLASS = int(os.getenv("TAG_CLASSIFIER_MIN_PER_CLASS", 50))
+TAG_CLASSIFIER_HOLDOUT = float(os.getenv("TAG_CLASSIFIER_HOLDOUT", 0.2))
+TAG_CLASSIFIER_MIN_ACCURACY = float(os.getenv("TAG_CLASSIFIER_MIN_ACCURACY", 0.95))
+
+# the classifier trains at startup, on at most this many documents and with this many distinct tokens
+TAG_CLASSIFIER_MAX_DOCUMENTS = int(os.getenv("TAG_CLASSIFIER_MAX_DOCUMENTS", 20000))
+TAG_CLASSIFIER_MAX_FEATURES = int(os.getenv("TAG_CLASSIFIER_MAX_FEATURES", 50000))
+
+tagging_metrics = {tier: {"hits": 0, "seconds": 0.0} for tier in ["structural", "classifier", "llm"]}
+tagging_metrics_lock = threading.Lock()
+
+logger = get_logger("metadata_tag")
+
+
+# the schema alone decides most documents: products carry product fields, emails carry email fields
+def tag_by_structure(data):
+    if not isinstance(data, dict):
+        return None
+    
+    if "product_id" in data or any(key.startswith("product_") for key in data):
+        return "insurance_product"
+    
+    if "email_id" in data or ("from" in data and "to" in data):
+        return "internal_policies"
+    
+    return None
+
+
+# what the enrichment stages added to a labelled copy, not part of the document that was tagged
+TAGGING_OUTPUT_FIELDS = ("type", "labelled", "label_tier", "fingerprints", "assembled_for_embedding", "embedding", "chunk_count")
+
+
+def document_text(data):
+    if isinstance(data, str):
+        return data
+    return " ".join(str(value) for key, value in data.items() if isinstance(value, str) and key not in TAGGING_OUTPUT_FIELDS)
+
+
+def read_documents(path):
+    with open(path, 'r') as file:
+        text = file.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+# the (text, type) pairs of the training documents labelled by the LLM tier or by hand
+def load_training_data(paths):
+    texts = []
+    labels = []
+
+    for path in paths:
+        try:
+            documents = read_documents(path)
+        except Exception as e:
+            logger.error("Error loading classifier training data %s: %s", path, e)
+            continue
+
+        for document in documents:
+            # a labelled copy from before label_tier was stored may have been labelled by any tier
+            exported = document.get("labelled") is not None
+            if document.get("type") in TYPES and (not exported or document.get("label_tier") == "llm"):
+                texts.append(document_text(document))
+                labels.append(document["type"])
+
+    return texts, labels
+
+
+# a stratified split, holdout of the documents of every type are held out
+def split_holdout(labels, holdout, seed=0):
+    random = np.random.default_rng(seed)
+    train, held_out = [], []
+
+    for label in TYPES:
+        indices = random.permutation([index for index, value in enumerate(labels) if value == label]).tolist()
+        count = int(len(indices) * holdout)
+        held_out.extend(indices[:count])
+        train.extend(indices[count:])
+
+    return sorted(train), sorted(held_out)
+
+
+# the accuracy of every prediction, and of those confident enough to be used and how many are
+def evaluate_classifier(classifier, texts, labels, threshold):
+    predictions = [classifier.predict(text) for text in texts]
+    correct = [type == label for (type, _), label in zip(predictions, labels)]
+    confident = [right for right, (_, probability) in zip(correct, predictions) if probability >= threshold]
+
+    return dict(
+        holdout_documents=len(texts),
+        holdout_accuracy=sum(correct) / len(correct) if correct else None,
+        confident_accuracy=sum(confident) / len(confident) if confident else None,
+        confident_share=len(confident) / len(correct) if correct else None,
+    )
+
+
+# trains the classifier and returns it, or None if the tier stays disabled, with a report of why and how
+# accurate it is on the held out documents
+def train_classifier(paths=TAG_CLASSIFIER_TRAINING_PATHS):
+    texts, labels = load_training_data(paths)
+    train, held_out = split_holdout(labels, TAG_CLASSIFIER_HOLDOUT)
+    per_class = {label: sum(1 for index in train if labels[index] == label) for label in TYPES}
+    report = dict(enabled=False, reason=None, training_documents=per_class)
+
+    if min(per_class.values()) < TAG_CLASSIFIER_MIN_PER_CLASS:
+        report["reason"] = f"fewer than {TAG_CLASSIFIER_MIN_PER_CLASS} training documents of a type"
+        logger.warning("Metadata classifier disabled, %s: %s", report["reason"], per_class)
+        return None, report
+
+    logger.info("Training metadata classifier on %d documents..", len(train))
+    classifier = TfidfLogisticClassifier(TYPES, max_features=TAG_CLASSIFIER_MAX_FEATURES, max_documents=TAG_CLASSIFIER_MAX_DOCUMENTS)
+    classifier.fit([texts[index] for index in train], [labels[index] for index in train])
+    report.update(evaluate_classifier(classifier, [texts[index] for index in held_out], [labels[index] for index in held_out], TAG_CLASSIFIER_THRESHOLD))
+
+    if report["confident_accuracy"] is None or report["confident_accuracy"] < TAG_CLASSIFIER_MIN_ACCURACY:
+        report["reason"] = f"held out accuracy {report['confident_accuracy']} below {TAG_CLASSIFIER_MIN_ACCURACY}"
+        logger.warning("Metadata classifier disabled, %s", report["reason"])
+        return None, report
+
+    report["enabled"] = True
+    logger.info("Metadata classifier held out accuracy %.3f, %.3f on the %.0f%% it is confident about",
+                report["holdout_accuracy"], report["confident_accuracy"], report["confident_share"] * 100)
+    return classifier, report
+
+
+classifier, classifier_report = train_classifier()
+
+
+def record_tagging_tier(tier, seconds):
+    with tagging_metrics_lock:
+        tagging_metrics[tier]["hits"] += 1
+        tagging_metrics[tier]["seconds"] += seconds
+    
+    record_stage(f"tag_{tier}", seconds)
+
+
+def get_tagging_metrics():
+    with tagging_metrics_lock:
+        total = sum(metrics["hits"] for metrics in tagging_metrics.values())
+        return dict({
+            tier: dict(
+                hits=metrics["hits"],
+                hit_rate=metrics["hits"] / total if total else 0.0,
+                average_seconds=metrics["seconds"] / metrics["hits"] if metrics["hits"] else 0.0,
+            )
+            for tier, metrics in tagging_metrics.items()
+        }, classifier_training=classifier_report)
+
+
+def collect_tagging_metrics():
+    with tagging_metrics_lock:
+        hits = [({"tier": tier}, metrics["hits"]) for tier, metrics in tagging_metrics.items()]
+    yield ("chatbot_tagging_tier_total", "counter", "Documents tagged by each metadata tagging tier", hits)
+    if classifier_report.get("holdout_accuracy") is not None:
+        yield ("chatbot_tagging_classifier_holdout_accuracy", "gauge", "Accuracy of the metadata classifier on its held out documents",
+               [({"predictions": "all"}, classifier_report["holdout_accuracy"]),
+                ({"predictions": "confident"}, classifier_report["confident_accuracy"] or 0.0)])
+
+
+registry.register_collector(collect_tagging_metrics)
+
+
 def tag_metadata(data):
+    return label_metadata(data)["type"]
+
+
+# structural rules first, then the local text classifier, and the LLM tagger only when neither is confident.
+# returns the type and the tier that decided it, the metadata_labelling function stores both
+def label_metadata(data):
+    start = time.time()
+    
+    type = tag_by_structure(data)
+    if type is not None:
+        record_tagging_tier("structural", time.time() - start)
+        return dict(type=type, tier="structural")
+    
+    if classifier is not None and isinstance(data, (str, dict)):
+        type, probability = classifier.predict(document_text(data))
+        if probability >= TAG_CLASSIFIER_THRESHOLD:
+            record_tagging_tier("classifier", time.time() - start)
+            return dict(type=type, tier="classifier")
+    
+    type = tag_metadata_with_llm(data)
+    record_tagging_tier("llm", time.time() - start)
+    return dict(type=type, tier="llm")
+
+
+def tag_metadata_with_llm(data):
       
     if isinstance(data, str):
         data = data
@@ -40,5 +252,8 @@ def tag_metadata(data):
         )
     ]
 
-    enhanced_documents = document_transformer.transform_documents(original_documents)
+    enhanced_documents = scheduler.call(
+        lambda: document_transformer.transform_documents(original_documents),
+        BACKGROUND, estimate_tokens(data, completion_tokens=50),
+    )
     return enhanced_documents[0].metadata['type']
\ No newline at end of file
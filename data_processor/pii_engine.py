@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+
+
+# local detection of the sensitive data we see in the corpus. every text field is scanned once with a
+# single compiled alternation; matches that validate (checksums, digit counts, a labelling keyword) are
+# masked here, and fields with matches that don't validate, or with address-like wording, are flagged
+# as ambiguous so only those go to the LLM
+pii_pattern = re.compile(
+    r"(?P<email>\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b)"
+    r"|(?P<hkid>\b[A-Z]{1,2}\d{6,8}\s?\(?[0-9A]\)?)"
+    r"|(?P<phone>(?<![\w-])(?:\+\d{1,3}[\s-]?)?\(?\d{2,4}\)?[\s-]?\d{3,4}[\s-]?\d{4}\b)"
+    r"|(?P<case_id>\b[A-Z]{2,4}\d{3,8}\b)"
+    r"|(?P<local_phone>(?<![\w-])\d{4}[\s-]?\d{4}(?![\w-]))"
+)
+
+id_keyword_pattern = re.compile(r"\b(hkid|id|identity|passport)\b\W*$", re.IGNORECASE)
+case_keyword_pattern = re.compile(r"\b(case|ticket|claim|ref|reference)\b\W*$", re.IGNORECASE)
+# anywhere in the window before a local number, "call me at 9123 4567"
+phone_keyword_pattern = re.compile(r"\b(phone|tel|telephone|mobile|cell|call|contact|whatsapp|sms|fax)\b", re.IGNORECASE)
+
+# numbered flats, accounts and cards, or a house number followed by a street name
+ambiguous_pattern = re.compile(
+    r"\b(?:flat|floor|block|room|unit|account|card)\b\W{0,3}(?:no\.?|number|#)?\W{0,3}\d"
+    r"|\b\d+[a-z]?\s+(?:\w+\s+){1,3}(?:street|road|avenue|lane)\b",
+    re.IGNORECASE,
+)
+
+KEYWORD_WINDOW = 12
+PHONE_KEYWORD_WINDOW = 24
+
+# identifiers and timestamps of our own that look like pii to the patterns above
+SKIP_FIELDS = {"product_id", "email_id", "last_update", "type"}
+
+
+def hkid_check_digit_valid(hkid):
+    hkid = re.sub(r"[\s()]", "", hkid.upper())
+    match = re.fullmatch(r"([A-Z]{1,2})(\d{6})([0-9A])", hkid)
+    if match is None:
+        return False
+
+    letters, digits, check = match.groups()
+    # a single letter prefix is padded with a space, which counts as 36
+    values = ([36] if len(letters) == 1 else []) + [ord(letter) - 55 for letter in letters] + [int(digit) for digit in digits]
+    total = sum(value * weight for value, weight in zip(values, range(9, 1, -1)))
+
+    remainder = (11 - total % 11) % 11
+    expected = "A" if remainder == 10 else str(remainder)
+    return check == expected
+
+
+def mask_id(value):
+    # keep the prefix, replace the last four digits like the LLM prompt does
+    return re.sub(r"\d(?=(?:\D*\d){0,3}\D*$)", "x", value)
+
+
+def preceded_by(pattern, text, start, window=KEYWORD_WINDOW):
+    return pattern.search(text[max(0, start - window):start]) is not None
+
+
+# returns the masked text and whether anything in it still needs a closer look
+def scan_text(text):
+    ambiguous = ambiguous_pattern.search(text) is not None
+
+    def replace(match):
+        nonlocal ambiguous
+        kind = match.lastgroup
+        value = match.group()
+
+        if kind == "email":
+            return "xxxx@xxxx.xxxx"
+
+        if kind == "phone":
+            if 8 <= len(re.sub(r"\D", "", value)) <= 15:
+                return "xxx-xxx-xxxx"
+            ambiguous = True
+            return value
+
+        # an 8 digit local (hong kong) number is masked next to a phone keyword, otherwise it could as well
+        # be an amount or a date and goes to the LLM
+        if kind == "local_phone":
+            if preceded_by(phone_keyword_pattern, text, match.start(), PHONE_KEYWORD_WINDOW):
+                return "xxxx-xxxx"
+            ambiguous = True
+            return value
+
+        if kind == "hkid":
+            if hkid_check_digit_valid(value) or preceded_by(id_keyword_pattern, text, match.start()):
+                return mask_id(value)
+            ambiguous = True
+            return value
+
+        if kind == "case_id":
+            if preceded_by(case_keyword_pattern, text, match.start()):
+                return mask_id(value)
+            ambiguous = True
+            return value
+
+        return value
+
+    return pii_pattern.sub(replace, text), ambiguous
+
+
+def text_fields(data, path=()):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key not in SKIP_FIELDS:
+                yield from text_fields(value, path + (key,))
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            yield from text_fields(value, path + (index,))
+    elif isinstance(data, str):
+        yield path, data
+
+
+def set_field(data, path, value):
+    for key in path[:-1]:
+        data = data[key]
+    data[path[-1]] = value
+
+
+def field_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# masked field values keyed by a hash of the original value
+class MaskedFieldCache:
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
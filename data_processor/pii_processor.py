@@ -1,33 +1,53 @@
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import StrOutputParser
-import json 
+from dotenv import load_dotenv
+from data_processor.pii_engine import scan_text, text_fields, set_field, field_hash, MaskedFieldCache
+from metrics import span, timed_stage, record_cache
+from model_router import router, record_response_usage
+from chain_registry import chains
+import copy
+import os
 
-model = ChatOpenAI(model="gpt-4")
+load_dotenv()
 
-parser = StrOutputParser()
+# the model ambiguous fields go to, through the model router so it falls back on timeouts and rate limits
+PII_MODEL = os.getenv("PII_MODEL", "gpt-4")
 
+# send fields the local engine flags as ambiguous to the LLM, otherwise the local result is final
+PII_LLM_FALLBACK = os.getenv("PII_LLM_FALLBACK", "true").lower() == "true"
 
-prompt_template = PromptTemplate.from_template(
-   """The input_text below is a json document. Scan the document, identify 
-   all occurences of any sensitive information such as phone numbers, ids, addresss, etc.
-   Then, mask the sensitive information by replacing it with a placeholder.
-   For example, if the information is an id, replace last four digits with 'xxxx'. 
-   if the information is a phone number, replace it with 'xxx-xxx-xxxx'.
-   if the information is an email, replace it with xxxx@xxxx.xxxx'
-   If the information is an any other nature, replace it with 'xxxxxxxx'.
-   
-   input_text: {input_text}
-   return the transformed document as a JSON object, all property names should be enclosed in double quotes.
-   
-   output_as_json:
-   """
-)
 
-chain = prompt_template | model | parser
+# the masking prompt is prompts/pii_mask.txt, reloaded by the chain registry when it changes
+chains.register("pii_mask", "pii_mask.txt", PromptTemplate.from_template)
 
+masked_fields = MaskedFieldCache(max_entries=int(os.getenv("PII_CACHE_MAX_ENTRIES", 10000)))
+
+
+def mask_text(text):
+    key = field_hash(text)
+    masked = masked_fields.get(key)
+    record_cache("pii_mask", masked is not None)
+    if masked is not None:
+        return masked
+    
+    masked, ambiguous = scan_text(text)
+    
+    if ambiguous and PII_LLM_FALLBACK:
+        with span("mask_llm"):
+            model, response = router.run(lambda llm: chains.chain("pii_mask", llm), {"input_text": masked}, PII_MODEL, "pii")
+        record_response_usage(model, response)
+        masked = response.content.strip()
+    
+    masked_fields.put(key, masked)
+    return masked
+
+
+@timed_stage("mask")
 def mask_sensitive_data(request_data):    
-    result = chain.invoke({"input_text": request_data})
-    #transform result into a dictionary
-    result_dict = json.loads(result)
+    result_dict = copy.deepcopy(request_data)
+    
+    for path, text in list(text_fields(request_data)):
+        masked = mask_text(text)
+        if masked != text:
+            set_field(result_dict, path, masked)
+    
     return result_dict
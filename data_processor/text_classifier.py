@@ -0,0 +1,108 @@
+from collections import Counter
+import numpy as np
+import re
+
+
+token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+# binary tf-idf + logistic regression classifier, small enough to train at startup on the corpus.
+# features are kept sparse (the nonzero columns and values of every row), so memory grows with the
+# tokens in the training texts rather than documents x vocabulary. the vocabulary is capped at the
+# max_features most frequent tokens and training at max_documents texts, sampled evenly over the classes
+class TfidfLogisticClassifier:
+
+    def __init__(self, labels, iterations=300, learning_rate=1.0, l2=1e-3, max_features=50000, max_documents=20000, seed=0):
+        self.labels = labels
+        self.iterations = iterations
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        self.max_features = max_features
+        self.max_documents = max_documents
+        self.seed = seed
+        self.vocabulary = {}
+        self.idf = None
+        self.weights = None
+        self.bias = 0.0
+
+    def fit(self, texts, labels):
+        texts, labels = self.sample(texts, labels)
+
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(set(tokenize(text)))
+
+        kept = sorted(token for token, _ in document_frequency.most_common(self.max_features))
+        self.vocabulary = {token: index for index, token in enumerate(kept)}
+        self.idf = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for token, index in self.vocabulary.items():
+            self.idf[index] = np.log((1 + len(texts)) / (1 + document_frequency[token])) + 1
+
+        rows, columns, values = self.transform(texts)
+        targets = np.array([self.labels.index(label) for label in labels], dtype=np.float32)
+        self.weights = np.zeros(len(self.vocabulary), dtype=np.float32)
+        self.bias = 0.0
+
+        # weight the classes equally, the corpus has far more products than emails
+        class_counts = np.bincount(targets.astype(int), minlength=2)
+        sample_weights = (len(texts) / (2 * np.maximum(class_counts, 1)))[targets.astype(int)].astype(np.float32)
+
+        for _ in range(self.iterations):
+            scores = np.bincount(rows, weights=values * self.weights[columns], minlength=len(texts))
+            predictions = self.sigmoid(scores + self.bias)
+            error = (predictions - targets) * sample_weights
+            gradient = np.bincount(columns, weights=values * error[rows], minlength=len(self.vocabulary))
+            self.weights -= (self.learning_rate * (gradient / len(texts) + self.l2 * self.weights)).astype(np.float32)
+            self.bias -= self.learning_rate * float(error.mean())
+
+        return self
+
+    def sample(self, texts, labels):
+        if len(texts) <= self.max_documents:
+            return texts, labels
+
+        random = np.random.default_rng(self.seed)
+        per_label = self.max_documents // len(self.labels)
+        chosen = []
+        for label in self.labels:
+            indices = [index for index, value in enumerate(labels) if value == label]
+            chosen.extend(random.permutation(indices)[:per_label].tolist())
+
+        chosen.sort()
+        return [texts[index] for index in chosen], [labels[index] for index in chosen]
+
+    # the nonzero features of texts as (row, column, value) arrays, every row l2 normalised
+    def transform(self, texts):
+        rows, columns, values = [], [], []
+
+        for row, text in enumerate(texts):
+            counts = [(self.vocabulary[token], count) for token, count in Counter(tokenize(text)).items() if token in self.vocabulary]
+            if not counts:
+                continue
+
+            row_columns = np.array([column for column, _ in counts], dtype=np.int64)
+            row_values = np.array([count for _, count in counts], dtype=np.float32) * self.idf[row_columns]
+            rows.append(np.full(len(counts), row, dtype=np.int64))
+            columns.append(row_columns)
+            values.append(row_values / np.linalg.norm(row_values))
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+    # returns the predicted label and its probability
+    def predict(self, text):
+        _, columns, values = self.transform([text])
+        probability = float(self.sigmoid(float(values @ self.weights[columns]) + self.bias))
+
+        if probability >= 0.5:
+            return self.labels[1], probability
+        return self.labels[0], 1 - probability
+
+    @staticmethod
+    def sigmoid(values):
+        return 1 / (1 + np.exp(-values))
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import sqlite3
+import threading
+
+
+def content_hash(model, text):
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+# embeddings keyed by a hash of model and text. the newest max_entries are kept in memory as float32
+# arrays (about 6 KB for 1536 dimensions, a list of python floats takes about 50 KB), and with a path
+# every embedding is also kept in a sqlite file so they survive restarts. lookups return lists.
+# the file keeps the max_rows most recently written embeddings, older rows are deleted as new ones come in.
+# it's opened in WAL mode, so workers sharing it read while one of them writes, and a writer waits up to
+# busy_timeout seconds for another one's lock instead of failing
+class EmbeddingCache:
+
+    def __init__(self, max_entries=10000, path=None, max_rows=100000, busy_timeout=5):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+
+        if path:
+            self.db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+            self.db.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key].tolist()
+
+            if self.db is not None:
+                row = self.db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self.remember(key, embedding)
+                    self.hits += 1
+                    return embedding.tolist()
+
+            self.misses += 1
+            return None
+
+    def put_many(self, items):
+        with self.lock:
+            items = [(key, np.asarray(embedding, dtype=np.float32)) for key, embedding in items]
+            for key, embedding in items:
+                self.remember(key, embedding)
+
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, embedding.tobytes()) for key, embedding in items],
+                )
+                self.evict_rows()
+                self.db.commit()
+
+    def put(self, key, embedding):
+        self.put_many([(key, embedding)])
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), bytes=sum(embedding.nbytes for embedding in self.entries.values()), hits=self.hits, misses=self.misses)
+
+    # a replaced row gets a new rowid, so rowids follow the write order and the oldest rows are a range of them
+    def evict_rows(self):
+        self.db.execute("DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?", (self.max_rows,))
+
+    def remember(self, key, embedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
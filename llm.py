@@ -1,44 +1,400 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate
-from openai import OpenAI
+from langchain_core.documents import Document
+from openai import OpenAI, AsyncOpenAI
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dotenv import load_dotenv
+import asyncio
+import os
+import re
+import threading
+import time
+import tiktoken
+from embedding_cache import EmbeddingCache, content_hash
+from metrics import registry, span, annotate, record_cache
+from model_router import router, record_usage, record_response_usage, REWRITE_MODEL, CHAT_MODELS
+from openai_scheduler import scheduler, INTERACTIVE, BACKGROUND
+from chain_registry import chains
 
+load_dotenv()
 
-chat_openai = ChatOpenAI(model="gpt-4o", temperature=0.05)    
 
-client_openai = OpenAI()
+# rate limited calls are retried by the OpenAI scheduler, which slows down for everyone on a 429
+client_openai = OpenAI(max_retries=0)
 
-prompt_openai = ChatPromptTemplate.from_template("""Answer the following question incorporating the following context:
-<context>
-{context}
-</context>
+async_client_openai = AsyncOpenAI(max_retries=0)
 
-The answer should be precise and professional, and no longer than 5 sentences. 
-
-Question: {input}""")
-
-
-query_transform_prompt = ChatPromptTemplate.from_messages(
+# the answer and query rewrite prompts are read from prompts/answer.txt and prompts/query_transform.txt,
+# their chains are built per model by the chain registry and reloaded when the files change
+chains.register("answer", "answer.txt", ChatPromptTemplate.from_template, create_stuff_documents_chain)
+chains.register("query_transform", "query_transform.txt", lambda text: ChatPromptTemplate.from_messages(
     [
         MessagesPlaceholder(variable_name="messages"),
-        (
-            "user",
-            "Given the above conversation, generate a search query to look up in order to get information relevant to the conversation. Only respond with the query, nothing else.",
-        ),
+        ("user", text),
     ]
+))
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# embeddings are cached by content hash, in memory and optionally in a sqlite file at EMBEDDING_CACHE_PATH,
+# which keeps the newest EMBEDDING_CACHE_MAX_ROWS
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 10000)),
+    path=os.getenv("EMBEDDING_CACHE_PATH"),
+    max_rows=int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", 100000)),
+    busy_timeout=float(os.getenv("EMBEDDING_CACHE_BUSY_TIMEOUT", 5)),
 )
 
-def create_openai_embeddings(input_message):
-    return client_openai.embeddings.create(input = [input_message], model="text-embedding-ada-002").data[0].embedding
+# limits for one embeddings request when embedding in batches
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 100000))
+
+embedding_encoding = tiktoken.get_encoding("cl100k_base")
+
+
+# a chat query is embedded at INTERACTIVE priority, documents for the index at BACKGROUND
+def create_openai_embeddings(input_message, priority=INTERACTIVE):
+    key = content_hash(EMBEDDING_MODEL, input_message)
+    embedding = embedding_cache.get(key)
+    record_cache("embedding", embedding is not None)
+    
+    if embedding is None:
+        with span("embed"):
+            response = scheduler.call(
+                lambda: client_openai.embeddings.create(input = [input_message], model=EMBEDDING_MODEL),
+                priority, len(embedding_encoding.encode(input_message)),
+            )
+        record_usage(EMBEDDING_MODEL, prompt_tokens=response.usage.prompt_tokens)
+        embedding = response.data[0].embedding
+        embedding_cache.put(key, embedding)
+    
+    return embedding
+
+
+# embeds many strings, returning the embeddings in the same order. duplicates and cached strings are not
+# sent, the rest go out in requests of at most EMBEDDING_BATCH_SIZE strings and EMBEDDING_BATCH_MAX_TOKENS tokens
+def create_openai_embeddings_batch(input_messages, priority=BACKGROUND):
+    embeddings, missing = lookup_cached_embeddings(input_messages)
+    
+    for batch, tokens in split_embedding_batches(missing):
+        with span("embed_batch"):
+            response = scheduler.call(lambda: client_openai.embeddings.create(input = batch, model=EMBEDDING_MODEL), priority, tokens)
+        store_batch_embeddings(embeddings, batch, response)
+    
+    return [embeddings[message] for message in input_messages]
+
+
+def lookup_cached_embeddings(input_messages):
+    embeddings = {}
+    missing = []
+    
+    for message in dict.fromkeys(input_messages):
+        embedding = embedding_cache.get(content_hash(EMBEDDING_MODEL, message))
+        if embedding is None:
+            missing.append(message)
+        else:
+            embeddings[message] = embedding
+    
+    record_cache("embedding", True, count=len(embeddings))
+    record_cache("embedding", False, count=len(missing))
+    return embeddings, missing
 
 
+def split_embedding_batches(messages):
+    batch = []
+    batch_tokens = 0
+    
+    for message in messages:
+        tokens = len(embedding_encoding.encode(message))
+        
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+            yield batch, batch_tokens
+            batch = []
+            batch_tokens = 0
+        
+        batch.append(message)
+        batch_tokens += tokens
+    
+    if batch:
+        yield batch, batch_tokens
+
+
+def store_batch_embeddings(embeddings, batch, response):
+    items = []
+    
+    for data in response.data:
+        message = batch[data.index]
+        embeddings[message] = data.embedding
+        items.append((content_hash(EMBEDDING_MODEL, message), data.embedding))
+    
+    embedding_cache.put_many(items)
+    record_usage(EMBEDDING_MODEL, prompt_tokens=response.usage.prompt_tokens)
+
+
+def rewrite_chain(llm):
+    return chains.chain("query_transform", llm)
+
+
+# the rewrite goes to REWRITE_MODEL, a cheaper and faster model than the answers need
 def generate_query_transform_prompt(messages):
-    query_transformation_chain = query_transform_prompt | chat_openai
+    with span("rewrite"):
+        model, response = router.run(rewrite_chain, {"messages": messages}, REWRITE_MODEL, "rewrite")
+    record_response_usage(model, response)
+    return response.content 
+    
+
+async def acreate_openai_embeddings(input_message, priority=INTERACTIVE):
+    key = content_hash(EMBEDDING_MODEL, input_message)
+    embedding = embedding_cache.get(key)
+    record_cache("embedding", embedding is not None)
     
-    print("generating transformed query...")
-    return query_transformation_chain.invoke({"messages": messages}).content 
+    if embedding is None:
+        with span("embed"):
+            response = await scheduler.acall(
+                lambda: async_client_openai.embeddings.create(input = [input_message], model=EMBEDDING_MODEL),
+                priority, len(embedding_encoding.encode(input_message)),
+            )
+        record_usage(EMBEDDING_MODEL, prompt_tokens=response.usage.prompt_tokens)
+        embedding = response.data[0].embedding
+        embedding_cache.put(key, embedding)
     
+    return embedding
+
+
+async def acreate_openai_embeddings_batch(input_messages, priority=BACKGROUND):
+    embeddings, missing = lookup_cached_embeddings(input_messages)
+    
+    batches = list(split_embedding_batches(missing))
+    with span("embed_batch"):
+        responses = await asyncio.gather(*[
+            scheduler.acall(lambda batch=batch: async_client_openai.embeddings.create(input = batch, model=EMBEDDING_MODEL), priority, tokens)
+            for batch, tokens in batches
+        ])
+    for (batch, _), response in zip(batches, responses):
+        store_batch_embeddings(embeddings, batch, response)
+    
+    return [embeddings[message] for message in input_messages]
+
+
+async def agenerate_query_transform_prompt(messages):
+    with span("rewrite"):
+        model, response = await router.arun(rewrite_chain, {"messages": messages}, REWRITE_MODEL, "rewrite")
+    record_response_usage(model, response)
+    return response.content 
+    
+
+def generate_document_chain(llm):     
+    return chains.chain("answer", llm)
+
+
+# chains for every model a message can end up on, including fallbacks, are built at startup
+chains.warm("answer", [router.chat_model(model) for name in CHAT_MODELS for model in router.candidates(name)])
+chains.warm("query_transform", [router.chat_model(model) for model in router.candidates(REWRITE_MODEL)])
+
+
+# streams the answer from the requested model (CHAT_MODEL if it isn't one of CHAT_MODELS), or its
+# fallback. yields (model, chunk) pairs, the model is the one actually answering
+def stream_answer(query, context, model=None):
+    annotate(prompt_version=chains.version("answer"))
+    inputs = {"input": query, "context": [Document(page_content=context)]}
+    yield from router.stream(generate_document_chain, inputs, router.resolve(model), "answer")
+
+
+async def astream_answer(query, context, model=None):
+    annotate(prompt_version=chains.version("answer"))
+    inputs = {"input": query, "context": [Document(page_content=context)]}
+    async for model_chunk in router.astream(generate_document_chain, inputs, router.resolve(model), "answer"):
+        yield model_chunk
+
+
+# streamed completions don't report usage, so the answer tokens are counted here. cl100k_base is close
+# enough to the chat models' tokenizers for capacity planning and cost estimates
+def record_answer_tokens(model, query, context, answer):
+    record_usage(
+        model,
+        prompt_tokens=len(embedding_encoding.encode(chains.prompt("answer").format(input=query, context=context))),
+        completion_tokens=len(embedding_encoding.encode(answer)),
+    )
+
 
-def generate_document_chain():     
-    return create_stuff_documents_chain(chat_openai, prompt_openai)
\ No newline at end of file
+# query rewrite policy
+# "auto" skips the rewrite on the first turn and for follow-ups that already read as standalone questions,
+# "always" rewrites every message like before
+REWRITE_POLICY = os.getenv("REWRITE_POLICY", "auto")
+
+# when a rewrite is needed, retrieve for the raw query at the same time and use that result if the rewrite
+# comes back unchanged or doesn't come back within REWRITE_RACE_TIMEOUT seconds
+REWRITE_RACE = os.getenv("REWRITE_RACE", "false").lower() == "true"
+REWRITE_RACE_TIMEOUT = float(os.getenv("REWRITE_RACE_TIMEOUT", 3))
+
+rewrite_executor = ThreadPoolExecutor(max_workers=int(os.getenv("REWRITE_RACE_WORKERS", 16)))
+
+# references to earlier turns, or connectives that only make sense as a continuation
+follow_up_pattern = re.compile(
+    r"\b(it|its|it's|this|that|these|those|they|them|their|he|she|him|his|her|one|ones|same|above|previous|former|latter|other|else|more|also|too|again)\b"
+    r"|^\s*(and|but|so|or|what about|how about)\b",
+    re.IGNORECASE,
+)
+
+rewrite_metrics = {
+    "first_turn": 0,
+    "standalone": 0,
+    "rewrite": 0,
+    "race_raw_reused": 0,
+    "race_timeout": 0,
+    "rewrite_calls": 0,
+    "rewrite_seconds": 0.0,
+    "saved_seconds": 0.0,
+}
+rewrite_metrics_lock = threading.Lock()
+
+
+def choose_rewrite_path(messages):
+    if REWRITE_POLICY == "always":
+        return "rewrite"
+    
+    if len(messages) <= 1:
+        return "first_turn"
+    
+    query = messages[-1].content.strip()
+    if len(query.split()) < 3 or follow_up_pattern.search(query):
+        return "rewrite"
+    
+    return "standalone"
+
+
+def record_rewrite_path(path, rewrite_seconds=None, saved_seconds=None):
+    with rewrite_metrics_lock:
+        rewrite_metrics[path] += 1
+        
+        if rewrite_seconds is not None:
+            rewrite_metrics["rewrite_calls"] += 1
+            rewrite_metrics["rewrite_seconds"] += rewrite_seconds
+        
+        # a skipped rewrite saves what a rewrite costs on average
+        if saved_seconds is None and path in ("first_turn", "standalone") and rewrite_metrics["rewrite_calls"]:
+            saved_seconds = rewrite_metrics["rewrite_seconds"] / rewrite_metrics["rewrite_calls"]
+        
+        if saved_seconds is not None:
+            rewrite_metrics["saved_seconds"] += saved_seconds
+        
+    annotate(rewrite_path=path)
+
+
+def get_rewrite_metrics():
+    with rewrite_metrics_lock:
+        return dict(rewrite_metrics)
+
+
+def collect_rewrite_metrics():
+    current = get_rewrite_metrics()
+    yield ("chatbot_rewrite_path_total", "counter", "Messages by query rewrite path",
+           [({"path": path}, current[path]) for path in ("first_turn", "standalone", "rewrite", "race_raw_reused", "race_timeout")])
+    yield ("chatbot_rewrite_saved_seconds_total", "counter", "Estimated seconds saved by skipping or racing the rewrite",
+           [({}, current["saved_seconds"])])
+
+
+registry.register_collector(collect_rewrite_metrics)
+
+
+def same_query(query, other_query):
+    normalise = lambda text: re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+    return normalise(query) == normalise(other_query)
+
+
+def timed_retrieve(retrieve, query):
+    start = time.time()
+    result = retrieve(query)
+    return result, time.time() - start
+
+
+async def atimed_retrieve(aretrieve, query):
+    start = time.time()
+    result = await aretrieve(query)
+    return result, time.time() - start
+
+
+def transform_query(messages):
+    path = choose_rewrite_path(messages)
+    query = messages[-1].content
+    
+    if path != "rewrite":
+        record_rewrite_path(path)
+        return query
+    
+    start = time.time()
+    new_query = generate_query_transform_prompt(messages)
+    record_rewrite_path(path, rewrite_seconds=time.time() - start)
+    return new_query
+
+
+# returns the query that was used together with retrieve(query)
+def transform_query_and_retrieve(messages, retrieve):
+    if not REWRITE_RACE or choose_rewrite_path(messages) != "rewrite":
+        new_query = transform_query(messages)
+        return new_query, retrieve(new_query)
+    
+    query = messages[-1].content
+    start = time.time()
+    rewrite_future = rewrite_executor.submit(generate_query_transform_prompt, messages)
+    raw_future = rewrite_executor.submit(timed_retrieve, retrieve, query)
+    
+    try:
+        new_query = rewrite_future.result(timeout=REWRITE_RACE_TIMEOUT)
+    except FutureTimeoutError:
+        raw_result, retrieve_seconds = raw_future.result()
+        record_rewrite_path("race_timeout", saved_seconds=REWRITE_RACE_TIMEOUT + retrieve_seconds - (time.time() - start))
+        return query, raw_result
+    
+    rewrite_seconds = time.time() - start
+    
+    if same_query(query, new_query):
+        raw_result, retrieve_seconds = raw_future.result()
+        record_rewrite_path("race_raw_reused", rewrite_seconds=rewrite_seconds, saved_seconds=rewrite_seconds + retrieve_seconds - (time.time() - start))
+        return query, raw_result
+    
+    record_rewrite_path("rewrite", rewrite_seconds=rewrite_seconds)
+    return new_query, retrieve(new_query)
+
+
+async def atransform_query(messages):
+    path = choose_rewrite_path(messages)
+    query = messages[-1].content
+    
+    if path != "rewrite":
+        record_rewrite_path(path)
+        return query
+    
+    start = time.time()
+    new_query = await agenerate_query_transform_prompt(messages)
+    record_rewrite_path(path, rewrite_seconds=time.time() - start)
+    return new_query
+
+
+async def atransform_query_and_retrieve(messages, aretrieve):
+    if not REWRITE_RACE or choose_rewrite_path(messages) != "rewrite":
+        new_query = await atransform_query(messages)
+        return new_query, await aretrieve(new_query)
+    
+    query = messages[-1].content
+    start = time.time()
+    rewrite_task = asyncio.create_task(agenerate_query_transform_prompt(messages))
+    raw_task = asyncio.create_task(atimed_retrieve(aretrieve, query))
+    
+    try:
+        new_query = await asyncio.wait_for(rewrite_task, timeout=REWRITE_RACE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raw_result, retrieve_seconds = await raw_task
+        record_rewrite_path("race_timeout", saved_seconds=REWRITE_RACE_TIMEOUT + retrieve_seconds - (time.time() - start))
+        return query, raw_result
+    
+    rewrite_seconds = time.time() - start
+    
+    if same_query(query, new_query):
+        raw_result, retrieve_seconds = await raw_task
+        record_rewrite_path("race_raw_reused", rewrite_seconds=rewrite_seconds, saved_seconds=rewrite_seconds + retrieve_seconds - (time.time() - start))
+        return query, raw_result
+    
+    raw_task.cancel()
+    record_rewrite_path("rewrite", rewrite_seconds=rewrite_seconds)
+    return new_query, await aretrieve(new_query)
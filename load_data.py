@@ -0,0 +1,354 @@
+from couchbase.auth import PasswordAuthenticator
+from couchbase.cluster import Cluster
+from couchbase.options import ClusterOptions
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from dotenv import load_dotenv
+from local_index import document_key
+import argparse
+import hashlib
+import json
+import os
+import requests
+import threading
+import time
+
+load_dotenv()
+
+
+# streams raw-data.json style files (a json array, or json lines) into main.raw.raw, where the eventing
+# pipeline picks the documents up. documents are read one at a time, keyed by their product_id / email_id
+# (or a hash of their content, so reloading a file doesn't duplicate it), and written with upsert_multi in
+# batches, several batches at a time. --rate caps documents per second and --max-backlog pauses while the
+# reformatting function is behind, so the pipeline isn't flooded. the checkpoint file records how far every
+# input got, and a rerun resumes from there
+LOADER_BATCH_SIZE = int(os.getenv("LOADER_BATCH_SIZE", 500))
+LOADER_CONCURRENCY = int(os.getenv("LOADER_CONCURRENCY", 4))
+LOADER_RATE = float(os.getenv("LOADER_RATE", 0))
+LOADER_MAX_RETRIES = int(os.getenv("LOADER_MAX_RETRIES", 5))
+LOADER_BACKOFF_SECONDS = float(os.getenv("LOADER_BACKOFF_SECONDS", 0.5))
+
+READ_CHUNK_SIZE = 1 << 20
+
+EE_HOSTNAME = os.getenv("EE_HOSTNAME")
+EVENTING_HOSTNAME = os.getenv("EVENTING_HOSTNAME")
+CB_USERNAME = os.getenv("CB_USERNAME")
+CB_PASSWORD = os.getenv("CB_PASSWORD")
+
+
+# a key that stays the same across runs: the document's own id field, or a hash of its content
+def stable_key(document, key_field=None):
+    key = document_key(document, key_field)
+    if key is not None:
+        return key
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+# yields (document, byte offset after it). a json array is parsed one element at a time from a buffer, so
+# only the current chunk and document are in memory; offset resumes a previous read (from a checkpoint)
+def iter_documents(path, offset=0):
+    with open(path, "rb") as file:
+        first = file.read(READ_CHUNK_SIZE).lstrip()[:1]
+        file.seek(offset)
+
+        if first == b"[":
+            yield from iter_array(file, offset)
+        else:
+            yield from iter_lines(file, offset)
+
+
+def iter_lines(file, offset):
+    for line in file:
+        offset += len(line)
+        if line.strip():
+            yield json.loads(line), offset
+
+
+def iter_array(file, offset):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    pending = b""
+    at_start = offset == 0
+    eof = False
+
+    while True:
+        # skip whitespace, the opening bracket and the commas between elements
+        skipped = position
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == "," or (at_start and buffer[position] == "[")):
+            at_start = at_start and buffer[position] != "["
+            position += 1
+        offset += len(buffer[skipped:position].encode("utf-8"))
+
+        if buffer.startswith("]", position):
+            return
+
+        if position < len(buffer):
+            try:
+                document, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                document = None
+
+            # a document that ends exactly at the end of the buffer may be a truncated number, read on
+            if document is not None and (end < len(buffer) or eof):
+                offset += len(buffer[position:end].encode("utf-8"))
+                position = end
+                yield document, offset
+                continue
+
+        if eof:
+            if buffer[position:].strip():
+                raise ValueError(f"unexpected end of {file.name}")
+            return
+
+        chunk = file.read(READ_CHUNK_SIZE)
+        eof = not chunk
+        # a multi-byte character may be split between chunks
+        data = pending + chunk
+        cut = len(data) if eof else utf8_boundary(data)
+        buffer = buffer[position:] + data[:cut].decode("utf-8")
+        position = 0
+        pending = data[cut:]
+
+
+def utf8_boundary(data):
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte < 0x80:
+            return len(data)
+        if byte >= 0xC0:
+            length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) if back >= length else len(data) - back
+    return len(data)
+
+
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_slot - now
+            self.next_slot = max(self.next_slot, now) + count / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# remaining mutations of the eventing function reading main.raw.raw
+def eventing_backlog(function_name):
+    response = requests.get(f"http://{EVENTING_HOSTNAME}:8096/getDcpEventsRemaining", params={"name": function_name},
+                            auth=(CB_USERNAME, CB_PASSWORD), timeout=10)
+    response.raise_for_status()
+    return response.json().get("dcp_backlog", 0)
+
+
+# how far each input file got. batches finish out of order, so an input only advances past a batch once
+# every batch before it is written
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.inputs = {}
+        self.finished = {}
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path, "r") as file:
+                self.inputs = json.load(file)
+
+    def position(self, input_path):
+        return self.inputs.get(os.path.abspath(input_path), {"records": 0, "offset": 0})
+
+    def done(self, input_path, sequence, records, offset):
+        name = os.path.abspath(input_path)
+
+        with self.lock:
+            finished = self.finished.setdefault(name, {"next": 0, "batches": {}})
+            finished["batches"][sequence] = (records, offset)
+
+            advanced = False
+            while finished["next"] in finished["batches"]:
+                records, offset = finished["batches"].pop(finished["next"])
+                self.inputs[name] = {"records": records, "offset": offset}
+                finished["next"] += 1
+                advanced = True
+
+            if advanced:
+                self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.inputs, file)
+        os.replace(temporary, self.path)
+
+
+class Loader:
+
+    def __init__(self, collection, checkpoint, batch_size=LOADER_BATCH_SIZE, concurrency=LOADER_CONCURRENCY, rate=LOADER_RATE,
+                 key_field=None, max_backlog=0, eventing_function="reformatting", max_retries=LOADER_MAX_RETRIES,
+                 backoff_seconds=LOADER_BACKOFF_SECONDS):
+        self.collection = collection
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.key_field = key_field
+        self.max_backlog = max_backlog
+        self.eventing_function = eventing_function
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # at most this many batches read ahead of the writers
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.backlog_checked = 0
+
+    def load(self, paths, progress_seconds=5):
+        start = time.time()
+        last_report = start
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for path in paths:
+                position = self.checkpoint.position(path)
+                if position["records"]:
+                    print(f"Resuming {path} after {position['records']} documents")
+
+                size = os.path.getsize(path)
+                records = position["records"]
+                batch = {}
+                sequence = 0
+                offset = position["offset"]
+
+                for document, offset in iter_documents(path, position["offset"]):
+                    batch[stable_key(document, self.key_field)] = document
+                    records += 1
+
+                    if len(batch) >= self.batch_size:
+                        self.submit(executor, path, sequence, batch, records, offset)
+                        batch = {}
+                        sequence += 1
+
+                    if time.time() - last_report >= progress_seconds:
+                        last_report = time.time()
+                        self.report(start, f"{path} {offset / size:.1%}" if size else path)
+
+                if batch:
+                    self.submit(executor, path, sequence, batch, records, offset)
+
+        self.report(start, "done")
+        return self.written, self.failed
+
+    def submit(self, executor, path, sequence, batch, records, offset):
+        self.wait_for_eventing()
+        self.limiter.acquire(len(batch))
+        self.slots.acquire()
+        executor.submit(self.write, path, sequence, batch, records, offset)
+
+    def write(self, path, sequence, batch, records, offset):
+        try:
+            failed = self.upsert_with_retries(batch)
+            with self.lock:
+                self.written += len(batch) - len(failed)
+                self.failed += len(failed)
+            for key, error in failed.items():
+                print(f"Giving up writing {key}: {error}")
+            # failed documents are reported, not retried on resume, so one bad document can't block the checkpoint
+            self.checkpoint.done(path, sequence, records, offset)
+        except Exception as e:
+            print(f"Error writing batch {sequence} of {path}: {e}")
+        finally:
+            self.slots.release()
+
+    def upsert_with_retries(self, documents):
+        for attempt in range(self.max_retries + 1):
+            try:
+                failed = self.collection.upsert_multi(documents).exceptions
+            except Exception as e:
+                failed = {key: e for key in documents}
+
+            if not failed:
+                return {}
+
+            documents = {key: documents[key] for key in failed}
+            if attempt < self.max_retries:
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+
+        return failed
+
+    def wait_for_eventing(self, poll_seconds=2):
+        if not self.max_backlog or time.time() - self.backlog_checked < poll_seconds:
+            return
+
+        while True:
+            self.backlog_checked = time.time()
+            try:
+                backlog = eventing_backlog(self.eventing_function)
+            except Exception as e:
+                print(f"Could not read the eventing backlog, not pausing: {e}")
+                return
+            if backlog <= self.max_backlog:
+                return
+            print(f"Eventing backlog of {self.eventing_function} is {backlog}, waiting")
+            time.sleep(poll_seconds)
+
+    def report(self, start, where):
+        elapsed = time.time() - start
+        with self.lock:
+            written, failed = self.written, self.failed
+        print(f"{written} documents written, {failed} failed, {written / elapsed if elapsed else 0:.0f}/s ({where})")
+
+
+def connect(capella):
+    auth = PasswordAuthenticator(CB_USERNAME, CB_PASSWORD)
+
+    if capella:
+        options = ClusterOptions(auth)
+        options.apply_profile('wan_development')
+        cluster = Cluster('couchbases://{}'.format(os.getenv("CB_HOSTNAME")), options)
+    else:
+        cluster = Cluster(f'couchbase://{EE_HOSTNAME}', ClusterOptions(auth))
+
+    cluster.wait_until_ready(timedelta(seconds=5))
+    return cluster
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="load raw-data.json style documents into main.raw.raw")
+    parser.add_argument('input', nargs='+', help='json array or json lines files')
+    parser.add_argument('--capella', action='store_true', default=False, help='if the environment is Capella')
+    parser.add_argument('--scope', default='raw')
+    parser.add_argument('--collection', default='raw')
+    parser.add_argument('--key-field', default=None, help='field holding the document key, product_id / email_id otherwise')
+    parser.add_argument('--batch-size', type=int, default=LOADER_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=LOADER_CONCURRENCY, help='batches written at the same time')
+    parser.add_argument('--rate', type=float, default=LOADER_RATE, help='documents per second, 0 for no limit')
+    parser.add_argument('--max-backlog', type=int, default=0, help='pause while the eventing function has more mutations to process, 0 to not check')
+    parser.add_argument('--eventing-function', default='reformatting')
+    parser.add_argument('--checkpoint', default='./load_data.checkpoint.json', help='progress file, a rerun resumes from it')
+    parser.add_argument('--restart', action='store_true', default=False, help='ignore the checkpoint and load everything again')
+    parser.add_argument('--progress-seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    cluster = connect(args.capella)
+    collection = cluster.bucket("main").scope(args.scope).collection(args.collection)
+
+    loader = Loader(collection, Checkpoint(args.checkpoint), batch_size=args.batch_size, concurrency=args.concurrency, rate=args.rate,
+                    key_field=args.key_field, max_backlog=args.max_backlog, eventing_function=args.eventing_function)
+    written, failed = loader.load(args.input, args.progress_seconds)
+
+    print(f"Loaded {written} documents into main.{args.scope}.{args.collection}, {failed} failed")
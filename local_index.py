@@ -0,0 +1,322 @@
+from retriever import Retriever, TYPE_COLLECTIONS
+from vector_encoding import decode_vector
+import argparse
+import json
+import numpy as np
+import os
+import time
+
+
+# process-local alternative to embedding-index for local development, CI and edge deployments.
+# vectors are one float32 C-contiguous matrix scored with a single matrix-vector product. optionally an IVF
+# coarse quantizer limits scoring to the nprobe closest lists, and product quantization keeps only uint8
+# codes in memory and re-scores the best rerank_factor x k candidates against the full vectors. a saved
+# index is memory-mapped on load, so startup doesn't read the matrix into memory. both trade recall for
+# speed: "local_index.py bench --sweep" reports recall@k against exact search for nprobe and rerank_factor
+class LocalVectorRetriever(Retriever):
+
+    def __init__(self, ids, documents, vectors, ivf_centroids=None, ivf_lists=None, pq_codebooks=None, pq_codes=None,
+                 nprobe=4, rerank_factor=16, **kwargs):
+        super().__init__(**kwargs)
+        self.ids = ids
+        self.documents = documents
+        self.vectors = vectors
+        self.collections_of = np.array([document.get("collection", "") for document in documents])
+        self.ivf_centroids = ivf_centroids
+        self.ivf_lists = ivf_lists
+        self.pq_codebooks = pq_codebooks
+        self.pq_codes = pq_codes
+        self.nprobe = nprobe
+        self.rerank_factor = rerank_factor
+
+    def retrieve(self, vector, query_text, collections=None):
+        return self.finish(self.search(vector, collections), query_text)
+
+    def search(self, vector, collections=None):
+        query = np.asarray(vector, dtype=np.float32)
+        candidates = self.candidates(query, collections or self.collections)
+        if len(candidates) == 0:
+            return []
+
+        if self.pq_codes is not None:
+            # approximate scores from the codes, then exact scores for the best few
+            approximate = self.pq_scores(query, candidates)
+            candidates = candidates[top_k(approximate, self.k * self.rerank_factor)]
+
+        scores = self.vectors[candidates] @ query
+        best = candidates[top_k(scores, self.k)]
+        return [(self.ids[row], self.documents[row]) for row in best]
+
+    def candidates(self, query, collections):
+        if self.ivf_centroids is not None:
+            probed = top_k(self.ivf_centroids @ query, self.nprobe)
+            rows = np.flatnonzero(np.isin(self.ivf_lists, probed))
+        else:
+            rows = np.arange(len(self.ids))
+
+        if collections:
+            rows = rows[np.isin(self.collections_of[rows], collections)]
+        return rows
+
+    def pq_scores(self, query, rows):
+        subvectors = query.reshape(len(self.pq_codebooks), -1)
+        # dot products of every query subvector with every centroid of its subspace
+        table = np.einsum("msd,md->ms", self.pq_codebooks, subvectors)
+        return table[np.arange(len(self.pq_codebooks)), self.pq_codes[rows]].sum(axis=1)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(self.vectors, dtype=np.float32))
+
+        if self.ivf_centroids is not None:
+            np.save(os.path.join(path, "ivf_centroids.npy"), self.ivf_centroids)
+            np.save(os.path.join(path, "ivf_lists.npy"), self.ivf_lists)
+
+        if self.pq_codes is not None:
+            np.save(os.path.join(path, "pq_codebooks.npy"), self.pq_codebooks)
+            np.save(os.path.join(path, "pq_codes.npy"), self.pq_codes)
+
+        with open(os.path.join(path, "documents.json"), "w") as file:
+            json.dump({"ids": self.ids, "documents": self.documents}, file)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        optional = lambda name: np.load(os.path.join(path, name), mmap_mode="r") if os.path.exists(os.path.join(path, name)) else None
+
+        with open(os.path.join(path, "documents.json"), "r") as file:
+            stored = json.load(file)
+
+        return cls(
+            stored["ids"],
+            stored["documents"],
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            ivf_centroids=optional("ivf_centroids.npy"),
+            ivf_lists=optional("ivf_lists.npy"),
+            pq_codebooks=optional("pq_codebooks.npy"),
+            pq_codes=optional("pq_codes.npy"),
+            **kwargs,
+        )
+
+    @classmethod
+    def build(cls, ids, documents, vectors, ivf_lists=0, pq_subvectors=0, **kwargs):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ivf_centroids = ivf_assignments = pq_codebooks = pq_codes = None
+
+        if ivf_lists:
+            ivf_centroids, ivf_assignments = kmeans(vectors, ivf_lists)
+
+        if pq_subvectors:
+            if vectors.shape[1] % pq_subvectors:
+                raise ValueError(f"{vectors.shape[1]} dimensions can't be split into {pq_subvectors} subvectors")
+            subspaces = vectors.reshape(len(vectors), pq_subvectors, -1)
+            trained = [kmeans(subspaces[:, m, :], 256, normalise=False) for m in range(pq_subvectors)]
+            pq_codebooks = np.stack([pad_codebook(centroids, 256) for centroids, _ in trained])
+            pq_codes = np.stack([assignments for _, assignments in trained], axis=1).astype(np.uint8)
+
+        return cls(ids, documents, vectors, ivf_centroids, ivf_assignments, pq_codebooks, pq_codes, **kwargs)
+
+
+def top_k(scores, k):
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+def kmeans(vectors, clusters, iterations=10, normalise=True, seed=0):
+    clusters = min(clusters, len(vectors))
+    random = np.random.default_rng(seed)
+    centroids = vectors[random.choice(len(vectors), clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        if normalise:
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+        else:
+            distances = (vectors ** 2).sum(axis=1, keepdims=True) - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)
+            assignments = np.argmin(distances, axis=1)
+
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+
+        if normalise:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+    return centroids.astype(np.float32), assignments.astype(np.int32)
+
+
+def pad_codebook(centroids, size):
+    padded = np.zeros((size, centroids.shape[1]), dtype=np.float32)
+    padded[:len(centroids)] = centroids
+    return padded
+
+
+# same assembly as the embedding eventing function
+def assemble_for_embedding(document):
+    if "product_id" in document or document.get("type") == "insurance_product":
+        fields = ["product_name", "product_overview", "product_promotion_details", "product_eligibles", "product_details", "product_exclusions"]
+        return ".  ".join(str(document.get(field, "")) for field in fields)
+    return document.get("content", "")
+
+
+def document_key(document, key_field):
+    for field in [key_field, "_id", "id", "product_id", "email_id"]:
+        if field and field in document:
+            return str(document[field])
+    return None
+
+
+def read_documents(path):
+    with open(path, "r") as file:
+        text = file.read().strip()
+
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+# reads a cbexport of main.data (json lines or array, with embeddings in any EMBEDDING_ENCODING) or raw-data.json style
+# documents, which are embedded the same way the eventing function does it
+def load_corpus(paths, key_field=None):
+    ids = []
+    documents = []
+    vectors = []
+    to_embed = []
+
+    for path in paths:
+        for document in read_documents(path):
+            key = document_key(document, key_field)
+            if key is None:
+                continue
+
+            collection = TYPE_COLLECTIONS.get(document.get("type"), "products" if "product_id" in document else "policies")
+            text = document.get("assembled_for_embedding") or assemble_for_embedding(document)
+
+            ids.append(key)
+            documents.append({"assembled_for_embedding": text, "source": document.get("source"), "from": document.get("from"), "collection": collection})
+            vectors.append(None if document.get("embedding") is None else decode_vector(document["embedding"]))
+            if document.get("embedding") is None:
+                to_embed.append(len(vectors) - 1)
+
+    if to_embed:
+        from llm import create_openai_embeddings_batch
+        print(f"Embedding {len(to_embed)} documents..")
+        for row, embedding in zip(to_embed, create_openai_embeddings_batch([documents[row]["assembled_for_embedding"] for row in to_embed])):
+            vectors[row] = embedding
+
+    return ids, documents, np.asarray(vectors, dtype=np.float32)
+
+
+# the query latencies of retriever in ms
+def benchmark(retriever, queries, repeat, search=None):
+    search = search or retriever.search
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            search(query)
+            latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return dict(p50_ms=float(np.percentile(latencies, 50)), p95_ms=float(np.percentile(latencies, 95)), p99_ms=float(np.percentile(latencies, 99)))
+
+
+# the fraction of the reference top k ids a search returns, averaged over the queries
+def recall(search, queries, reference):
+    found = [{id for id, _ in search(query)} for query in queries]
+    return float(np.mean([len(ids & expected) / len(expected) for ids, expected in zip(found, reference) if expected]))
+
+
+# the same vectors scored exactly, without IVF or PQ
+def exact_retriever(retriever):
+    return LocalVectorRetriever(retriever.ids, retriever.documents, retriever.vectors, k=retriever.k)
+
+
+# stored vectors moved by noise (relative to their norm) in a random direction, so a query isn't its own
+# nearest neighbour and doesn't always fall in its own IVF list
+def sample_queries(vectors, count, noise, seed=0):
+    random = np.random.default_rng(seed)
+    queries = np.asarray(vectors[random.choice(len(vectors), min(count, len(vectors)), replace=False)], dtype=np.float32)
+    directions = random.standard_normal(queries.shape).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    queries = queries + noise * np.linalg.norm(queries, axis=1, keepdims=True) * directions
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def report(name, latency, recall_at_k=None, k=None):
+    quality = f", recall@{k} {recall_at_k:.3f}" if recall_at_k is not None else ""
+    print(f"{name:36} p50 {latency['p50_ms']:.3f} ms, p95 {latency['p95_ms']:.3f} ms, p99 {latency['p99_ms']:.3f} ms{quality}")
+
+
+# latency and recall@k of the index against exact search over the same vectors, optionally over a grid of
+# nprobe and rerank_factor values, and against embedding-index with compare_couchbase
+def bench(retriever, queries, repeat, sweep=False, couchbase=None):
+    exact = exact_retriever(retriever)
+    reference = [{id for id, _ in exact.search(query)} for query in queries]
+    print(f"{len(queries)} queries x {repeat} over {len(retriever.ids)} vectors, k {retriever.k}")
+
+    results = dict(exact=dict(benchmark(exact, queries, repeat), recall=1.0))
+    report("exact", results["exact"])
+
+    if retriever.ivf_centroids is not None or retriever.pq_codes is not None:
+        name = f"nprobe {retriever.nprobe}, rerank_factor {retriever.rerank_factor}"
+        results[name] = dict(benchmark(retriever, queries, repeat), recall=recall(retriever.search, queries, reference))
+        report(name, results[name], results[name]["recall"], retriever.k)
+
+    if sweep and (retriever.ivf_centroids is not None or retriever.pq_codes is not None):
+        lists = len(retriever.ivf_centroids) if retriever.ivf_centroids is not None else 1
+        nprobes = sorted({min(2 ** power, lists) for power in range(int(np.log2(lists)) + 2)}) if retriever.ivf_centroids is not None else [retriever.nprobe]
+        rerank_factors = [1, 4, 16, 64] if retriever.pq_codes is not None else [retriever.rerank_factor]
+        for nprobe in nprobes:
+            for rerank_factor in rerank_factors:
+                retriever.nprobe, retriever.rerank_factor = nprobe, rerank_factor
+                name = f"nprobe {nprobe}, rerank_factor {rerank_factor}"
+                results[name] = dict(benchmark(retriever, queries, max(1, repeat // 10)), recall=recall(retriever.search, queries, reference))
+                report(name, results[name], results[name]["recall"], retriever.k)
+
+    if couchbase is not None:
+        search = lambda query: couchbase.vector_search(query.tolist())[:retriever.k]
+        results["embedding-index"] = dict(benchmark(couchbase, queries, max(1, repeat // 10), search), recall=recall(search, queries, reference))
+        report("embedding-index", results["embedding-index"], results["embedding-index"]["recall"], retriever.k)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="build, or benchmark, the local vector index")
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('--input', nargs='+', default=['./templates/assets/raw-data.json'], help='main.data exports or raw-data.json style files')
+    parser.add_argument('--key-field', default=None, help='field holding the document key in the input')
+    parser.add_argument('--output', default='./local-index', help='directory of the saved index')
+    parser.add_argument('--ivf-lists', type=int, default=0, help='number of IVF lists, 0 for exact search')
+    parser.add_argument('--pq-subvectors', type=int, default=0, help='number of PQ subvectors, 0 to keep full vectors only')
+    parser.add_argument('--nprobe', type=int, default=4)
+    parser.add_argument('--rerank-factor', type=int, default=16, help='PQ candidates re-scored exactly, as a multiple of k')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--noise', type=float, default=0.1, help='how far queries are moved from the stored vectors they are sampled from')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--sweep', action='store_true', default=False, help='also measure a grid of nprobe and rerank_factor values')
+    parser.add_argument('--compare-couchbase', action='store_true', default=False, help='also query embedding-index with the same vectors')
+    parser.add_argument('--capella', action='store_true', default=False, help='if the environment is Capella')
+    parser.add_argument('--report', default=None, help='write the results as json')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        ids, documents, vectors = load_corpus(args.input, args.key_field)
+        LocalVectorRetriever.build(ids, documents, vectors, ivf_lists=args.ivf_lists, pq_subvectors=args.pq_subvectors).save(args.output)
+        print(f"Saved local index of {len(ids)} documents to {args.output}")
+
+    else:
+        retriever = LocalVectorRetriever.load(args.output, nprobe=args.nprobe, rerank_factor=args.rerank_factor, k=args.k)
+        couchbase = None
+        if args.compare_couchbase:
+            from load_data import connect
+            from retriever import CouchbaseRetriever
+            couchbase = CouchbaseRetriever(connect(args.capella), k=args.k, num_candidates=max(args.k, 10))
+
+        results = bench(retriever, sample_queries(retriever.vectors, args.queries, args.noise), args.repeat, args.sweep, couchbase)
+        if args.report:
+            with open(args.report, "w") as file:
+                json.dump(results, file, indent=2)
@@ -0,0 +1,284 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+load_dotenv()
+
+
+# process-wide counters and histograms rendered in the prometheus text format on /metrics, and per request
+# traces written as one json log line each. recording a value is a dict lookup and a few additions under a
+# lock, so it stays on at full load; METRICS_TRACE_SAMPLE_RATE thins out the trace log lines if needed
+METRICS_TRACE_LOG = os.getenv("METRICS_TRACE_LOG", "true").lower() == "true"
+METRICS_TRACE_SAMPLE_RATE = float(os.getenv("METRICS_TRACE_SAMPLE_RATE", 1.0))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# operational messages (fallbacks, evictions, errors) of every module go to "chatbot.<module>" loggers at LOG_LEVEL
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("chatbot")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def get_logger(name):
+    return logger.getChild(name)
+
+
+trace_logger = logging.getLogger("chatbot.trace")
+if not trace_logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [(f"{self.name}{format_labels(zip(self.labelnames, key))}", value) for key, value in values.items()]
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + [f"{name} {value}" for name, value in self.samples()]
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label values: the count of every bucket (the last one is +Inf), the sum and the count
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in values.items():
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # collect() yields (name, type, help, [(labels dict, value), ...]) for metrics kept elsewhere,
+    # like the rewrite and tagging counters
+    def register_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        for collect in self.collectors:
+            for name, type, help, samples in collect():
+                lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {type}"])
+                lines.extend(f"{name}{format_labels(sorted(labels.items()))} {value}" for labels, value in samples)
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("chatbot_stage_seconds", "Duration of the stages of the chat and enrichment pipelines", ["stage"])
+couchbase_operation_seconds = registry.histogram("chatbot_couchbase_operation_seconds", "Duration of Couchbase operations", ["operation"])
+couchbase_operation_errors = registry.counter("chatbot_couchbase_operation_errors_total", "Couchbase operations that raised", ["operation"])
+openai_tokens = registry.counter("chatbot_openai_tokens_total", "OpenAI tokens by model and kind (prompt or completion)", ["model", "kind"])
+cache_requests = registry.counter("chatbot_cache_requests_total", "Cache lookups by cache and result (hit or miss)", ["cache", "result"])
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+# the stages of one request. spans from threads the request hands work to aren't attached to it (thread
+# pools don't copy the context), they're still counted in the stage histogram
+class Trace:
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.id = uuid.uuid4().hex
+        self.fields = fields
+        self.spans = {}
+        self.start = time.perf_counter()
+        self.token = None
+        self.finished = False
+
+    def add_span(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    # only the first call counts, handlers also call it on the way out of an error
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        duration = self.elapsed()
+        stage_seconds.observe(duration, stage=self.name)
+
+        if self.token is not None:
+            current_trace.reset(self.token)
+            self.token = None
+
+        if METRICS_TRACE_LOG and random.random() < METRICS_TRACE_SAMPLE_RATE:
+            trace_logger.info(json.dumps({
+                "trace": self.name,
+                "trace_id": self.id,
+                "duration_ms": round(duration * 1000, 3),
+                "spans_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.spans.items()},
+                **self.fields,
+            }, default=str))
+
+
+def start_trace(name, **fields):
+    trace = Trace(name, **fields)
+    trace.token = current_trace.set(trace)
+    return trace
+
+
+# adds fields to the log line of the current trace, if there is one
+def annotate(**fields):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+# decorates a function, or coroutine function, to record its duration as a pipeline stage
+def timed_stage(stage):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# exceptions in expected, like a missing document on a lookup, aren't counted as errors
+@contextmanager
+def couchbase_operation(operation, expected=()):
+    start = time.perf_counter()
+    try:
+        yield
+    except expected:
+        raise
+    except Exception:
+        couchbase_operation_errors.inc(operation=operation)
+        raise
+    finally:
+        couchbase_operation_seconds.observe(time.perf_counter() - start, operation=operation)
+
+
+
+def record_tokens(model, prompt_tokens=0, completion_tokens=0):
+    if prompt_tokens:
+        openai_tokens.inc(prompt_tokens, model=model, kind="prompt")
+    if completion_tokens:
+        openai_tokens.inc(completion_tokens, model=model, kind="completion")
+
+
+def record_cache(cache, hit, count=1):
+    if count:
+        cache_requests.inc(count, cache=cache, result="hit" if hit else "miss")
+
+
+def render_metrics():
+    return registry.render()
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,272 @@
+from couchbase.kv_range_scan import RangeScan, SamplingScan
+from couchbase.options import ScanOptions, MutateInOptions
+import couchbase.subdocument as SD
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from load_data import connect, RateLimiter, CB_USERNAME, CB_PASSWORD
+from provisioning import search_index_built, wait_until, CB_SEARCH_PORT
+from vector_encoding import ENCODINGS, INDEX_FIELD_TYPES, EMBEDDING_ENCODING, encode_vector, decode_vector, vector_encoding, encoded_size, index_definition
+import argparse
+import json
+import numpy as np
+import os
+import requests
+import sys
+import threading
+import time
+
+load_dotenv()
+
+
+# re-encodes the embeddings already stored in main.data to another encoding (see vector_encoding.py), in
+# place. documents are listed with a range scan and only their "embedding" path is read and written, with
+# sub-document operations under the document's cas, so a document changed meanwhile is left alone and the
+# rest of it isn't sent. the eventing functions see the mutations and skip them, the embedded text is the
+# same. a search index only indexes the vectors of the encoding it's typed for, so an indexed encoding is
+# migrated to in three steps, none of them leaving documents out of what the app searches:
+#   1. --create-index creates embedding-index-<encoding> next to embedding-index and waits until it's built
+#   2. the app is restarted with EMBEDDING_ENCODING=<encoding> and RETRIEVER_INDEX_NAME=embedding-index-<encoding>,embedding-index,
+#      it searches both and every document is in one of them while it's converted
+#   3. the migration re-encodes the documents, waits until the new index holds as many documents as the old
+#      one, and with --drop-old-index drops it, RETRIEVER_INDEX_NAME is then the new index alone
+# the report has the bytes the embeddings took before and after and, with --queries, the vector search
+# latency against the old index before and the new one after. the latency after isn't measured, and the old
+# index isn't dropped, if the new index doesn't hold every document
+MIGRATION_CONCURRENCY = int(os.getenv("MIGRATION_CONCURRENCY", 16))
+MIGRATION_POLL_SECONDS = float(os.getenv("MIGRATION_POLL_SECONDS", 5))
+
+SEARCH_HOSTNAME = os.getenv("SEARCH_HOSTNAME")
+SEARCH_URL = f"http://{SEARCH_HOSTNAME}:{CB_SEARCH_PORT}/api"
+
+
+class Migration:
+
+    def __init__(self, scope, collections, encoding, concurrency=MIGRATION_CONCURRENCY, rate=0, dry_run=False):
+        self.scope = scope
+        self.collections = collections
+        self.encoding = encoding
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.lock = threading.Lock()
+        self.stats = {collection: dict(documents=0, migrated=0, unchanged=0, failed=0, bytes_before=0, bytes_after=0) for collection in collections}
+
+    def run(self, progress_seconds=5):
+        start = time.time()
+        last_report = start
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for name in self.collections:
+                collection = self.scope.collection(name)
+                for item in collection.scan(RangeScan(), ScanOptions(ids_only=True, concurrency=4)):
+                    self.limiter.acquire(1)
+                    self.slots.acquire()
+                    executor.submit(self.migrate, collection, name, item.id)
+
+                    if time.time() - last_report >= progress_seconds:
+                        last_report = time.time()
+                        self.report(start, name)
+
+        self.report(start, "done")
+        return self.summary()
+
+    def migrate(self, collection, name, key):
+        try:
+            result = collection.lookup_in(key, [SD.get("embedding")])
+            if not result.exists(0):
+                return
+            value = result.content_as[lambda content: content](0)
+            encoded = value if vector_encoding(value) == self.encoding else encode_vector(decode_vector(value), self.encoding)
+            changed = encoded is not value
+
+            if changed and not self.dry_run:
+                collection.mutate_in(key, [SD.upsert("embedding", encoded)], MutateInOptions(cas=result.cas))
+
+            with self.lock:
+                stats = self.stats[name]
+                stats["documents"] += 1
+                stats["migrated" if changed else "unchanged"] += 1
+                stats["bytes_before"] += encoded_size(value)
+                stats["bytes_after"] += encoded_size(encoded)
+
+        except Exception as e:
+            print(f"Error migrating {name}/{key}: {e}")
+            with self.lock:
+                self.stats[name]["failed"] += 1
+        finally:
+            self.slots.release()
+
+    def report(self, start, where):
+        elapsed = time.time() - start
+        with self.lock:
+            documents = sum(stats["documents"] for stats in self.stats.values())
+            saved = sum(stats["bytes_before"] - stats["bytes_after"] for stats in self.stats.values())
+        print(f"{documents} embeddings {'checked' if self.dry_run else 'migrated'}, {saved / 1e6:.1f} MB saved, "
+              f"{documents / elapsed if elapsed else 0:.0f}/s ({where})")
+
+    def summary(self):
+        with self.lock:
+            collections = {name: dict(stats) for name, stats in self.stats.items()}
+        before = sum(stats["bytes_before"] for stats in collections.values())
+        after = sum(stats["bytes_after"] for stats in collections.values())
+        return dict(
+            encoding=self.encoding,
+            dry_run=self.dry_run,
+            collections=collections,
+            bytes_before=before,
+            bytes_after=after,
+            bytes_saved=before - after,
+            saved_ratio=(before - after) / before if before else 0.0,
+        )
+
+
+# the embeddings of a random sample of documents, as query vectors
+def sample_vectors(collection, count):
+    return [decode_vector(item.content_as[dict]["embedding"]) for item in collection.scan(SamplingScan(count, seed=0))
+            if "embedding" in item.content_as[dict]]
+
+
+def vector_search_latency(cluster, vectors, index_name, repeat=3):
+    from retriever import CouchbaseRetriever
+
+    retriever = CouchbaseRetriever(cluster, index_name=index_name)
+    latencies = []
+    for _ in range(repeat):
+        for vector in vectors:
+            start = time.perf_counter()
+            retriever.vector_search(vector.tolist())
+            latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return dict(queries=len(latencies), p50_ms=float(np.percentile(latencies, 50)), p95_ms=float(np.percentile(latencies, 95)))
+
+
+def index_url(index_name):
+    return f"{SEARCH_URL}/bucket/main/scope/data/index/{index_name}"
+
+
+def index_exists(index_name):
+    return requests.get(index_url(index_name), auth=(CB_USERNAME, CB_PASSWORD), timeout=10).status_code == 200
+
+
+def index_built(index_name):
+    response = requests.get(f"{SEARCH_URL}/stats/index/main.data.{index_name}", auth=(CB_USERNAME, CB_PASSWORD), timeout=10)
+    response.raise_for_status()
+    return search_index_built(response.json())
+
+
+def index_count(index_name):
+    response = requests.get(index_url(index_name) + "/count", auth=(CB_USERNAME, CB_PASSWORD), timeout=10)
+    response.raise_for_status()
+    return response.json().get("count", 0)
+
+
+# the fts-index.json definition typed for encoding as index_name, next to the existing index, and waits until
+# it's built
+def create_index(index_name, encoding, timeout_seconds):
+    if index_exists(index_name):
+        print(f"{index_name} exists")
+    else:
+        with open('./templates/assets/fts-index.json', 'r') as file:
+            definition = index_definition(json.load(file), encoding)
+        definition["name"] = index_name
+
+        response = requests.put(index_url(index_name), auth=(CB_USERNAME, CB_PASSWORD), json=definition, timeout=30)
+        response.raise_for_status()
+        print(f"{index_name} created for {encoding} vectors, waiting for it to be built")
+
+    wait_until(lambda: index_built(index_name), timeout_seconds, MIGRATION_POLL_SECONDS)
+
+
+# whether the new index caught up with the migrated documents: built, and holding as many documents as the
+# old one. returns the counts and, if it didn't, why
+def verify_index(new_index, old_index, timeout_seconds):
+    deadline = time.time() + timeout_seconds
+
+    while True:
+        built = index_built(new_index)
+        counts = dict(new_index=index_count(new_index), old_index=index_count(old_index))
+        if built and counts["new_index"] == counts["old_index"]:
+            return dict(counts, verified=True, error=None)
+
+        print(f"{new_index}: {counts['new_index']} documents indexed, {old_index}: {counts['old_index']}")
+        if time.time() >= deadline:
+            error = f"{new_index} {'holds' if built else 'is still building with'} {counts['new_index']} documents, {old_index} {counts['old_index']}"
+            return dict(counts, verified=False, error=error)
+        time.sleep(MIGRATION_POLL_SECONDS)
+
+
+def drop_index(index_name):
+    response = requests.delete(index_url(index_name), auth=(CB_USERNAME, CB_PASSWORD), timeout=30)
+    response.raise_for_status()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="re-encode the embeddings stored in main.data")
+    parser.add_argument('--to', dest='encoding', choices=list(ENCODINGS), default=EMBEDDING_ENCODING, help='target encoding, EMBEDDING_ENCODING by default')
+    parser.add_argument('--capella', action='store_true', default=False, help='if the environment is Capella')
+    parser.add_argument('--collections', nargs='+', default=['products', 'policies', 'chunks'])
+    parser.add_argument('--concurrency', type=int, default=MIGRATION_CONCURRENCY, help='documents migrated at the same time')
+    parser.add_argument('--rate', type=float, default=0, help='documents per second, 0 for no limit')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='only report the bytes that would be saved')
+    parser.add_argument('--create-index', action='store_true', default=False, help='only create the index for the target encoding and wait until it is built')
+    parser.add_argument('--index-name', default=None, help='the index for the target encoding, embedding-index-<encoding> by default')
+    parser.add_argument('--old-index', default='embedding-index', help='the index the app searches now')
+    parser.add_argument('--drop-old-index', action='store_true', default=False, help='drop the old index once the new one holds every document')
+    parser.add_argument('--index-timeout', type=float, default=600, help='seconds to wait for an index build')
+    parser.add_argument('--queries', type=int, default=0, help='vector searches to time before and after, 0 to skip')
+    parser.add_argument('--report', default=None, help='write the report as json')
+    parser.add_argument('--progress-seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    indexed = INDEX_FIELD_TYPES[args.encoding] is not None
+    new_index = args.index_name or f"embedding-index-{args.encoding}"
+
+    if (args.create_index or args.drop_old_index) and not indexed:
+        parser.error(f"the search service can't index {args.encoding} vectors")
+
+    if args.create_index:
+        create_index(new_index, args.encoding, args.index_timeout)
+        print(f"{new_index} is built. restart the app with EMBEDDING_ENCODING={args.encoding} and "
+              f"RETRIEVER_INDEX_NAME={new_index},{args.old_index}, then run the migration")
+        sys.exit(0)
+
+    # re-encoded documents drop out of the old index, the new one has to be there to take them
+    if indexed and not args.dry_run and not index_exists(new_index):
+        parser.error(f"{new_index} doesn't exist, create it with --create-index first")
+
+    cluster = connect(args.capella)
+    scope = cluster.bucket("main").scope("data")
+
+    queries = sample_vectors(scope.collection(args.collections[0]), args.queries) if args.queries else []
+    latency_before = vector_search_latency(cluster, queries, args.old_index) if queries else None
+    if latency_before:
+        print(f"vector search before: {latency_before}")
+
+    migration = Migration(scope, args.collections, args.encoding, concurrency=args.concurrency, rate=args.rate, dry_run=args.dry_run)
+    report = migration.run(args.progress_seconds)
+    report["latency_before"] = latency_before
+    verified = not indexed or args.dry_run
+
+    if indexed and not args.dry_run:
+        report["index"] = verify_index(new_index, args.old_index, args.index_timeout)
+        failed = sum(stats["failed"] for stats in report["collections"].values())
+        verified = report["index"]["verified"] and failed == 0
+
+        if not verified:
+            print(f"not switching over: {report['index']['error'] or f'{failed} documents failed to migrate, rerun the migration'}")
+        elif queries:
+            report["latency_after"] = vector_search_latency(cluster, queries, new_index)
+
+        if verified and args.drop_old_index:
+            drop_index(args.old_index)
+            print(f"{args.old_index} dropped, set RETRIEVER_INDEX_NAME={new_index}")
+
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if not verified:
+        sys.exit(1)
@@ -0,0 +1,288 @@
+from langchain_openai import ChatOpenAI
+from metrics import registry, record_tokens, get_logger
+from openai_scheduler import scheduler, priority_for, estimate_tokens
+from dotenv import load_dotenv
+import asyncio
+import openai
+import os
+import threading
+import time
+
+load_dotenv()
+
+
+def parse_mapping(value, cast=str):
+    mapping = {}
+    for item in (value or "").split(","):
+        if ":" in item:
+            key, _, mapped = item.partition(":")
+            mapping[key.strip()] = cast(mapped.strip())
+    return mapping
+
+
+# the models a client may ask for in the "model" field of a socket message, and the defaults
+CHAT_MODELS = [model.strip() for model in os.getenv("CHAT_MODELS", "gpt-4o,gpt-4o-mini,gpt-3.5-turbo").split(",") if model.strip()]
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o")
+REWRITE_MODEL = os.getenv("REWRITE_MODEL", "gpt-4o-mini")
+
+# the model tried next when one times out, is rate limited or has no free slot, e.g. "gpt-4o:gpt-4o-mini"
+MODEL_FALLBACKS = parse_mapping(os.getenv("MODEL_FALLBACKS", "gpt-4o:gpt-4o-mini,gpt-4o-mini:gpt-3.5-turbo,gpt-4:gpt-4o"))
+
+# requests in flight per model and process, e.g. "gpt-4o:16", others get MODEL_DEFAULT_CONCURRENCY
+MODEL_CONCURRENCY = parse_mapping(os.getenv("MODEL_CONCURRENCY"), int)
+MODEL_DEFAULT_CONCURRENCY = int(os.getenv("MODEL_DEFAULT_CONCURRENCY", 32))
+
+# seconds to wait for a free slot before falling back, and for a response before it counts as a timeout
+MODEL_QUEUE_TIMEOUT = float(os.getenv("MODEL_QUEUE_TIMEOUT", 2))
+MODEL_REQUEST_TIMEOUT = float(os.getenv("MODEL_REQUEST_TIMEOUT", 30))
+
+# USD per million prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "text-embedding-ada-002": (0.1, 0.0),
+}
+
+model_latency_seconds = registry.histogram("chatbot_model_latency_seconds", "Duration of chat model calls by model and purpose", ["model", "purpose"])
+model_requests = registry.counter("chatbot_model_requests_total", "Chat model calls by model and result (ok, fallback or error)", ["model", "result"])
+model_cost = registry.counter("chatbot_model_cost_usd_total", "Estimated chat model cost in USD", ["model"])
+model_fallbacks = registry.counter("chatbot_model_fallbacks_total", "Chat model calls handed to the fallback model, by model, fallback and error",
+                                   ["model", "fallback", "error"])
+
+logger = get_logger("model_router")
+
+model_metrics = {}
+model_metrics_lock = threading.Lock()
+
+
+class ModelBusy(Exception):
+    pass
+
+
+# errors worth retrying on another model, anything else is raised
+FALLBACK_ERRORS = (ModelBusy, openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def model_stats(model):
+    return model_metrics.setdefault(model, dict(calls=0, fallbacks=0, errors=0, seconds=0.0, prompt_tokens=0, completion_tokens=0, cost=0.0))
+
+
+def record_model_call(model, purpose, seconds, result):
+    model_latency_seconds.observe(seconds, model=model, purpose=purpose)
+    model_requests.inc(model=model, result=result)
+
+    with model_metrics_lock:
+        metrics = model_stats(model)
+        metrics["calls"] += 1
+        metrics["seconds"] += seconds
+        if result == "fallback":
+            metrics["fallbacks"] += 1
+        elif result == "error":
+            metrics["errors"] += 1
+
+
+def record_fallback(model, error):
+    model_fallbacks.inc(model=model, fallback=MODEL_FALLBACKS[model], error=type(error).__name__)
+    logger.warning("%s failed with %s, falling back to %s", model, type(error).__name__, MODEL_FALLBACKS[model])
+
+
+def record_usage(model, prompt_tokens=0, completion_tokens=0):
+    record_tokens(model, prompt_tokens, completion_tokens)
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+    model_cost.inc(cost, model=model)
+
+    with model_metrics_lock:
+        metrics = model_stats(model)
+        metrics["prompt_tokens"] += prompt_tokens
+        metrics["completion_tokens"] += completion_tokens
+        metrics["cost"] += cost
+
+
+def response_usage(response):
+    return getattr(response, "response_metadata", {}).get("token_usage") or {}
+
+
+def record_response_usage(model, response):
+    usage = response_usage(response)
+    record_usage(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+
+def get_model_metrics():
+    with model_metrics_lock:
+        return {
+            model: dict(
+                calls=metrics["calls"],
+                fallbacks=metrics["fallbacks"],
+                errors=metrics["errors"],
+                average_seconds=metrics["seconds"] / metrics["calls"] if metrics["calls"] else 0.0,
+                prompt_tokens=metrics["prompt_tokens"],
+                completion_tokens=metrics["completion_tokens"],
+                cost=metrics["cost"],
+            )
+            for model, metrics in model_metrics.items()
+        }
+
+
+# one ChatOpenAI per model and process, shared by every request. calls go through run/arun (one
+# response) or stream/astream (chunks); each takes a slot of the model's concurrency limit and moves on
+# to the fallback model on a timeout, a rate limit or when no slot frees up in time. a stream only falls
+# back before its first chunk. with a slot, the call still waits for a permit of the process-wide OpenAI
+# scheduler, at the priority of its purpose
+class ModelRouter:
+
+    def __init__(self, temperature=0.05):
+        self.temperature = temperature
+        self.models = {}
+        self.slots = {}
+        self.async_slots = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, model, default=CHAT_MODEL):
+        return model if model in CHAT_MODELS else default
+
+    def chat_model(self, model):
+        with self.lock:
+            if model not in self.models:
+                self.models[model] = ChatOpenAI(model=model, temperature=self.temperature, timeout=MODEL_REQUEST_TIMEOUT, max_retries=0)
+                self.slots[model] = threading.BoundedSemaphore(MODEL_CONCURRENCY.get(model, MODEL_DEFAULT_CONCURRENCY))
+            return self.models[model]
+
+    def async_slot(self, model):
+        self.chat_model(model)
+        if model not in self.async_slots:
+            self.async_slots[model] = asyncio.Semaphore(MODEL_CONCURRENCY.get(model, MODEL_DEFAULT_CONCURRENCY))
+        return self.async_slots[model]
+
+    # the model and its fallbacks, without cycles
+    def candidates(self, model):
+        models = []
+        while model and model not in models:
+            models.append(model)
+            model = MODEL_FALLBACKS.get(model)
+        return models
+
+    def run(self, build, inputs, model, purpose):
+        candidates = self.candidates(model)
+        for candidate in candidates:
+            last = candidate == candidates[-1]
+            chain = build(self.chat_model(candidate))
+            start = time.time()
+
+            try:
+                if not self.slots[candidate].acquire(timeout=MODEL_QUEUE_TIMEOUT):
+                    raise ModelBusy(candidate)
+                try:
+                    with scheduler.request(priority_for(purpose), estimate_tokens(inputs)) as ticket:
+                        response = chain.invoke(inputs)
+                        ticket.used(response_usage(response).get("total_tokens"))
+                finally:
+                    self.slots[candidate].release()
+
+            except FALLBACK_ERRORS as e:
+                record_model_call(candidate, purpose, time.time() - start, "error" if last else "fallback")
+                if last:
+                    raise
+                record_fallback(candidate, e)
+                continue
+
+            record_model_call(candidate, purpose, time.time() - start, "ok")
+            return candidate, response
+
+    async def arun(self, build, inputs, model, purpose):
+        candidates = self.candidates(model)
+        for candidate in candidates:
+            last = candidate == candidates[-1]
+            chain = build(self.chat_model(candidate))
+            slot = self.async_slot(candidate)
+            start = time.time()
+
+            try:
+                try:
+                    await asyncio.wait_for(slot.acquire(), MODEL_QUEUE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise ModelBusy(candidate)
+                try:
+                    async with scheduler.arequest(priority_for(purpose), estimate_tokens(inputs)) as ticket:
+                        response = await chain.ainvoke(inputs)
+                        ticket.used(response_usage(response).get("total_tokens"))
+                finally:
+                    slot.release()
+
+            except FALLBACK_ERRORS as e:
+                record_model_call(candidate, purpose, time.time() - start, "error" if last else "fallback")
+                if last:
+                    raise
+                record_fallback(candidate, e)
+                continue
+
+            record_model_call(candidate, purpose, time.time() - start, "ok")
+            return candidate, response
+
+    # yields (model, chunk) pairs
+    def stream(self, build, inputs, model, purpose):
+        candidates = self.candidates(model)
+        for candidate in candidates:
+            last = candidate == candidates[-1]
+            chain = build(self.chat_model(candidate))
+            start = time.time()
+            started = False
+
+            try:
+                if not self.slots[candidate].acquire(timeout=MODEL_QUEUE_TIMEOUT):
+                    raise ModelBusy(candidate)
+                try:
+                    with scheduler.request(priority_for(purpose), estimate_tokens(inputs)):
+                        for chunk in chain.stream(inputs):
+                            started = True
+                            yield candidate, chunk
+                finally:
+                    self.slots[candidate].release()
+
+            except FALLBACK_ERRORS as e:
+                record_model_call(candidate, purpose, time.time() - start, "error" if last or started else "fallback")
+                if last or started:
+                    raise
+                record_fallback(candidate, e)
+                continue
+
+            record_model_call(candidate, purpose, time.time() - start, "ok")
+            return
+
+    async def astream(self, build, inputs, model, purpose):
+        candidates = self.candidates(model)
+        for candidate in candidates:
+            last = candidate == candidates[-1]
+            chain = build(self.chat_model(candidate))
+            slot = self.async_slot(candidate)
+            start = time.time()
+            started = False
+
+            try:
+                try:
+                    await asyncio.wait_for(slot.acquire(), MODEL_QUEUE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise ModelBusy(candidate)
+                try:
+                    async with scheduler.arequest(priority_for(purpose), estimate_tokens(inputs)):
+                        async for chunk in chain.astream(inputs):
+                            started = True
+                            yield candidate, chunk
+                finally:
+                    slot.release()
+
+            except FALLBACK_ERRORS as e:
+                record_model_call(candidate, purpose, time.time() - start, "error" if last or started else "fallback")
+                if last or started:
+                    raise
+                record_fallback(candidate, e)
+                continue
+
+            record_model_call(candidate, purpose, time.time() - start, "ok")
+            return
+
+
+router = ModelRouter()
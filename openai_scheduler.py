@@ -0,0 +1,362 @@
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque
+from dotenv import load_dotenv
+from metrics import registry
+import asyncio
+import openai
+import os
+import threading
+import time
+import tiktoken
+
+load_dotenv()
+
+
+# every OpenAI call of the process, chat and embeddings, interactive and enrichment, waits here for a
+# permit. permits go out in priority order while the requests/min and tokens/min buckets have room and
+# fewer calls than the concurrency limit are in flight. a 429 halves the limit and pauses the queue for the
+# retry-after time, every success adds 1/limit back (AIMD). background work has a deadline: it's shed with
+# SchedulerShed when the deadline passes in the queue, or straight away when the tokens queued ahead of it
+# can't be sent before it. the limits are per process, with several worker processes divide the account
+# limits between them
+PRIORITIES = ["interactive", "background"]
+INTERACTIVE, BACKGROUND = PRIORITIES
+
+# router purposes that aren't waiting on a user
+BACKGROUND_PURPOSES = {"pii"}
+
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 3000))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", 300000))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 64))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", 2))
+
+# seconds background work may wait for a permit before it's shed
+OPENAI_BACKGROUND_DEADLINE = float(os.getenv("OPENAI_BACKGROUND_DEADLINE", 60))
+
+# retries of a rate limited call, and the pause after a 429 without a retry-after header
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", 2))
+OPENAI_RATE_LIMIT_PAUSE = float(os.getenv("OPENAI_RATE_LIMIT_PAUSE", 1))
+
+# completion tokens counted against the tokens/min bucket for a chat call, until its usage is known
+OPENAI_COMPLETION_TOKENS = int(os.getenv("OPENAI_COMPLETION_TOKENS", 500))
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+queue_wait_seconds = registry.histogram("chatbot_openai_queue_wait_seconds", "Time OpenAI calls waited for a scheduler permit by priority", ["priority"])
+shed_requests = registry.counter("chatbot_openai_shed_total", "OpenAI calls shed by the scheduler by priority", ["priority"])
+rate_limited_requests = registry.counter("chatbot_openai_rate_limited_total", "OpenAI calls answered with a 429 by priority", ["priority"])
+
+
+class SchedulerShed(Exception):
+    pass
+
+
+def priority_for(purpose):
+    return BACKGROUND if purpose in BACKGROUND_PURPOSES else INTERACTIVE
+
+
+# prompt tokens of chain inputs (strings, messages, documents, nested in dicts and lists) plus the completion
+def estimate_tokens(inputs, completion_tokens=OPENAI_COMPLETION_TOKENS):
+
+    def texts(value):
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, dict):
+            for item in value.values():
+                yield from texts(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                yield from texts(item)
+        else:
+            yield from texts(getattr(value, "page_content", getattr(value, "content", "")))
+
+    return sum(len(encoding.encode(text)) for text in texts(inputs)) + completion_tokens
+
+
+def retry_after(error):
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return OPENAI_RATE_LIMIT_PAUSE
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until amount is available, a request larger than the bucket waits for a full one
+    def wait_time(self, amount, now):
+        return self.backlog_time(min(amount, self.capacity), now)
+
+    # seconds until amount has been refilled, for the work queued ahead
+    def backlog_time(self, amount, now):
+        self.refill(now)
+        return max(0.0, amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+
+class Ticket:
+
+    def __init__(self, priority, tokens, deadline, wake):
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.shed = False
+        self.released = False
+        self.used_tokens = None
+
+    # the tokens the call actually used, the bucket is corrected on release
+    def used(self, tokens):
+        self.used_tokens = tokens
+
+
+class OpenAIScheduler:
+
+    def __init__(self, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+                 max_concurrency=OPENAI_MAX_CONCURRENCY, min_concurrency=OPENAI_MIN_CONCURRENCY, background_deadline=OPENAI_BACKGROUND_DEADLINE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.background_deadline = background_deadline
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.stats = {priority: dict(requests=0, shed=0, rate_limited=0, wait_seconds=0.0, max_wait_seconds=0.0) for priority in PRIORITIES}
+        self.condition = threading.Condition()
+        self.dispatcher = None
+
+    def default_deadline(self, priority):
+        return time.monotonic() + self.background_deadline if priority == BACKGROUND else None
+
+    def enqueue(self, priority, tokens, deadline, wake):
+        ticket = Ticket(priority, tokens, deadline, wake)
+
+        with self.condition:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.run, name="openai-scheduler", daemon=True)
+                self.dispatcher.start()
+
+            if deadline is not None and ticket.enqueued + self.expected_wait(ticket) > deadline:
+                self.shed(ticket)
+                return ticket
+
+            self.queues[priority].append(ticket)
+            self.condition.notify()
+        return ticket
+
+    # the bucket time needed for everything queued at the same or a higher priority, and the ticket itself
+    def expected_wait(self, ticket):
+        now = time.monotonic()
+        ahead = [queued for priority in PRIORITIES[:PRIORITIES.index(ticket.priority) + 1] for queued in self.queues[priority]]
+        return max(
+            self.paused_until - now,
+            self.requests.backlog_time(len(ahead) + 1, now),
+            self.tokens.backlog_time(sum(min(queued.tokens, self.tokens.capacity) for queued in ahead + [ticket]), now),
+        )
+
+    def shed(self, ticket):
+        ticket.shed = True
+        self.stats[ticket.priority]["shed"] += 1
+        shed_requests.inc(priority=ticket.priority)
+        ticket.wake()
+
+    def run(self):
+        with self.condition:
+            while True:
+                self.condition.wait(self.dispatch())
+
+    # grants what can be granted now, returns the seconds until the next permit or deadline, None to wait
+    # for an enqueue or a release
+    def dispatch(self):
+        now = time.monotonic()
+        wait = None
+
+        for queue in self.queues.values():
+            for ticket in [ticket for ticket in queue if ticket.deadline is not None and ticket.deadline <= now]:
+                queue.remove(ticket)
+                self.shed(ticket)
+
+        while self.in_flight < int(self.limit):
+            queue = next((queue for queue in self.queues.values() if queue), None)
+            if queue is None:
+                break
+
+            ticket = queue[0]
+            wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(ticket.tokens, now))
+            if wait > 0:
+                break
+
+            wait = None
+            queue.popleft()
+            self.grant(ticket, now)
+
+        deadlines = [ticket.deadline - now for queue in self.queues.values() for ticket in queue if ticket.deadline is not None]
+        return min([wait] + deadlines if wait is not None else deadlines, default=None)
+
+    def grant(self, ticket, now):
+        self.requests.take(1)
+        self.tokens.take(min(ticket.tokens, self.tokens.capacity))
+        self.in_flight += 1
+        ticket.granted = True
+
+        waited = now - ticket.enqueued
+        stats = self.stats[ticket.priority]
+        stats["requests"] += 1
+        stats["wait_seconds"] += waited
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        queue_wait_seconds.observe(waited, priority=ticket.priority)
+        ticket.wake()
+
+    def release(self, ticket, ok=True, rate_limited_for=None):
+        with self.condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+
+            if ticket.used_tokens is not None:
+                self.tokens.take(ticket.used_tokens - min(ticket.tokens, self.tokens.capacity))
+
+            if rate_limited_for is not None:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + rate_limited_for)
+                self.stats[ticket.priority]["rate_limited"] += 1
+                rate_limited_requests.inc(priority=ticket.priority)
+                print(f"OpenAI rate limited, concurrency limit {int(self.limit)}, pausing for {rate_limited_for}s")
+            elif ok:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.condition.notify()
+
+    # a waiter that gave up: out of the queue, or its permit back if it was granted meanwhile
+    def cancel(self, ticket):
+        with self.condition:
+            if ticket in self.queues[ticket.priority]:
+                self.queues[ticket.priority].remove(ticket)
+                return
+        if ticket.granted:
+            self.release(ticket, ok=False)
+
+    def acquire(self, priority, tokens, deadline=None):
+        event = threading.Event()
+        ticket = self.enqueue(priority, tokens, deadline or self.default_deadline(priority), event.set)
+        event.wait()
+
+        if ticket.shed:
+            raise SchedulerShed(f"{priority} OpenAI call shed after waiting {time.monotonic() - ticket.enqueued:.1f}s")
+        return ticket
+
+    async def aacquire(self, priority, tokens, deadline=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = self.enqueue(priority, tokens, deadline or self.default_deadline(priority), wake)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+
+        if ticket.shed:
+            raise SchedulerShed(f"{priority} OpenAI call shed after waiting {time.monotonic() - ticket.enqueued:.1f}s")
+        return ticket
+
+    # holds a permit for the body, a 429 raised in it slows the scheduler down
+    @contextmanager
+    def request(self, priority, tokens, deadline=None):
+        ticket = self.acquire(priority, tokens, deadline)
+        try:
+            yield ticket
+        except openai.RateLimitError as e:
+            self.release(ticket, rate_limited_for=retry_after(e))
+            raise
+        except BaseException:
+            self.release(ticket, ok=False)
+            raise
+        self.release(ticket)
+
+    @asynccontextmanager
+    async def arequest(self, priority, tokens, deadline=None):
+        ticket = await self.aacquire(priority, tokens, deadline)
+        try:
+            yield ticket
+        except openai.RateLimitError as e:
+            self.release(ticket, rate_limited_for=retry_after(e))
+            raise
+        except BaseException:
+            self.release(ticket, ok=False)
+            raise
+        self.release(ticket)
+
+    # call() with a permit, queued again on a 429 up to OPENAI_RATE_LIMIT_RETRIES times within one deadline
+    def call(self, function, priority, tokens):
+        deadline = self.default_deadline(priority)
+        for attempt in range(OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                with self.request(priority, tokens, deadline):
+                    return function()
+            except openai.RateLimitError:
+                if attempt == OPENAI_RATE_LIMIT_RETRIES:
+                    raise
+
+    async def acall(self, function, priority, tokens):
+        deadline = self.default_deadline(priority)
+        for attempt in range(OPENAI_RATE_LIMIT_RETRIES + 1):
+            try:
+                async with self.arequest(priority, tokens, deadline):
+                    return await function()
+            except openai.RateLimitError:
+                if attempt == OPENAI_RATE_LIMIT_RETRIES:
+                    raise
+
+    def get_metrics(self):
+        with self.condition:
+            return dict(
+                concurrency_limit=int(self.limit),
+                in_flight=self.in_flight,
+                paused_seconds=max(0.0, self.paused_until - time.monotonic()),
+                queues={
+                    priority: dict(
+                        waiting=len(self.queues[priority]),
+                        requests=stats["requests"],
+                        shed=stats["shed"],
+                        rate_limited=stats["rate_limited"],
+                        average_wait_seconds=stats["wait_seconds"] / stats["requests"] if stats["requests"] else 0.0,
+                        max_wait_seconds=stats["max_wait_seconds"],
+                    )
+                    for priority, stats in self.stats.items()
+                },
+            )
+
+    def collect(self):
+        current = self.get_metrics()
+        yield ("chatbot_openai_queue_depth", "gauge", "OpenAI calls waiting for a scheduler permit by priority",
+               [({"priority": priority}, queue["waiting"]) for priority, queue in current["queues"].items()])
+        yield ("chatbot_openai_in_flight", "gauge", "OpenAI calls holding a scheduler permit", [({}, current["in_flight"])])
+        yield ("chatbot_openai_concurrency_limit", "gauge", "Current adaptive OpenAI concurrency limit", [({}, current["concurrency_limit"])])
+
+
+scheduler = OpenAIScheduler()
+registry.register_collector(scheduler.collect)
+
+
+def get_scheduler_metrics():
+    return scheduler.get_metrics()
@@ -0,0 +1,432 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from vector_encoding import index_definition, EMBEDDING_ENCODING
+import base64
+import json
+import os
+import re
+import requests
+import threading
+import time
+
+load_dotenv()
+
+
+# the environment as a graph of resources (buckets, scopes, collections, eventing functions, the query
+# index, the search index), each with an existence check, a create call and a readiness check, and the
+# resources it needs. a step starts as soon as every step it depends on is ready, independent steps run
+# at the same time over one pooled HTTP session. a resource that already exists isn't created again, so a
+# rerun only creates what's missing and waits for what isn't ready yet. readiness is polled (bucket
+# warmup, collection manifests, function deployment, index builds) up to PROVISION_READY_TIMEOUT seconds
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", 8))
+PROVISION_READY_TIMEOUT = float(os.getenv("PROVISION_READY_TIMEOUT", 300))
+PROVISION_POLL_SECONDS = float(os.getenv("PROVISION_POLL_SECONDS", 1))
+
+EE_HOSTNAME = os.getenv("EE_HOSTNAME")
+EVENTING_HOSTNAME = os.getenv("EVENTING_HOSTNAME")
+SEARCH_HOSTNAME = os.getenv("SEARCH_HOSTNAME")
+CB_USERNAME = os.getenv("CB_USERNAME")
+CB_PASSWORD = os.getenv("CB_PASSWORD")
+CHATBOT_APP_END_POINT = os.getenv("CHATBOT_APP_END_POINT")
+# the search index setupothers.py creates is the first one the retriever searches, embedding-index-base64
+# once migrate_vectors.py switched it over
+SEARCH_INDEX_NAME = os.getenv("RETRIEVER_INDEX_NAME", "embedding-index").split(",")[0].strip()
+
+# the service ports, other values point the setup at benchmark/fake_management.py
+CB_MANAGEMENT_PORT = int(os.getenv("CB_MANAGEMENT_PORT", 8091))
+CB_QUERY_PORT = int(os.getenv("CB_QUERY_PORT", 8093))
+CB_SEARCH_PORT = int(os.getenv("CB_SEARCH_PORT", 8094))
+CB_EVENTING_PORT = int(os.getenv("CB_EVENTING_PORT", 8096))
+
+CAPELLA_BASEURL = "https://cloudapi.cloud.couchbase.com"
+
+# bucket: (ram quota in MB, {scope: [collections]})
+DATA_STRUCTURES = {
+    "main": (2000, {
+        "raw": ["raw", "formatted", "batches"],
+        "data": ["products", "policies", "chunks"],
+        "chats": ["human", "bot", "sessions"],
+        "cache": ["answers"],
+    }),
+    "meta": (1000, {}),
+}
+
+EVENTING_FUNCTIONS = ["reformatting", "metadata_labelling", "embedding", "cache_invalidation"]
+
+QUERY_INDEXES = {
+    "idx_answers_document_ids": ("main", "cache", "answers", "CREATE INDEX IF NOT EXISTS idx_answers_document_ids ON `main`.`cache`.`answers`(DISTINCT ARRAY id FOR id IN document_ids END)"),
+}
+
+# cache_invalidation looks up cached answers through the query index
+EXTRA_DEPENDENCIES = {
+    "eventing cache_invalidation": ["query index idx_answers_document_ids"],
+}
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class Step:
+
+    def __init__(self, name, create=None, exists=None, ready=None, depends=()):
+        self.name = name
+        self.create = create
+        self.exists = exists
+        self.ready = ready
+        self.depends = list(depends)
+
+
+# GETs are retried on connection errors and 5xx, creates aren't: they're guarded by the existence checks
+def pooled_session(workers=PROVISION_WORKERS, auth=None, headers=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers,
+                          max_retries=Retry(total=3, backoff_factor=0.2, allowed_methods=["GET"], status_forcelist=[502, 503, 504]))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.auth = auth
+    session.headers.update(headers or {})
+    return session
+
+
+def check(response, *ok):
+    if response.status_code in ok:
+        return response
+    # created meanwhile, by another run
+    if response.status_code in (400, 409) and "already exist" in response.text.lower():
+        return response
+    raise ProvisioningError(f"{response.request.method} {response.url}: {response.status_code} {response.text[:300]}")
+
+
+# from the search service's index stats: every partition of the index exists and has indexed all the
+# mutations it received from the source collections. the count endpoint answers long before that
+def search_index_built(stats):
+    target = stats.get("num_pindexes_target", 0)
+    return target > 0 and stats.get("num_pindexes_actual", 0) >= target and stats.get("num_mutations_to_index", 1) == 0
+
+
+def wait_until(ready, timeout=PROVISION_READY_TIMEOUT, poll_seconds=PROVISION_POLL_SECONDS):
+    deadline = time.time() + timeout
+    last_error = None
+
+    while True:
+        try:
+            if ready():
+                return
+            last_error = None
+        except (requests.RequestException, ProvisioningError, KeyError, ValueError) as e:
+            last_error = e
+
+        if time.time() >= deadline:
+            raise ProvisioningError(f"not ready after {timeout:.0f}s" + (f": {last_error}" if last_error else ""))
+        time.sleep(min(poll_seconds, max(0.0, deadline - time.time())))
+
+
+class Provisioner:
+
+    def __init__(self, steps, workers=PROVISION_WORKERS, ready_timeout=PROVISION_READY_TIMEOUT, poll_seconds=PROVISION_POLL_SECONDS):
+        self.steps = {step.name: step for step in steps}
+        self.workers = workers
+        self.ready_timeout = ready_timeout
+        self.poll_seconds = poll_seconds
+        self.print_lock = threading.Lock()
+        self.validate()
+
+    def validate(self):
+        for step in self.steps.values():
+            for name in step.depends:
+                if name not in self.steps:
+                    raise ValueError(f"{step.name} depends on unknown step {name}")
+
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in visiting:
+                raise ValueError(f"dependency cycle through {name}")
+            if name not in done:
+                visiting.add(name)
+                for dependency in self.steps[name].depends:
+                    visit(dependency)
+                visiting.discard(name)
+                done.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    # returns {name: {"status", "start", "seconds", "ready_seconds", "error"}}, status is created, exists,
+    # failed or blocked (a dependency failed)
+    def run(self):
+        self.started = time.time()
+        results = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(results) < len(self.steps):
+                progressed = False
+                for name, step in self.steps.items():
+                    if name in results or name in running.values():
+                        continue
+                    statuses = [results[dependency]["status"] if dependency in results else None for dependency in step.depends]
+                    if any(status in ("failed", "blocked") for status in statuses):
+                        results[name] = dict(status="blocked", start=None, seconds=0.0, ready_seconds=0.0, error=None)
+                        self.log(f"{name}: blocked by a failed dependency")
+                        progressed = True
+                    elif all(status is not None for status in statuses):
+                        running[executor.submit(self.execute, step)] = name
+                        progressed = True
+
+                # the next steps can only start once a running one finishes
+                if running:
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        results[running.pop(future)] = future.result()
+                elif not progressed:
+                    pending = [name for name in self.steps if name not in results]
+                    raise ProvisioningError(f"no step can start, waiting on each other: {', '.join(pending)}")
+
+        self.elapsed = time.time() - self.started
+        return results
+
+    def execute(self, step):
+        start = time.time()
+        result = dict(status="exists", start=start - self.started, seconds=0.0, ready_seconds=0.0, error=None)
+
+        try:
+            if step.exists is None or not step.exists():
+                if step.create is not None:
+                    step.create()
+                result["status"] = "created"
+
+            created = time.time()
+            if step.ready is not None:
+                wait_until(step.ready, self.ready_timeout, self.poll_seconds)
+            result["ready_seconds"] = time.time() - created
+            self.log(f"{step.name}: {result['status']}")
+
+        except Exception as e:
+            result.update(status="failed", error=str(e))
+            self.log(f"{step.name}: failed, {e}")
+
+        result["seconds"] = time.time() - start
+        return result
+
+    def log(self, message):
+        with self.print_lock:
+            print(message)
+
+    def report(self, results):
+        print(f"\n{'step':48} {'status':8} {'start':>8} {'seconds':>8} {'ready':>8}")
+        for name, result in sorted(results.items(), key=lambda item: item[1]["start"] if item[1]["start"] is not None else float("inf")):
+            start = f"{result['start']:.2f}" if result["start"] is not None else "-"
+            print(f"{name:48} {result['status']:8} {start:>8} {result['seconds']:8.2f} {result['ready_seconds']:8.2f}")
+
+        busy = sum(result["seconds"] for result in results.values())
+        print(f"{len(results)} steps in {self.elapsed:.2f}s ({busy:.2f}s of step time)")
+        return all(result["status"] in ("created", "exists") for result in results.values())
+
+
+# buckets, scopes and collections through the cluster's REST API
+class ServerManagement:
+
+    def __init__(self, session, hostname=EE_HOSTNAME):
+        self.session = session
+        self.url = f"http://{hostname}:{CB_MANAGEMENT_PORT}/pools/default/buckets"
+
+    def bucket_exists(self, bucket):
+        return self.session.get(f"{self.url}/{bucket}").status_code == 200
+
+    def create_bucket(self, bucket, ram_quota):
+        check(self.session.post(self.url, data={"name": bucket, "ramQuota": ram_quota, "bucketType": "couchbase", "flushEnabled": 1}), 200, 202)
+
+    # warmed up on every node
+    def bucket_ready(self, bucket):
+        nodes = check(self.session.get(f"{self.url}/{bucket}"), 200).json().get("nodes", [])
+        return bool(nodes) and all(node.get("status") == "healthy" for node in nodes)
+
+    def scopes(self, bucket):
+        response = self.session.get(f"{self.url}/{bucket}/scopes")
+        if response.status_code == 404:
+            return {}
+        return {scope["name"]: [collection["name"] for collection in scope.get("collections", [])] for scope in check(response, 200).json()["scopes"]}
+
+    def create_scope(self, bucket, scope):
+        check(self.session.post(f"{self.url}/{bucket}/scopes", data={"name": scope}), 200)
+
+    def create_collection(self, bucket, scope, collection):
+        check(self.session.post(f"{self.url}/{bucket}/scopes/{scope}/collections", data={"name": collection}), 200)
+
+
+# the same through the Capella management API, where buckets are addressed by id
+class CapellaManagement:
+
+    def __init__(self, session, org_id=os.getenv("ORG_ID"), project_id=os.getenv("PROJECT_ID"), cluster_id=os.getenv("CLUSTER_ID")):
+        self.session = session
+        self.url = f"{CAPELLA_BASEURL}/v4/organizations/{org_id}/projects/{project_id}/clusters/{cluster_id}/buckets"
+
+    def bucket_id(self, bucket):
+        return base64.b64encode(bucket.encode("utf-8")).decode("ascii")
+
+    def bucket_exists(self, bucket):
+        return self.session.get(f"{self.url}/{self.bucket_id(bucket)}").status_code == 200
+
+    def create_bucket(self, bucket, ram_quota):
+        check(self.session.post(self.url, json={
+            "name": bucket,
+            "type": "couchbase",
+            "storageBackend": "couchstore",
+            "memoryAllocationInMb": ram_quota,
+            "bucketConflictResolution": "seqno",
+            "replicas": 1,
+            "flush": True,
+        }), 201)
+
+    def bucket_ready(self, bucket):
+        return self.bucket_exists(bucket)
+
+    def scopes(self, bucket):
+        response = self.session.get(f"{self.url}/{self.bucket_id(bucket)}/scopes")
+        if response.status_code == 404:
+            return {}
+        return {scope["name"]: [collection["name"] for collection in scope.get("collections", [])] for scope in check(response, 200).json()["scopes"]}
+
+    def create_scope(self, bucket, scope):
+        check(self.session.post(f"{self.url}/{self.bucket_id(bucket)}/scopes", json={"name": scope}), 201)
+
+    def create_collection(self, bucket, scope, collection):
+        check(self.session.post(f"{self.url}/{self.bucket_id(bucket)}/scopes/{scope}/collections", json={"name": collection}), 201)
+
+
+def management(capella, workers=PROVISION_WORKERS):
+    if capella:
+        return CapellaManagement(pooled_session(workers, headers={"Authorization": f"Bearer {os.getenv('CAPELLA_API_KEY_TOKEN')}"}))
+    return ServerManagement(pooled_session(workers, auth=(CB_USERNAME, CB_PASSWORD)))
+
+
+def bucket_step(bucket):
+    return f"bucket {bucket}"
+
+
+def scope_step(bucket, scope):
+    return f"scope {bucket}.{scope}"
+
+
+def collection_step(bucket, scope, collection):
+    return f"collection {bucket}.{scope}.{collection}"
+
+
+def data_structure_steps(manager, structures=DATA_STRUCTURES):
+    steps = []
+
+    for bucket, (ram_quota, scopes) in structures.items():
+        steps.append(Step(
+            bucket_step(bucket),
+            create=lambda bucket=bucket, ram_quota=ram_quota: manager.create_bucket(bucket, ram_quota),
+            exists=lambda bucket=bucket: manager.bucket_exists(bucket),
+            ready=lambda bucket=bucket: manager.bucket_ready(bucket),
+        ))
+
+        for scope, collections in scopes.items():
+            steps.append(Step(
+                scope_step(bucket, scope),
+                create=lambda bucket=bucket, scope=scope: manager.create_scope(bucket, scope),
+                exists=lambda bucket=bucket, scope=scope: scope in manager.scopes(bucket),
+                ready=lambda bucket=bucket, scope=scope: scope in manager.scopes(bucket),
+                depends=[bucket_step(bucket)],
+            ))
+
+            for collection in collections:
+                has_collection = lambda bucket=bucket, scope=scope, collection=collection: collection in manager.scopes(bucket).get(scope, [])
+                steps.append(Step(
+                    collection_step(bucket, scope, collection),
+                    create=lambda bucket=bucket, scope=scope, collection=collection: manager.create_collection(bucket, scope, collection),
+                    exists=has_collection,
+                    ready=has_collection,
+                    depends=[scope_step(bucket, scope)],
+                ))
+
+    return steps
+
+
+# the steps of the keyspace (bucket, scope, collection), "*" and _default stand for what contains them
+def keyspace_steps(bucket, scope, collection, structures=DATA_STRUCTURES):
+    if scope in ("*", "_default", None):
+        return [bucket_step(bucket)]
+    if collection in ("*", "_default", None):
+        return [collection_step(bucket, scope, name) for name in structures[bucket][1].get(scope, [])] or [scope_step(bucket, scope)]
+    return [collection_step(bucket, scope, collection)]
+
+
+def read_function(function_name):
+    with open(f'./templates/assets/eventing/{function_name}.json', 'r') as file:
+        data_str = json.dumps(json.load(file))
+    # the curl bindings point at this app
+    if CHATBOT_APP_END_POINT:
+        data_str = re.sub(r"ec2-.+?\.com", CHATBOT_APP_END_POINT, data_str)
+    return json.loads(data_str)
+
+
+def function_dependencies(definition):
+    function = definition[0] if isinstance(definition, list) else definition
+    config = function["depcfg"]
+    keyspaces = [
+        (config["source_bucket"], config["source_scope"], config["source_collection"]),
+        (config["metadata_bucket"], config["metadata_scope"], config["metadata_collection"]),
+    ] + [(binding["bucket_name"], binding.get("scope_name"), binding.get("collection_name")) for binding in config.get("buckets", [])]
+    return list(dict.fromkeys(step for keyspace in keyspaces for step in keyspace_steps(*keyspace)))
+
+
+# eventing functions, the query index and the search index of setupothers.py
+def service_steps(session):
+    eventing = f"http://{EVENTING_HOSTNAME}:{CB_EVENTING_PORT}/api/v1"
+    query = f"http://{EE_HOSTNAME}:{CB_QUERY_PORT}/query/service"
+    search = f"http://{SEARCH_HOSTNAME}:{CB_SEARCH_PORT}/api/bucket/main/scope/data/index/{SEARCH_INDEX_NAME}"
+    search_stats = f"http://{SEARCH_HOSTNAME}:{CB_SEARCH_PORT}/api/stats/index/main.data.{SEARCH_INDEX_NAME}"
+    steps = []
+
+    def function_status(function_name):
+        apps = check(session.get(f"{eventing}/status"), 200).json().get("apps") or []
+        return next((app.get("composite_status") for app in apps if app.get("name") == function_name), None)
+
+    for function_name in EVENTING_FUNCTIONS:
+        definition = read_function(function_name)
+        name = f"eventing {function_name}"
+        steps.append(Step(
+            name,
+            create=lambda function_name=function_name, definition=definition: check(session.post(f"{eventing}/functions/{function_name}", json=definition), 200),
+            exists=lambda function_name=function_name: session.get(f"{eventing}/functions/{function_name}").status_code == 200,
+            ready=lambda function_name=function_name: function_status(function_name) == "deployed",
+            depends=function_dependencies(definition) + EXTRA_DEPENDENCIES.get(name, []),
+        ))
+
+    def run_query(statement):
+        return check(session.post(query, data={"statement": statement}), 200).json().get("results", [])
+
+    def index_state(index_name, bucket, scope, collection):
+        states = run_query(f'SELECT RAW state FROM system:indexes WHERE name = "{index_name}" AND bucket_id = "{bucket}" '
+                           f'AND scope_id = "{scope}" AND keyspace_id = "{collection}"')
+        return states[0] if states else None
+
+    for index_name, (bucket, scope, collection, statement) in QUERY_INDEXES.items():
+        steps.append(Step(
+            f"query index {index_name}",
+            create=lambda statement=statement: run_query(statement),
+            exists=lambda keyspace=(index_name, bucket, scope, collection): index_state(*keyspace) is not None,
+            ready=lambda keyspace=(index_name, bucket, scope, collection): index_state(*keyspace) == "online",
+            depends=[collection_step(bucket, scope, collection)],
+        ))
+
+    with open('./templates/assets/fts-index.json', 'r') as file:
+        # the vector fields are typed for the EMBEDDING_ENCODING the app stores
+        fts_index = dict(index_definition(json.load(file), EMBEDDING_ENCODING), name=SEARCH_INDEX_NAME)
+
+    steps.append(Step(
+        f"search index {SEARCH_INDEX_NAME}",
+        create=lambda: check(session.put(search, json=fts_index), 200),
+        exists=lambda: session.get(search).status_code == 200,
+        ready=lambda: search_index_built(check(session.get(search_stats), 200).json()),
+        depends=[step for type_name in fts_index["params"]["mapping"]["types"] for step in keyspace_steps(fts_index["sourceName"], *type_name.split("."))],
+    ))
+
+    return steps
@@ -0,0 +1,153 @@
+from dotenv import load_dotenv
+import math
+import numpy as np
+import os
+import re
+import tiktoken
+import zlib
+
+load_dotenv()
+
+
+# optional stage between retrieval and generation, CPU only: the retriever over-fetches RERANK_CANDIDATES
+# documents, they're reranked by a blend of their vector search rank and a BM25 score against the query
+# (idf over the candidates), near-duplicates whose word shingles are mostly contained in a better ranked
+# document (MinHash estimate) are dropped, and every kept document longer than RERANK_DOCUMENT_MAX_TOKENS is
+# cut down to its sentences that best match the query, in their original order. the retriever's context
+# budget applies after that. off by default: with OpenAI embeddings ranking the candidates the defaults cut
+# the benchmark's prompt tokens by 63.5% but its fact recall from 0.75 to 0.56, the compression drops
+# sentences the answer needs. enable it only where benchmark/rerank.py --openai holds fact recall on your questions
+RERANK = os.getenv("RERANK", "false").lower() == "true"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 20))
+RERANK_VECTOR_WEIGHT = float(os.getenv("RERANK_VECTOR_WEIGHT", 0.5))
+RERANK_DUPLICATE_THRESHOLD = float(os.getenv("RERANK_DUPLICATE_THRESHOLD", 0.8))
+RERANK_DOCUMENT_MAX_TOKENS = int(os.getenv("RERANK_DOCUMENT_MAX_TOKENS", 400))
+
+MINHASH_PRIME = (1 << 31) - 1
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+# crude suffix stripping so "claims" matches "claim" and "delayed" matches "delay" in the BM25 scores
+def terms(text):
+    return [stem(word) for word in words(text)]
+
+
+def stem(word):
+    for suffix in ("ing", "ed", "es", "s"):
+        if word.endswith(suffix) and len(word) > len(suffix) + 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def sentences(text):
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
+
+
+def bm25_scores(query_terms, documents_terms, k1=1.2, b=0.75):
+    count = len(documents_terms)
+    average_length = sum(len(terms) for terms in documents_terms) / count or 1.0
+    frequencies = [{} for _ in documents_terms]
+    document_frequency = {}
+
+    for index, terms in enumerate(documents_terms):
+        for term in terms:
+            frequencies[index][term] = frequencies[index].get(term, 0) + 1
+        for term in frequencies[index]:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+
+    scores = np.zeros(count)
+    for term in set(query_terms):
+        if term not in document_frequency:
+            continue
+        idf = math.log(1 + (count - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+        for index, terms in enumerate(documents_terms):
+            frequency = frequencies[index].get(term, 0)
+            if frequency:
+                scores[index] += idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * len(terms) / average_length))
+    return scores
+
+
+class Reranker:
+
+    def __init__(self, keep=5, vector_weight=RERANK_VECTOR_WEIGHT, duplicate_threshold=RERANK_DUPLICATE_THRESHOLD,
+                 document_max_tokens=RERANK_DOCUMENT_MAX_TOKENS, permutations=64, shingle_size=3):
+        self.keep = keep
+        self.vector_weight = vector_weight
+        self.duplicate_threshold = duplicate_threshold
+        self.document_max_tokens = document_max_tokens
+        self.shingle_size = shingle_size
+        # one (a, b) per MinHash permutation, h(x) = (a * x + b) mod p
+        hashes = np.random.RandomState(0).randint(1, MINHASH_PRIME, size=(permutations, 2)).astype(np.uint64)
+        self.hash_a = hashes[:, :1]
+        self.hash_b = hashes[:, 1:]
+
+    # rows are (id, fields) in vector search rank order, the same rows come back reranked, deduplicated,
+    # compressed and at most keep long
+    def rerank(self, query_text, rows, text_field="assembled_for_embedding"):
+        if not rows:
+            return rows
+
+        query_terms = terms(query_text)
+        documents_terms = [terms(fields.get(text_field, "")) for _, fields in rows]
+
+        text_scores = bm25_scores(query_terms, documents_terms)
+        if text_scores.max() > 0:
+            text_scores = text_scores / text_scores.max()
+        vector_scores = 1 - np.arange(len(rows)) / len(rows)
+        scores = self.vector_weight * vector_scores + (1 - self.vector_weight) * text_scores
+
+        kept = []
+        signatures = []
+        for index in np.argsort(-scores, kind="stable"):
+            signature, size = self.signature(documents_terms[index])
+            if any(self.containment(signature, size, other, other_size) >= self.duplicate_threshold for other, other_size in signatures):
+                continue
+
+            signatures.append((signature, size))
+            kept.append(rows[index])
+            if len(kept) == self.keep:
+                break
+
+        return [(id, self.compress(fields, text_field, query_terms)) for id, fields in kept]
+
+    def signature(self, terms):
+        size = min(self.shingle_size, len(terms)) or 1
+        shingles = {" ".join(terms[index:index + size]) for index in range(max(1, len(terms) - size + 1))}
+        values = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+        return ((self.hash_a * values + self.hash_b) % MINHASH_PRIME).min(axis=1), len(shingles)
+
+    # share of the smaller document's shingles found in the other one, from the MinHash estimate of their
+    # jaccard similarity and the shingle counts, so a forwarded copy or a trimmed version counts as a duplicate
+    @staticmethod
+    def containment(signature, size, other, other_size):
+        jaccard = np.mean(signature == other)
+        return jaccard * (size + other_size) / ((1 + jaccard) * min(size, other_size))
+
+    # the sentences sharing the most (rarer within the document) query terms, in document order, within budget
+    def compress(self, fields, text_field, query_terms):
+        text = fields.get(text_field, "")
+        if not self.document_max_tokens or len(encoding.encode(text)) <= self.document_max_tokens:
+            return fields
+
+        parts = sentences(text)
+        scores = bm25_scores(query_terms, [terms(sentence) for sentence in parts])
+        chosen = []
+        tokens = 0
+
+        for index in np.argsort(-scores, kind="stable"):
+            sentence_tokens = len(encoding.encode(parts[index]))
+            if tokens + sentence_tokens > self.document_max_tokens:
+                continue
+            chosen.append(index)
+            tokens += sentence_tokens
+
+        if not chosen:
+            best = parts[int(np.argmax(scores))]
+            return dict(fields, **{text_field: encoding.decode(encoding.encode(best)[:self.document_max_tokens])})
+
+        return dict(fields, **{text_field: " ".join(parts[index] for index in sorted(chosen))})
@@ -0,0 +1,260 @@
+from couchbase.vector_search import VectorQuery, VectorSearch
+import couchbase.search as search
+from couchbase.options import SearchOptions
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from metrics import couchbase_operation, span, get_logger
+from reranker import Reranker, RERANK, RERANK_CANDIDATES
+import asyncio
+import os
+import tiktoken
+
+
+# the metadata pipeline's "type" labels and the collections the labelled documents are routed to
+TYPE_COLLECTIONS = {
+    "internal_policies": "policies",
+    "insurance_product": "products",
+}
+
+encoding = tiktoken.get_encoding("cl100k_base")
+
+logger = get_logger("retriever")
+
+
+# what the chat pipeline retrieves through. retrieve(vector, query_text, collections) and its async
+# twin return the product ids, the additional context and the documents, like the couchbase search did
+class Retriever(ABC):
+
+    def __init__(self, key_context_field="assembled_for_embedding", k=5, collections=None, types=None, context_max_tokens=3000, reranker=None):
+        self.key_context_field = key_context_field
+        self.k = k
+        self.collections = self.resolve_collections(collections, types)
+        self.context_max_tokens = context_max_tokens
+        self.fields = [key_context_field, "source", "from"]
+        self.reranker = reranker
+
+    def resolve_collections(self, collections, types):
+        resolved = list(collections or []) + [TYPE_COLLECTIONS[type] for type in (types or [])]
+        return sorted(set(resolved)) or None
+
+    @abstractmethod
+    def retrieve(self, vector, query_text, collections=None):
+        pass
+
+    async def aretrieve(self, vector, query_text, collections=None):
+        return self.retrieve(vector, query_text, collections)
+
+    # with a reranker, k is the number of candidates fetched and the reranker keeps the best of them
+    def finish(self, rows, query_text):
+        if self.reranker is not None:
+            with span("rerank"):
+                rows = self.reranker.rerank(query_text, rows, self.key_context_field)
+        return self.build_context(rows)
+
+    # documents are added in rank order until the next one doesn't fit, the first one is cut to fit if needed
+    def build_context(self, rows):
+        product_ids = []
+        additional_context = ""
+        documents = []
+        tokens = 0
+
+        for id, fields in rows:
+            text = fields.get(self.key_context_field, "")
+            text_tokens = encoding.encode(text)
+
+            if tokens + len(text_tokens) > self.context_max_tokens:
+                if product_ids:
+                    break
+                text = encoding.decode(text_tokens[:self.context_max_tokens])
+                text_tokens = text_tokens[:self.context_max_tokens]
+
+            product_ids.append(id)
+            additional_context += text + "\n"
+            documents.append(fields)
+            tokens += len(text_tokens)
+
+        return product_ids, additional_context, documents
+
+    # the best limit chunk rows become one row per parent document, in the rank order of its best chunk, with
+    # the text of its retrieved chunks in document order as the context. parents outside collections are left out
+    def group_chunks(self, rows, collections=None, limit=None, text_field="text"):
+        collections = collections or self.collections
+        parents = {}
+        kept = 0
+
+        for id, fields in rows:
+            if collections and fields.get("parent_collection") not in collections:
+                continue
+            if limit and kept == limit:
+                break
+            parent = parents.setdefault(fields.get("parent_id", id), dict(fields, chunks=[]))
+            parent["chunks"].append((fields.get("chunk_index", 0), fields.get(text_field, "")))
+            kept += 1
+
+        grouped = []
+        for parent_id, fields in list(parents.items())[:self.k]:
+            chunks = sorted(fields.pop("chunks"))
+            fields.pop(text_field, None)
+            fields.pop("chunk_index", None)
+            fields[self.key_context_field] = "\n".join(text for _, text in chunks)
+            fields["chunk_indexes"] = [index for index, _ in chunks]
+            grouped.append((parent_id, fields))
+
+        return grouped
+
+
+# built once at startup around the main.data scope and embedding-index. retrieves k documents out of
+# num_candidates vector candidates, optionally restricted to some collections or types, optionally fused
+# with a text query over the indexed text fields, and keeps the context within a token budget. with chunks,
+# the chunk_k best chunks of main.data.chunks are retrieved instead and grouped by parent document.
+# index_name may list several indexes, comma separated: while migrate_vectors.py re-encodes the embeddings
+# every document is in one of the old and the new index, so the vector search runs on all of them and the
+# rows are merged by score, the same similarity in each. the text fields are in all of them, the first is used
+class CouchbaseRetriever(Retriever):
+
+    def __init__(self, cluster, embedding_field="embedding", num_candidates=10, hybrid=False,
+                 text_fields=("assembled_for_embedding", "product_name", "product_overview", "product_details"),
+                 vector_weight=1.0, text_weight=1.0, index_name="embedding-index", chunks=False, chunk_k=8, **kwargs):
+        super().__init__(**kwargs)
+        self.scope = cluster.bucket("main").scope("data")
+        self.index_name = index_name
+        self.index_names = [name.strip() for name in index_name.split(",") if name.strip()]
+        self.embedding_field = embedding_field
+        self.num_candidates = num_candidates
+        self.hybrid = hybrid
+        self.text_fields = text_fields
+        self.vector_weight = vector_weight
+        self.text_weight = text_weight
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.chunks = chunks
+        self.chunk_k = chunk_k
+
+        if chunks:
+            self.fields = ["text", "parent_id", "parent_collection", "chunk_index", "source", "from"]
+            self.text_fields = ("text",)
+
+    def search_options(self, limit, collections):
+        collections = ["chunks"] if self.chunks else collections or self.collections
+        if collections:
+            return SearchOptions(limit=limit, fields=self.fields, collections=collections)
+        return SearchOptions(limit=limit, fields=self.fields)
+
+    # chunks of other collections are filtered out after the search, so more are fetched then
+    def search_limit(self, collections):
+        if not self.chunks:
+            return self.k
+        if collections or self.collections:
+            return max(self.chunk_k, self.num_candidates)
+        return self.chunk_k
+
+    def rows_to_context(self, rows, query_text, collections):
+        if self.chunks:
+            rows = self.group_chunks(rows, collections, self.chunk_k)
+        return self.finish(rows, query_text)
+
+    def vector_request(self, vector):
+        return search.SearchRequest.create(search.MatchNoneQuery()).with_vector_search(
+            VectorSearch.from_vector_query(VectorQuery(self.embedding_field, vector, num_candidates=self.num_candidates)))
+
+    def text_request(self, query_text):
+        return search.SearchRequest.create(search.DisjunctionQuery(
+            *[search.MatchQuery(query_text, field=field) for field in self.text_fields]))
+
+    def vector_search(self, vector, collections=None):
+        limit = self.search_limit(collections)
+        with couchbase_operation("vector_search"):
+            results = [self.scope.search(name, self.vector_request(vector), self.search_options(limit, collections)) for name in self.index_names]
+            return self.merge_rows([list(result.rows()) for result in results], limit)
+
+    def text_search(self, query_text, collections=None):
+        with couchbase_operation("text_search"):
+            result = self.scope.search(self.index_names[0], self.text_request(query_text), self.search_options(self.num_candidates, collections))
+            return [(row.id, row.fields) for row in result.rows()]
+
+    def retrieve(self, vector, query_text, collections=None):
+        if not self.hybrid:
+            return self.rows_to_context(self.vector_search(vector, collections), query_text, collections)
+
+        text_future = self.executor.submit(self.text_search, query_text, collections)
+        vector_rows = self.vector_search(vector, collections)
+        return self.rows_to_context(self.fuse(vector_rows, text_future.result(), self.search_limit(collections)), query_text, collections)
+
+    # same as above for the acouchbase cluster
+    async def avector_search(self, vector, collections=None):
+        limit = self.search_limit(collections)
+
+        async def rows(name):
+            result = self.scope.search(name, self.vector_request(vector), self.search_options(limit, collections))
+            return [row async for row in result.rows()]
+
+        with couchbase_operation("vector_search"):
+            return self.merge_rows(await asyncio.gather(*[rows(name) for name in self.index_names]), limit)
+
+    async def atext_search(self, query_text, collections=None):
+        with couchbase_operation("text_search"):
+            result = self.scope.search(self.index_names[0], self.text_request(query_text), self.search_options(self.num_candidates, collections))
+            return [(row.id, row.fields) async for row in result.rows()]
+
+    async def aretrieve(self, vector, query_text, collections=None):
+        if not self.hybrid:
+            return self.rows_to_context(await self.avector_search(vector, collections), query_text, collections)
+
+        vector_rows, text_rows = await asyncio.gather(self.avector_search(vector, collections), self.atext_search(query_text, collections))
+        return self.rows_to_context(self.fuse(vector_rows, text_rows, self.search_limit(collections)), query_text, collections)
+
+    # the best scored rows of one or more indexes, a document found in several of them once
+    def merge_rows(self, results, limit):
+        if len(results) == 1:
+            return [(row.id, row.fields) for row in results[0]]
+
+        best = {}
+        for rows in results:
+            for row in rows:
+                if row.id not in best or row.score > best[row.id].score:
+                    best[row.id] = row
+
+        return [(row.id, row.fields) for row in sorted(best.values(), key=lambda row: row.score, reverse=True)[:limit]]
+
+    # reciprocal rank fusion, the raw vector and text scores aren't on comparable scales
+    def fuse(self, vector_rows, text_rows, limit=None):
+        scores = {}
+        fields = {}
+
+        for weight, rows in ((self.vector_weight, vector_rows), (self.text_weight, text_rows)):
+            for rank, (id, row_fields) in enumerate(rows):
+                scores[id] = scores.get(id, 0.0) + weight / (60 + rank + 1)
+                fields.setdefault(id, row_fields)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:limit or self.k]
+        return [(id, fields[id]) for id in ranked]
+
+
+# RETRIEVER_BACKEND picks couchbase (embedding-index) or local (the numpy index saved at LOCAL_INDEX_PATH)
+def retriever_from_env(cluster):
+    split = lambda value: [item.strip() for item in value.split(",") if item.strip()] if value else None
+
+    options = dict(
+        k=int(os.getenv("RETRIEVER_K", 5)),
+        collections=split(os.getenv("RETRIEVER_COLLECTIONS")),
+        types=split(os.getenv("RETRIEVER_TYPES")),
+        context_max_tokens=int(os.getenv("RETRIEVER_CONTEXT_MAX_TOKENS", 3000)),
+    )
+
+    # RERANK over-fetches RERANK_CANDIDATES and keeps RETRIEVER_K of them
+    if RERANK:
+        options.update(reranker=Reranker(keep=options["k"]), k=max(options["k"], RERANK_CANDIDATES))
+
+    if os.getenv("RETRIEVER_BACKEND", "couchbase") == "local":
+        from local_index import LocalVectorRetriever
+        logger.info("Loading local vector index..")
+        return LocalVectorRetriever.load(os.getenv("LOCAL_INDEX_PATH", "./local-index"), nprobe=int(os.getenv("LOCAL_INDEX_NPROBE", 4)), rerank_factor=int(os.getenv("LOCAL_INDEX_RERANK_FACTOR", 16)), **options)
+
+    return CouchbaseRetriever(
+        cluster,
+        index_name=os.getenv("RETRIEVER_INDEX_NAME", "embedding-index"),
+        num_candidates=int(os.getenv("RETRIEVER_NUM_CANDIDATES", 10)),
+        hybrid=os.getenv("RETRIEVER_HYBRID", "false").lower() == "true",
+        chunks=os.getenv("RETRIEVER_CHUNKS", "false").lower() == "true",
+        chunk_k=int(os.getenv("RETRIEVER_CHUNK_K", 8)),
+        **options,
+    )
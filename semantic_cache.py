@@ -0,0 +1,101 @@
+from metrics import registry, get_logger
+import numpy as np
+import threading
+import time
+import uuid
+
+
+# in-process index over the query embeddings of cached answers. the answers themselves live in
+# main.cache.answers with a TTL, which stays the source of truth: a lookup only yields a candidate key,
+# and the caller drops it from here when the couchbase document has expired or been invalidated. the
+# cached documents keep their query vector and model, so the index is filled from main.cache.answers at
+# startup and refreshed from it (see scan_cached_answers), and every worker finds what the others cached.
+# keys start with the time they were written, so after the first full scan a refresh only range scans
+# the keys written since the previous one.
+# an entry only matches lookups for the model that wrote the answer.
+# the index is a bounded ring of unit vectors searched with one matrix-vector product, which at a few
+# thousand entries is faster than maintaining an approximate structure
+CACHE_KEY_PREFIX = "answer::t"
+
+logger = get_logger("semantic_cache")
+hit_similarity = registry.histogram("chatbot_semantic_cache_hit_similarity", "Similarity of semantic cache hits to the cached question",
+                                    buckets=(0.95, 0.96, 0.97, 0.98, 0.99, 0.995, 1.0))
+
+
+class SemanticAnswerCache:
+
+    def __init__(self, threshold=0.95, max_entries=5000, ttl_seconds=86400):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.vectors = None
+        self.keys = [None] * max_entries
+        self.models = np.full(max_entries, None, dtype=object)
+        self.expiries = np.zeros(max_entries, dtype=np.float64)
+        self.slots = {}
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.slots
+
+    def lookup(self, vector, model=None):
+        with self.lock:
+            if self.vectors is None:
+                return None
+
+            scores = self.vectors @ normalise(vector)
+            scores[self.expiries < time.time()] = -1
+            if model is not None:
+                scores[self.models != model] = -1
+
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+
+            hit_similarity.observe(float(scores[best]))
+            logger.debug("Semantic cache hit %s, similarity %.4f", self.keys[best], scores[best])
+            return self.keys[best]
+
+    def add(self, key, vector, model=None, expires_at=None):
+        vector = normalise(vector)
+
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+
+            slot = self.slots.get(key, self.next_slot)
+            if slot == self.next_slot:
+                self.slots.pop(self.keys[slot], None)
+                self.next_slot = (slot + 1) % self.max_entries
+
+            self.vectors[slot] = vector
+            self.keys[slot] = key
+            self.models[slot] = model
+            self.expiries[slot] = expires_at if expires_at is not None else time.time() + self.ttl_seconds
+            self.slots[key] = slot
+
+    def remove(self, key):
+        with self.lock:
+            slot = self.slots.pop(key, None)
+            if slot is not None:
+                self.keys[slot] = None
+                self.models[slot] = None
+                self.expiries[slot] = 0
+
+
+def normalise(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def generate_cache_key():
+    return f"{cache_key_start(time.time())}::{uuid.uuid4()}"
+
+
+# the smallest key written at or after timestamp. keys of answers cached before keys had a time, answer::<uuid>,
+# sort before all of them
+def cache_key_start(timestamp):
+    return f"{CACHE_KEY_PREFIX}{int(timestamp * 1e9):020d}"
@@ -1,93 +1,258 @@
-from couchbase.vector_search import VectorQuery, VectorSearch
-import couchbase.search as search
-from couchbase.options import SearchOptions
+from couchbase.options import UpsertOptions, ScanOptions, ClusterOptions
+from couchbase.auth import PasswordAuthenticator
+from couchbase.exceptions import DocumentNotFoundException
+from couchbase.kv_range_scan import RangeScan, ScanTerm
 from dotenv import load_dotenv
+import os
 import uuid
 import datetime
+import functools
 import couchbase.subdocument as SD
+import time
+from metrics import couchbase_operation
+from vector_encoding import encode_vector, decode_vector
+from semantic_cache import cache_key_start
 
 load_dotenv()
 
-def cb_vector_search(cluster, embedding_field, vector, key_context_field): 
-    bucket = cluster.bucket("main")
-    scope = bucket.scope("data")
-    search_index = "embedding-index"
-    search_req = search.SearchRequest.create(search.MatchNoneQuery()).with_vector_search(
-    VectorSearch.from_vector_query(VectorQuery(embedding_field, vector, num_candidates=3)))
-    return scope.search(search_index, search_req, SearchOptions(limit=13,fields=[key_context_field, "source", "from"]))
+# idle chat sessions written through to main.chats.sessions expire after this
+CHAT_SESSION_EXPIRY = datetime.timedelta(seconds=int(os.getenv("CHAT_SESSION_TTL_SECONDS", 1800)))
 
+# cached answers in main.cache.answers expire after this
+ANSWER_CACHE_EXPIRY = datetime.timedelta(seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 86400)))
 
-def insert_user_message(cluster, query, transformed_query, deviceType, browserType): 
+
+# the connection string and options of the Capella cluster at CB_HOSTNAME, or of the cluster at EE_HOSTNAME
+def cluster_connection(capella):
+    auth = PasswordAuthenticator(os.getenv("CB_USERNAME"), os.getenv("CB_PASSWORD"))
+    options = ClusterOptions(auth)
+
+    if capella:
+        options.apply_profile('wan_development')
+        return 'couchbases://{}'.format(os.getenv("CB_HOSTNAME")), options
+
+    return f'couchbase://{os.getenv("EE_HOSTNAME")}', options
+
+
+# bucket, scope and collection handles are resolved once per cluster and collection
+@functools.lru_cache(maxsize=None)
+def get_collection(cluster, scope, collection):
+    return cluster.bucket("main").scope(scope).collection(collection)
+
+
+def load_chat_session(cluster, session_id):
+    session_collection = get_collection(cluster, "chats", "sessions")
+    
+    try:
+        with couchbase_operation("load_chat_session", expected=(DocumentNotFoundException,)):
+            return session_collection.get(session_id).content_as[dict]['messages']
     
-    chat_collection = cluster.bucket("main").scope("chats").collection("human")   
+    except DocumentNotFoundException:
+        return None
+    
+    except Exception as e:
+        print("exception:", e)
+        return None 
+
+
+def save_chat_session(cluster, session_id, messages):
+    session_collection = get_collection(cluster, "chats", "sessions")
     
     try:
-        uuid_to_insert = str(generate_uuid())
-        
-        document = dict(
-            query=query,
-            transformed_query=transformed_query,
-            device_type=deviceType,
-            browser_type=browserType,
-            # mock up further user data
-            user_id="H123",
-            timestamp=datetime.datetime.now().isoformat(),
-        )
-        chat_collection.upsert(
-            uuid_to_insert,
-            document
-        )
-        
-        print("UPSERT SUCCESS", uuid_to_insert)
-        
-        return uuid_to_insert
+        with couchbase_operation("save_chat_session"):
+            session_collection.upsert(session_id, chat_session_document(messages), UpsertOptions(expiry=CHAT_SESSION_EXPIRY))
         
     except Exception as e:
         print("exception:", e)
-        
+
+
+async def aload_chat_session(cluster, session_id):
+    session_collection = get_collection(cluster, "chats", "sessions")
+    
+    try:
+        with couchbase_operation("load_chat_session", expected=(DocumentNotFoundException,)):
+            result = await session_collection.get(session_id)
+        return result.content_as[dict]['messages']
+    
+    except DocumentNotFoundException:
+        return None
+    
+    except Exception as e:
+        print("exception:", e)
         return None 
 
 
-def insert_bot_message(cluster, message, user_msg_id, product_ids): 
-    chat_collection = cluster.bucket("main").scope("chats").collection("bot")   
+async def asave_chat_session(cluster, session_id, messages):
+    session_collection = get_collection(cluster, "chats", "sessions")
     
     try:
-        uuid_to_insert = str(generate_uuid())
-        
-        document = dict(
-            message=message,
-            user_msg_id=user_msg_id,
-            timestamp=datetime.datetime.now().isoformat(),
-            product_ids=product_ids
-        )
-        chat_collection.upsert(
-            uuid_to_insert,
-            document
-        )
-        
-        print("UPSERT SUCCESS", uuid_to_insert)
-        
-        return uuid_to_insert
+        with couchbase_operation("save_chat_session"):
+            await session_collection.upsert(session_id, chat_session_document(messages), UpsertOptions(expiry=CHAT_SESSION_EXPIRY))
         
     except Exception as e:
         print("exception:", e)
-        return None 
+
+
+def get_cached_answer(cluster, cache_key):
+    cache_collection = get_collection(cluster, "cache", "answers")
     
+    try:
+        with couchbase_operation("get_cached_answer", expected=(DocumentNotFoundException,)):
+            return cache_collection.get(cache_key).content_as[dict]
+    
+    except DocumentNotFoundException:
+        return None
+    
+    except Exception as e:
+        print("exception:", e)
+        return None 
+
 
-def update_bot_message_rating(cluster, bot_msg_id, rating):
-    print("UPDATING RATING", bot_msg_id, rating)
-    chat_collection = cluster.bucket("main").scope("chats").collection("bot")   
+def insert_cached_answer(cluster, cache_key, query, answer, product_ids, documents, vector, model):
+    cache_collection = get_collection(cluster, "cache", "answers")
     
-    try:        
-        chat_collection.mutate_in(bot_msg_id, [SD.upsert("rating", rating)])
+    try:
+        with couchbase_operation("insert_cached_answer"):
+            cache_collection.upsert(cache_key, cached_answer_document(query, answer, product_ids, documents, vector, model), UpsertOptions(expiry=ANSWER_CACHE_EXPIRY))
+        return True
         
-        print("UPDATED RATING SUCCESS")
-                
+    except Exception as e:
+        print("exception:", e)
+        return False
+
+
+async def aget_cached_answer(cluster, cache_key):
+    cache_collection = get_collection(cluster, "cache", "answers")
+    
+    try:
+        with couchbase_operation("get_cached_answer", expected=(DocumentNotFoundException,)):
+            result = await cache_collection.get(cache_key)
+        return result.content_as[dict]
+    
+    except DocumentNotFoundException:
+        return None
+    
     except Exception as e:
         print("exception:", e)
         return None 
+
+
+async def ainsert_cached_answer(cluster, cache_key, query, answer, product_ids, documents, vector, model):
+    cache_collection = get_collection(cluster, "cache", "answers")
+    
+    try:
+        with couchbase_operation("insert_cached_answer"):
+            await cache_collection.upsert(cache_key, cached_answer_document(query, answer, product_ids, documents, vector, model), UpsertOptions(expiry=ANSWER_CACHE_EXPIRY))
+        return True
+        
+    except Exception as e:
+        print("exception:", e)
+        return False
+
+
+# document_ids is what the cache_invalidation eventing function matches changed products and policies against,
+# vector (the query embedding, base64 float32), model and expires_at are what the semantic cache index is
+# rebuilt from
+def cached_answer_document(query, answer, product_ids, documents, vector, model):
+    return dict(
+        query=query,
+        answer=answer,
+        document_ids=product_ids,
+        documents=documents,
+        vector=encode_vector(vector, "base64"),
+        model=model,
+        expires_at=time.time() + ANSWER_CACHE_EXPIRY.total_seconds(),
+        timestamp=datetime.datetime.now().isoformat(),
+    )
+
+
+CACHED_ANSWER_INDEX_FIELDS = [SD.get("vector"), SD.get("model"), SD.get("expires_at")]
+
+
+def cached_answer_entry(key, result):
+    if not result.exists(0):
+        return None
+    field = lambda index: result.content_as[lambda content: content](index) if result.exists(index) else None
+    return key, decode_vector(field(0)), field(1), field(2)
+
+
+# (key, query vector, model, expiry timestamp) of the cached answers in main.cache.answers not in known_keys,
+# for the semantic cache index. only ids are scanned, the vectors of new entries are read with sub-document
+# lookups. with since, only the keys of answers cached from that timestamp on are scanned. answers cached
+# before the vector was stored are skipped
+def cached_answers_range(since):
+    return RangeScan() if since is None else RangeScan(start=ScanTerm(cache_key_start(since)))
+
+
+def scan_cached_answers(cluster, known_keys=(), since=None):
+    cache_collection = get_collection(cluster, "cache", "answers")
+    entries = []
+    
+    try:
+        for item in cache_collection.scan(cached_answers_range(since), ScanOptions(ids_only=True)):
+            if item.id in known_keys:
+                continue
+            try:
+                entry = cached_answer_entry(item.id, cache_collection.lookup_in(item.id, CACHED_ANSWER_INDEX_FIELDS))
+            except DocumentNotFoundException:
+                continue
+            if entry is not None:
+                entries.append(entry)
     
+    except Exception as e:
+        print("exception:", e)
+    
+    return entries
+
+
+async def ascan_cached_answers(cluster, known_keys=(), since=None):
+    cache_collection = get_collection(cluster, "cache", "answers")
+    entries = []
+    
+    try:
+        async for item in cache_collection.scan(cached_answers_range(since), ScanOptions(ids_only=True)):
+            if item.id in known_keys:
+                continue
+            try:
+                entry = cached_answer_entry(item.id, await cache_collection.lookup_in(item.id, CACHED_ANSWER_INDEX_FIELDS))
+            except DocumentNotFoundException:
+                continue
+            if entry is not None:
+                entries.append(entry)
     
+    except Exception as e:
+        print("exception:", e)
+    
+    return entries
+
+
+def chat_session_document(messages):
+    return dict(
+        messages=messages,
+        timestamp=datetime.datetime.now().isoformat(),
+    )
+
+
+def user_message_document(query, transformed_query, deviceType, browserType):
+    return dict(
+        query=query,
+        transformed_query=transformed_query,
+        device_type=deviceType,
+        browser_type=browserType,
+        # mock up further user data
+        user_id="H123",
+        timestamp=datetime.datetime.now().isoformat(),
+    )
+
+
+def bot_message_document(message, user_msg_id, product_ids):
+    return dict(
+        message=message,
+        user_msg_id=user_msg_id,
+        timestamp=datetime.datetime.now().isoformat(),
+        product_ids=product_ids
+    )
+
 
 def generate_uuid(): 
     return uuid.uuid4()
\ No newline at end of file
@@ -0,0 +1,68 @@
+import time
+
+
+# turns the answer chunks of one message into socket events. clients that send "delta": true get one
+# "sources" event, small "token" events and a "done" event; older clients keep getting the whole
+# "message" payload. in both cases chunks are coalesced so at most one event goes out per coalesce_seconds
+class MessageStream:
+
+    def __init__(self, timestamp, product_ids, documents, delta=False, coalesce_seconds=0.05):
+        self.timestamp = timestamp
+        self.product_ids = product_ids
+        self.documents = documents
+        self.delta = delta
+        self.coalesce_seconds = coalesce_seconds
+        self.message_string = ""
+        self.pending = ""
+        self.last_flush = time.time()
+
+    def start(self):
+        if not self.delta:
+            return []
+
+        return [('sources', {
+            "timestamp": self.timestamp,
+            "document_ids": self.product_ids,
+            "documents": self.documents
+        })]
+
+    def add(self, chunk):
+        self.message_string += chunk
+        self.pending += chunk
+
+        if time.time() - self.last_flush < self.coalesce_seconds:
+            return []
+        return self.flush()
+
+    def finish(self, bot_message_id):
+        events = self.flush()
+
+        if self.delta:
+            events.append(('done', {
+                "timestamp": self.timestamp,
+                "bot_message_id": bot_message_id
+            }))
+
+        return events
+
+    def flush(self):
+        self.last_flush = time.time()
+
+        if not self.pending:
+            return []
+
+        text = self.pending
+        self.pending = ""
+
+        if self.delta:
+            return [('token', {
+                "timestamp": self.timestamp,
+                "text": text
+            })]
+
+        return [('message', {
+            "timestamp": self.timestamp,
+            "message_string": self.message_string,
+            "document_ids": self.product_ids,
+            "documents": self.documents
+        })]
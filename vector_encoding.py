@@ -0,0 +1,98 @@
+from dotenv import load_dotenv
+import base64
+import copy
+import json
+import numpy as np
+import os
+
+load_dotenv()
+
+
+# how the embedding endpoints return vectors, and so how the eventing functions store them in "embedding":
+# "array" is a json float array (about 20 characters per dimension), "base64" the little-endian float32
+# bytes in base64 (about 5.3 per dimension), which the search service indexes as a vector_base64 field.
+# "base64_float16" halves that again for storage only, the search service can't index it, the local index
+# and the migration tool read it. its values start with "f16:", so the encoding of a stored value is never
+# guessed from its length. the index mapping has to match: setupothers.py and migrate_vectors.py write it
+# from fts-index.json for EMBEDDING_ENCODING
+EMBEDDING_ENCODING = os.getenv("EMBEDDING_ENCODING", "array")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1536))
+
+ENCODINGS = {
+    "array": None,
+    "base64": "<f4",
+    "base64_float16": "<f2",
+}
+
+# base64 values stay unprefixed, that's what the search service indexes
+PREFIXES = {
+    "base64_float16": "f16:",
+}
+
+# the search index field type of each encoding, None where the search service can't index it
+INDEX_FIELD_TYPES = {
+    "array": "vector",
+    "base64": "vector_base64",
+    "base64_float16": None,
+}
+
+
+def encode_vector(vector, encoding=EMBEDDING_ENCODING):
+    dtype = ENCODINGS[encoding]
+    if dtype is None:
+        return [float(value) for value in vector]
+    return PREFIXES.get(encoding, "") + base64.b64encode(np.asarray(vector, dtype=dtype).tobytes()).decode("ascii")
+
+
+# the encoding of a base64 value and its bytes. raises ValueError when they don't hold dimensions elements
+# of that encoding, e.g. a float16 value stored without its prefix
+def split_encoded(value, dimensions=EMBEDDING_DIMENSIONS):
+    encoding = next((encoding for encoding, prefix in PREFIXES.items() if value.startswith(prefix)), "base64")
+    data = base64.b64decode(value[len(PREFIXES.get(encoding, "")):])
+    expected = np.dtype(ENCODINGS[encoding]).itemsize * dimensions if dimensions else None
+
+    if expected is not None and len(data) != expected:
+        raise ValueError(f"{encoding} vector of {len(data)} bytes, {expected} expected for {dimensions} dimensions")
+    return encoding, data
+
+
+# a float32 array from any of the encodings
+def decode_vector(value, dimensions=EMBEDDING_DIMENSIONS):
+    if not isinstance(value, str):
+        return np.asarray(value, dtype=np.float32)
+
+    encoding, data = split_encoded(value, dimensions)
+    return np.frombuffer(data, dtype=ENCODINGS[encoding]).astype(np.float32)
+
+
+def vector_encoding(value, dimensions=EMBEDDING_DIMENSIONS):
+    if not isinstance(value, str):
+        return "array"
+    return split_encoded(value, dimensions)[0]
+
+
+# bytes the value takes in a json document
+def encoded_size(value):
+    return len(json.dumps(value, separators=(",", ":")))
+
+
+# the search index definition with every vector field of fts-index.json typed for encoding
+def index_definition(definition, encoding=EMBEDDING_ENCODING):
+    field_type = INDEX_FIELD_TYPES[encoding]
+    if field_type is None:
+        raise ValueError(f"the search service can't index {encoding} vectors")
+
+    definition = copy.deepcopy(definition)
+
+    def retype(value):
+        if isinstance(value, dict):
+            if value.get("type") in ("vector", "vector_base64") and "dims" in value:
+                value["type"] = field_type
+            for item in value.values():
+                retype(item)
+        elif isinstance(value, list):
+            for item in value:
+                retype(item)
+
+    retype(definition)
+    return definition